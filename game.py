@@ -3,49 +3,52 @@ File: game.py
 Author: Jay Kmetz
 """
 
-# LOCAL IMPORTS
-from pyobjs.Spaceship import Spaceship
-from pyobjs.Asteroid import Asteroid
-from pyobjs.Planet import Planet
+import importlib.util
+import os
+import random
+import sys
+import threading
+import time
 
-from utils.quat import *
-from utils.View import View
-from utils.util import *
+START_TIME = time.perf_counter()    # for time to first frame
 
+# DEPENDENCY CHECK
+# find_spec only locates the packages, nothing gets imported until it is needed
 pinstalled = True
-
-try:
-    from OpenGL.GL import *
-    from OpenGL.GLU import *
-    from OpenGL.GLUT import *
-except ImportError:
-    print("DEPENDENCY: 'OpenGL' NOT MET")
-    pinstalled = False
-
-try:
-    import pygame
-    from pygame.locals import *
-except ImportError:
-    print("DEPENDENCY: 'pygame' NOT MET")
-    pinstalled = False
-
-try:
-    import numpy as np
-except ImportError:
-    print("DEPENDENCY: 'numpy' NOT MET")
-    pinstalled = False
-
-try:
-    from PIL.Image import open
-except ImportError:
-    print("DEPENDENCY: 'PIL' NOT MET")
-    pinistalled = False
+for dependency in ("OpenGL", "pygame", "numpy", "PIL"):
+    if importlib.util.find_spec(dependency) is None:
+        print(f"DEPENDENCY: '{dependency}' NOT MET")
+        pinstalled = False
 
 if not pinstalled:
     print("Please install the dependenc(y|ies) above using pip or a similar service. Thank you!")
     exit()
 
-import random
+from OpenGL.GL import *
+from OpenGL.GLU import *
+import pygame
+from pygame.locals import *
+import numpy as np
+
+# LOCAL IMPORTS
+# optional subsystems (gravity, generated asteroid meshes, textures) import their modules when first used
+from pyobjs.Spaceship import Spaceship
+from pyobjs.Asteroid import Asteroid
+from pyobjs.Planet import Planet
+from pyobjs.ColObj import times_of_impact
+from utils.SceneGraph import SceneGraph, SceneNode
+from utils.spatial import GridIndex
+from utils.snapshot import Recorder, read_save, rng_state
+from utils.LevelGenerator import LevelGenerator
+from utils.simthread import SimThread, Frame, ShipView, TickTimer
+from utils.debugdraw import debug, CATEGORIES
+from utils.glpool import pool
+
+from utils.quat import *
+from utils.View import View
+from utils.util import *
+from utils.Input import InputMap, InputState
+from utils import Input
 
 
 # GLOBALS
@@ -72,6 +75,12 @@ VIEW_BR         = 'VBR'
 VIEW_T          = 'VT'
 VIEW_STATIC     = 'VS'
 VIEW_ORBIT      = 'VO'
+NEW_LEVEL       = 'NL'
+AUTOPILOT_KEY   = 'AP'
+REWIND_KEY      = 'RW'
+QUICKSAVE_KEY   = 'QS'
+QUICKLOAD_KEY   = 'QL'
+DEBUG_DRAW_KEY  = 'DD'
 
 U_KEYS = {
     ROLL_LEFT: 97,      # A
@@ -94,9 +103,26 @@ U_KEYS = {
     VIEW_BR: 108,       # L
     VIEW_T: 105,        # I
     VIEW_STATIC: 107,   # K
-    VIEW_ORBIT: 111     # O
+    VIEW_ORBIT: 111,    # O
+
+    NEW_LEVEL: 118,     # V
+    AUTOPILOT_KEY: 112, # P
+
+    REWIND_KEY: 98,     # B
+    QUICKSAVE_KEY: 109, # M
+    QUICKLOAD_KEY: 110, # N
+
+    DEBUG_DRAW_KEY: 103 # G
 }
 
+# STARTUP
+STARTUP_BASELINE_FILE = "./startup_baseline.json"   # first frame and import times recorded on this machine
+STARTUP_TOLERANCE = .25     # --measure-startup fails if the first frame is this much slower than the baseline
+STARTUP_RUNS = 3            # runs measured, the fastest is compared so one slow start isn't a regression
+
+# Optional JSON file overriding U_KEYS, e.g. {"TU": "w", "RL": 97}
+KEYMAP_FILE = "./keys.json"
+
 # VIEWS
 V_BACKRIGHT = 'VBR'
 V_FRONTLEFT = 'VFL'
@@ -115,96 +141,88 @@ U_VIEWS = {
 # Format: (x,y,z) relative to ship and then stay
 CURVIEW = V_BACKRIGHT
 
-
-def wait():
-    waiting = True
-    while waiting:
-        for event in pygame.event.get():
-            if event.type == QUIT:
-                pygame.quit()
-                sys.exit()
-            if event.type == KEYDOWN:
-                return
-
-
-def handleKeyEvent(env, event):
-    # KEY TESTING
-    # if event.type == pygame.KEYDOWN:
-    #     print(f'u: {event.unicode if hasattr(event,"unicode") else "none"}; k:{event.key}')
-
-    up = KP_UP if event.type == pygame.KEYUP else 0
-    ship = env["ship"]
-
-    def rl(up): # roll left
-        ship.setRot(Spaceship.ROLL, Spaceship.LEFT, up)
-    def rr(up): # roll right
-        ship.setRot(Spaceship.ROLL, Spaceship.RIGHT, up)
-    def rc(up): # roll center
-        ship.resetRot(Spaceship.ROLL)
-    def pl(up): # pitch left
-        ship.setRot(Spaceship.PITCH, Spaceship.LEFT, up)
-    def pr(up): # pitch right
-        ship.setRot(Spaceship.PITCH, Spaceship.RIGHT, up)
-    def pc(up): # pitch center
-        ship.resetRot(Spaceship.PITCH, up)
-    def yl(up): # yaw left
-        ship.setRot(Spaceship.YAW, Spaceship.LEFT, up)
-    def yr(up): # yaw right
-        ship.setRot(Spaceship.YAW, Spaceship.RIGHT, up)
-    def yc(up): # yaw center
-        ship.resetRot(Spaceship.YAW, up)
-    def tu(up): # thrust up
-        ship.setThrust(Spaceship.THF, up)
-    def td(up): # thrust down
-        ship.setThrust(Spaceship.THB, up)
-    def tc(up): # thrust center
-        ship.applyOppThrust(up)
-    def vbr(up):    # view back right
-        global CURVIEW
-        if not up:
-            CURVIEW = V_BACKRIGHT
-    def vfl(up):    # view front left
-        global CURVIEW
-        if not up:
-            CURVIEW = V_FRONTLEFT
-    def vt(up): # view top
-        global CURVIEW
-        if not up:
-            CURVIEW = V_TOP
-    def vs(up): # view static
-        global CURVIEW
-        if not up:
-            v_pos = U_VIEWS[CURVIEW].get_position()
-            v_up = U_VIEWS[CURVIEW].upvec
-            U_VIEWS[V_STATIC].set_static_view(ship.pos, ship.orient,v_pos,v_up)
-            CURVIEW = V_STATIC
-    def vo(up): # view orbit
-        global CURVIEW
-        if not up:
-            CURVIEW = V_ORBIT
-
-    # Execute Switch on event.key
-    func = {
-        U_KEYS[ROLL_LEFT]: rl,
-        U_KEYS[ROLL_RIGHT]: rr,
-        U_KEYS[ROLL_CENTER]: rc,
-        U_KEYS[PITCH_LEFT]: pl,
-        U_KEYS[PITCH_RIGHT]: pr,
-        U_KEYS[PITCH_CENTER]: pc,
-        U_KEYS[YAW_LEFT]: yl,
-        U_KEYS[YAW_RIGHT]: yr,
-        U_KEYS[YAW_CENTER]: yc,
-        U_KEYS[THRUST_UP]: tu,
-        U_KEYS[THRUST_DOWN]: td,
-        U_KEYS[THRUST_CENTER]: tc,
-        U_KEYS[V_BACKRIGHT]: vbr,
-        U_KEYS[V_FRONTLEFT]: vfl,
-        U_KEYS[V_TOP]: vt,
-        U_KEYS[V_STATIC]: vs,
-        U_KEYS[V_ORBIT]: vo
-    }.get(event.key, None)
-    if func:
-        func(up)
+# ASTEROIDS
+ASTEROID_VARIANTS = 6       # distinct generated asteroid shapes per level, 0 for the stock mesh only
+ASTEROID_SEED_POOL = 32     # variant seeds come from this pool so the mesh cache stays warm
+ASTEROID_DETAIL = 2         # icosphere subdivisions for generated asteroids
+
+# SIMULATION
+# Time each simulation tick advances, in flight model ticks. Movement, thrust, rotation, fuel burn,
+# gravity, the scene and particles all advance this much, so .5 is slow motion and 2 fast forward.
+# Collisions are swept over the whole step, so values above 1 don't tunnel.
+TIME_SCALE = 1.0
+SIM_THREAD = False      # tick on a worker thread at simthread.SIM_RATE, the window draws the newest tick
+
+# GRAVITY
+GRAVITY = False         # pull the ship and asteroids towards the planet
+MUTUAL_GRAVITY = False  # asteroids and the ship also attract each other
+# Barnes-Hut opening angle for mutual gravity, None for the exact O(N^2) sum. The tree is only used from
+# gravity.BH_MIN_BODIES bodies up, levels have far fewer so they get the exact sum either way.
+BH_THETA = .5
+
+# AUTOPILOT
+AUTOPILOT = False       # start every level with the landing autopilot flying, P toggles it
+PLAN_BUDGET_MS = 5.0    # autopilot planning time per tick
+
+# REWIND
+REWIND_SECONDS = 5      # how far back holding rewind goes, 0 turns recording off
+REWIND_SPEED = 2        # ticks stepped back per frame while rewinding
+SAVE_FILE = "./quicksave.isj"
+
+# LIGHTING
+SHADERS = True          # per-pixel GLSL lighting with the ship's spotlight, fixed-function lighting if it won't compile
+
+# QUALITY
+GOVERNOR = True         # trade render scale, trees, asteroid detail, HUD refreshes and draw distance for frame rate
+FRAME_TARGET_MS = 1000 / 60
+
+# TRAJECTORY
+PREDICT_SECONDS = 3     # length of the predicted path drawn ahead of the ship, 0 turns it off
+
+# PARTICLES
+PARTICLES = True        # thruster exhaust and impact debris
+CRASH_BURST = 4.0       # a planet crash throws this many times the debris of an asteroid hit
+
+# DEBUG DRAW
+DEBUG_DRAW = ()         # debugdraw.CATEGORIES shown from the start, G toggles the overlay
+
+# CAPTURE
+CAPTURE = None          # record the window: a directory of PNG frames, a .rgba raw file or a video file for ffmpeg
+CAPTURE_FPS = 60        # frames recorded a second at most
+CAPTURE_DROP = True     # skip frames while the writer is behind instead of holding up the game
+
+# RADAR
+RADAR_K = 12            # nearest asteroids shown
+RADAR_RANGE = 250       # world distance at the rim, anything further sits on the rim
+RADAR_RADIUS = 80       # pixels
+RADAR_RIM = np.stack((np.cos(np.linspace(0, 2 * np.pi, 48, endpoint=False)),
+                      np.sin(np.linspace(0, 2 * np.pi, 48, endpoint=False))), axis=1)
+
+
+# view switching happens on the tick a view key goes down
+VIEW_INPUTS = (
+    (Input.VIEW_BR, V_BACKRIGHT),
+    (Input.VIEW_FL, V_FRONTLEFT),
+    (Input.VIEW_T, V_TOP),
+    (Input.VIEW_STATIC, V_STATIC),
+    (Input.VIEW_ORBIT, V_ORBIT)
+)
+VIEW_INPUT_MASK = Input.VIEW_BR | Input.VIEW_FL | Input.VIEW_T | Input.VIEW_STATIC | Input.VIEW_ORBIT
+
+
+def handle_view_input(pressed, ship):
+    global CURVIEW
+    if not pressed & VIEW_INPUT_MASK:
+        return
+
+    for bit, view in VIEW_INPUTS:
+        if pressed & bit:
+            if view == V_STATIC:
+                # freeze the camera where the current view is
+                v_pos = U_VIEWS[CURVIEW].get_position()
+                v_up = U_VIEWS[CURVIEW].upvec
+                U_VIEWS[V_STATIC].set_static_view(ship.pos, ship.orient, v_pos, v_up)
+            CURVIEW = view
 
 
 def init_lighting():
@@ -237,6 +255,15 @@ def init_lighting():
     # glEnable(GL_LIGHT1)
 
 
+# viewport and perspective for a window this size
+def set_projection(width, height):
+    glViewport(0, 0, width, height)
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    gluPerspective(45, (width / max(1, height)), 0.1, 500.0)
+    glMatrixMode(GL_MODELVIEW)
+
+
 def calc_ambient():
     glPushMatrix()
 
@@ -247,8 +274,7 @@ def calc_ambient():
     glPopMatrix()
 
 
-def calc_view(env):
-    ship = env["ship"]
+def calc_view(ship):
     # calculate view from View object
     U_VIEWS[CURVIEW].local_gluLookAt(ship.pos, ship.orient)
 
@@ -274,6 +300,47 @@ def draw_centered_text(txt,col,font_size):
     glDrawPixels(txtSurf.get_width(), txtSurf.get_height(), GL_RGBA, GL_UNSIGNED_BYTE, txtdat)
 
 
+# Radar panel in the bottom right corner, ship's heading up and its right to the right.
+# Blips are the k nearest asteroids from the grid index plus the target planet, brighter above the ship
+# and darker below, drawn as one batch of points.
+def draw_radar(ship, planet_pos, index, asteroid_pos, k=RADAR_K):
+    cx, cy = SCREEN_WIDTH - RADAR_RADIUS - 20, SCREEN_HEIGHT - RADAR_RADIUS - 20
+
+    near, dist = index.knn(ship.pos, k)
+    world = np.vstack((asteroid_pos[near], planet_pos))
+    to_ship = q_to_mat4(q_conjugate(ship.orient))[:3, :3]   # world -> ship frame, same as qv_mult(q_conjugate(orient), v)
+    local = (world - ship.pos) @ to_ship.T
+
+    flat = np.linalg.norm(local[:, [0, 2]], axis=1)
+    scale = RADAR_RADIUS * np.minimum(flat, RADAR_RANGE) / (RADAR_RANGE * np.maximum(flat, 1e-9))
+    pts = np.stack((cx + local[:, 2] * scale, cy - local[:, 0] * scale), axis=1).astype(np.float32)
+
+    height = np.clip(local[:, 1] / RADAR_RANGE, -1, 1)[:, None]
+    colors = np.empty((len(pts), 3), dtype=np.float32)
+    colors[:] = (.9, .6, .2)    # asteroids
+    colors[-1] = (.2, .5, 1)    # planet
+    colors = np.clip(colors * (1 + .8 * height), 0, 1)
+
+    glEnableClientState(GL_VERTEX_ARRAY)
+    rim = (RADAR_RIM * RADAR_RADIUS + (cx, cy)).astype(np.float32)
+    glColor3f(0, .6, 0)
+    glVertexPointer(2, GL_FLOAT, 0, rim)
+    glDrawArrays(GL_LINE_LOOP, 0, len(rim))
+    glBegin(GL_LINES)
+    glVertex2f(cx - RADAR_RADIUS, cy); glVertex2f(cx + RADAR_RADIUS, cy)
+    glVertex2f(cx, cy - RADAR_RADIUS); glVertex2f(cx, cy + RADAR_RADIUS)
+    glEnd()
+
+    glPointSize(5)
+    glEnableClientState(GL_COLOR_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, pts)
+    glColorPointer(3, GL_FLOAT, 0, colors)
+    glDrawArrays(GL_POINTS, 0, len(pts))
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+    glPointSize(1)
+
+
 def draw_2d(func, *args, **kwargs):
     glMatrixMode(GL_PROJECTION)     # change matrix to projection
     glPushMatrix()                  # push projection matrix
@@ -295,140 +362,188 @@ def draw_2d(func, *args, **kwargs):
     glPopMatrix()                   # grab the previous one
 
 
-def main():
+def main(first_frame_exit=False, autopilot=AUTOPILOT, net=None, sim_thread=SIM_THREAD, seed=None,
+         debug_draw=DEBUG_DRAW, capture=CAPTURE):
     # Locals
     init_new_level = True
     level_counter = 0
 
     ship = None
-    planetd = None
+    planetd = None  # the planet to land on
+    scene = None    # everything in the level, planets carry their moons and belts
     asteroids = []
-    objs = []
+    variants = []   # asteroid mesh variants used this level
+    pilot = None    # landing autopilot while it is engaged
+    trajectory = None   # predicted path and what it runs into
+    particles = None    # exhaust and debris
+    lighting = None     # GLSL lighting program, fixed-function lighting while this is None
+    governor = None     # quality settings chasing FRAME_TARGET_MS
+    video = None        # frames read back and written out while capturing
+    radar_index = GridIndex()   # asteroid positions for the radar's nearest queries
+    recorder = None     # the last few seconds of the level, for rewinding and quick saves
+    race_events = 0     # what happened to the ship this tick, for the race server
+    rivals = {}         # other racers' ships by player
+    message = None      # (text, color) on screen until a key goes down, the game is held meanwhile
+    gravity = GRAVITY and net is None   # the race server flies without gravity
+    if seed is not None:    # the same run of levels every time
+        random.seed(seed)
+    if debug_draw:
+        debug.only(debug_draw)
+        debug.enabled = True
+
+    # a planet orbiting parent. A spinning pivot at the parent's centre carries it around.
+    def add_orbiter(parent, distance, radius, plane, rate):
+        pivot = scene.add(SceneNode(quat=tuple(plane), spin=((0, 1, 0), rate)), parent)
+        return scene.add(SceneNode(Planet(None, radius=radius), pos=(distance, 0, 0)), pivot)
 
     def initialize_level():
         global CURVIEW
-        nonlocal ship, planetd, asteroids, objs, level_counter, init_new_level
+        nonlocal ship, planetd, scene, asteroids, variants, level_counter, init_new_level, pilot, recorder
 
         # increease level_counter
         level_counter += 1
+        if net:     # every racer builds the same level from the race's seed
+            level_counter = net.level
+            random.seed(net.seed + level_counter)
+        level_rng = random.getstate()   # a quick save rebuilds the level from here
 
         CURVIEW = V_BACKRIGHT
-        # reset vars
-        asteroids = []
-
-        # deregister all objects if registered
-        # for obj in objs:
-        #     if obj.isstatic:
-        #         obj.obj.deregister()
-
-        objs = []
-
-        # Game generation tweaks
-        noise_max = 40
-        # planet
-        # Generate random radius and spherical coordinates for planet and then translate
-        # into cartesian coordinates
-        pradius = random.uniform(16,25)
-        # at least an extra 50 units each level
-        prho = random.uniform(200 + level_counter * 50, 200 + level_counter * 75)
-        ptheta = random.random() * 2 * np.pi
-        pphi = random.random() * np.pi
-        ppos = spherical_to_cartesian(prho,ptheta,pphi)
-
-        # planet landing plane point
-        # grab point inside sphere and then translate to cartesian coordinates. Point moves further out as
-        # level increases
-        # logistic values look good on Desmos
-        lrho = pradius * random.uniform(
-            logistic_approaches(level_counter,     minval=.45, maxval=.95, growth=.91, center=3.6),
-            logistic_approaches(level_counter + 1, minval=.45, maxval=.95, growth=.91, center=3.6)
-        )
-        ltheta = random.random() * 2 * np.pi
-        lphi = random.random() * np.pi
-        lplanepoint = spherical_to_cartesian(lrho,ltheta,lphi)
-
-        # print(lrho / pradius)
-        # print(ltheta * 180/np.pi)
-        # print(lphi * 180/np.pi)
-
-        # asteroids
-        # at least two more asteoroids each level
-        nasteroids = random.randrange(4 + level_counter*2, 6 + level_counter * 2)
-
-        ship = Spaceship(lose_cond=lose_condition)
-        if planetd:
-            planetd.deregister()
-        planetd = Planet(lplanepoint, pos=ppos, radius=pradius)
-
-        objs.append(ship)
-        objs.append(planetd)
-
-        for i in range(nasteroids):
-            # choose percentage along line and then create some random noise for each asteroid
-            # increase number of asteroids and noise as you go
-            percent = random.uniform(.1, .9)
-            noise = (
-                noise_max * random.uniform(-1,1), # noisex
-                noise_max * random.uniform(-1,1), # noisey
-                noise_max * random.uniform(-1,1)  # noisez
-            )
-            apos = map(lambda a: a*percent, ppos) # get position from percentage along vector to planet
-            apos = tuple(map(sum,zip(apos, noise))) # add noise
-            # random rotation in space
-            aaa = (random.uniform(-1,1),random.uniform(-1,1),random.uniform(-1,1),random.uniform(0,2*np.pi))
-            tmpa = Asteroid(pos=apos, aa=aaa)
-            asteroids.append(tmpa)
-            objs.append(tmpa)
 
+        # the planet, its moons and neighbours, belts and asteroids, further out and more of them every level
+        level = LevelGenerator(random.getrandbits(64), ASTEROID_VARIANTS, ASTEROID_SEED_POOL).generate(level_counter)
+
+        # asteroid shapes for this level, simpler ones drawn while the governor is short of time. Collisions
+        # always use the full meshes, so hits don't depend on the frame rate.
+        detail = ASTEROID_DETAIL
+        if governor:
+            Planet.TREE_SHARE = governor.quality.trees
+            detail = min(detail, governor.quality.detail)
+        variants = [(seed, detail) for seed in level.variant_seeds.tolist()]
+        hulls = [(seed, ASTEROID_DETAIL) for seed in level.variant_seeds.tolist()]
+
+        ship = Spaceship(lose_cond=race_restart if net else lose_condition)
+        if scene:   # give the old level's GL resources back, shared meshes stay
+            for obj in scene.objects():
+                obj.deregister()
+        pool.begin_level(level_counter)
+        for kind, handle, label, leak_level, why in pool.leaks():
+            print(f"GL leak: {kind} {handle} of {label}, {why}")
+        scene = SceneGraph()
+        scene.add(SceneNode(ship, free=True))  # the ship flies itself
+
+        planetd = Planet(tuple(level.landing_point.tolist()), radius=float(level.planet_radius))
+        target = scene.add(SceneNode(planetd, pos=tuple(level.planet_pos.tolist())))
+
+        orbiters = []   # parents come before their moons
+        for parent, distance, radius, plane, rate in level.orbiters.tolist():
+            orbiters.append(add_orbiter(orbiters[parent] if parent >= 0 else target, distance, radius, plane, rate))
+        belts = [scene.add(SceneNode(quat=tuple(plane), spin=((0, 1, 0), rate)), orbiters[parent])
+                 for parent, plane, rate in level.belts.tolist()]
+
+        # free asteroids drift, belt asteroids ride their belt's pivot
+        for pos, aa, vel, variant, belt in level.asteroids.tolist():
+            ast = Asteroid(pos=tuple(pos), aa=aa, variant=variants[variant] if variants else None,
+                           hull=hulls[variant] if hulls else None)
+            ast.vel = tuple(vel)
+            if belt < 0:
+                scene.add(SceneNode(ast, pos=tuple(pos), quat=ast.quat, drift=True))
+            else:
+                scene.add(SceneNode(ast, pos=tuple(pos), quat=ast.quat), belts[belt])
+
+        asteroids = scene.objects(Asteroid)
+        if pilot:   # plan the first block while the loading screen is still up
+            pilot.prime(ship, planetd, pilot_obstacles())
+        if not net:     # a race can't go back in time
+            recorder = Recorder(scene, ship, planetd, level_counter, level_rng, REWIND_SECONDS)
         init_new_level = False
 
     def lose_condition(dmgtxt=""):
-        nonlocal level_counter, init_new_level
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        draw_2d(draw_centered_text,f"Drats! {dmgtxt} Press any key to continue!", (255,0,0), 40)
-        pygame.display.flip()
-        wait()
+        nonlocal level_counter, init_new_level, message
+        message = (f"Drats! {dmgtxt} Press any key to continue!", (255,0,0))
         level_counter = 0
         init_new_level = True
 
+    # out of health in a race, back to the start with full health like the server does
+    def race_restart(dmgtxt=""):
+        ship.teleport(START)
+        ship.vel = (0,0,0)
+        ship.force = (0,0,0)
+        ship.rpy = [0,0,0]
+        ship.health = Spaceship.HEALTH
+
     def level_win_condition():
-        nonlocal level_counter, init_new_level
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        draw_2d(draw_centered_text,f"Great Job! Press any key to continue", (0,255,0), 40)
-        pygame.display.flip()
-        wait()
+        nonlocal init_new_level, message
+        message = (f"Great Job! Press any key to continue", (0,255,0))
         init_new_level = True
 
+    # start or stop the autopilot, it is only imported the first time it is engaged
+    def toggle_autopilot():
+        nonlocal pilot
+        if pilot:
+            pilot = None
+        else:
+            from utils.autopilot import Autopilot
+            pilot = Autopilot(PLAN_BUDGET_MS, dt=TIME_SCALE)
+            if planetd:     # engaged mid level, plan the first block now rather than inside a tick
+                pilot.prime(ship, planetd, pilot_obstacles())
+
+    # what the autopilot steers clear of: the asteroids and every planet but the target
+    def pilot_obstacles():
+        return asteroids + [p for p in scene.objects(Planet) if p is not planetd]
+
     def check_collisions():
-        nonlocal ship, planetd, asteroids
-
-        if ship.is_colliding(planetd): # if the ship is colliding with the planet...
-            s_vel = ship.getVelMag()
-            s_up = ship.getUpVec()
-            s_pos = ship.pos
-            is_good_landing, dmgtxt = planetd.is_good_landing(s_pos, s_vel, s_up)
-            if is_good_landing:
-                level_win_condition()
+        nonlocal ship, planetd, scene, asteroids, race_events
+
+        # Collisions are swept over the last step so fast ships can't tunnel through anything
+        for planet in scene.objects(Planet):
+            toi = ship.time_of_impact(planet)
+            if toi is None:
+                continue
+            # the ship touched a planet during the step...
+            if planet is planetd:
+                s_vel = ship.getVelMag()
+                s_up = ship.getUpVec()
+                s_pos = ship.contact_pos(toi)   # judge the landing where the ship actually touched down
+                is_good_landing, dmgtxt = planetd.is_good_landing(s_pos, s_vel, s_up)
+                if is_good_landing:
+                    if net:     # the server decides who got there first
+                        race_events |= EVENT_LANDED
+                    else:
+                        level_win_condition()
+                    return
+            else:
+                dmgtxt = "You flew into the wrong planet! "
+            if particles:
+                emit_impact(particles, ship.contact_pos(toi), size=CRASH_BURST)
+            ship.damage(dmgtxt)
+
+            if net:
+                race_events |= EVENT_CRASH
+                ship.teleport(START)
             else:
-                ship.damage(dmgtxt)
-
-                ship.pos = planetd.ejectpoint()
-                ship.vel = (0,0,0)
-                ship.force = (0,0,0)
-                ship.rpy = [0,0,0]
-
-        tmp_asteroids = [] # create temp asteroids list
-        while asteroids:
-            ast = asteroids.pop()   # get each asteroid
-            if ship.is_colliding(ast): # if the ship is colliding with an asteroid...
-                ship.damage("You hit an asteroid one too many times!")   # damage the ship and don't add the asteroid back
-            else:   # if the ship is not colliding...
-                tmp_asteroids.append(ast)   # add the asteroid back
-        while tmp_asteroids:    # add all of the asteroids back
-            asteroids.append(tmp_asteroids.pop())
-
-    def draw_hud():
-        nonlocal ship, planetd, level_counter
+                ship.teleport(planetd.ejectpoint())
+            ship.vel = (0,0,0)
+            ship.force = (0,0,0)
+            ship.rpy = [0,0,0]
+            if pilot:
+                pilot.reset()
+            break
+
+        tois = times_of_impact(ship, asteroids)  # one vectorized sweep against every asteroid
+        if np.isfinite(tois).any():
+            for ast, t in zip(asteroids, tois):
+                if np.isfinite(t):  # if the ship hit this asteroid...
+                    if particles:
+                        emit_impact(particles, ship.contact_pos(t), ast.step_delta())
+                    scene.remove(ast.node)  # take the asteroid out of the level
+                    ship.damage("You hit an asteroid one too many times!")   # damage the ship
+                    if net:
+                        race_events |= EVENT_HIT
+            asteroids = scene.objects(Asteroid)
+
+    def draw_hud(frame):
+        nonlocal level_counter, pilot, trajectory, net
+        ship = frame.ship
         val_scale = 10
         col_green = (0, 255, 0, 255)
         
@@ -459,7 +574,7 @@ def main():
         )
         ypr = f"Roll, Pitch, Yaw: ({ship.rpy[0]*val_scale:.2f}, {ship.rpy[1]*val_scale:.2f}, {ship.rpy[2]*val_scale:.2f})"
 
-        to_ship_vec = sub_vecs(planetd.pos, ship.pos)  # get the vector from the planet to the ship
+        to_ship_vec = sub_vecs(frame.target_pos, ship.pos)  # get the vector from the planet to the ship
         angle = np.arccos(dot_vecs(ship.getUpVec(), to_ship_vec) / (mag(ship.getUpVec()) * mag(to_ship_vec)))
 
         landing_angle = f"Landing Angle: {angle*180/np.pi:.2f}"
@@ -468,7 +583,7 @@ def main():
             255 * (angle <= Planet.LANDING_ANGLE_TOLERANCE),
             0
         )
-        dist_to_p = f"Distance to Planet: {mag(sub_vecs(ship.pos,planetd.pos))-planetd.radius:.2f}"
+        dist_to_p = f"Distance to Planet: {mag(sub_vecs(ship.pos,frame.target_pos))-frame.target.radius:.2f}"
         txtx = 10
         txty = 20
         draw_text((txtx, txty), health, health_color, 22);  txty += 20
@@ -486,6 +601,33 @@ def main():
         draw_text((txtx, txty), landing_angle, landing_color, 22);          txty += 20
         draw_text((txtx, txty), f"Level: {level_counter}", col_green, 22);  txty += 20
         draw_text((txtx, txty), dist_to_p, col_green, 22); txty += 20
+        if pilot:
+            draw_text((txtx, txty), f"Autopilot: {pilot.report()}", col_green, 22);  txty += 20
+        if frame.path is not None:
+            points, impact, impact_at = frame.path
+            if impact is None:
+                forecast, forecast_color = f"Path clear for {PREDICT_SECONDS} s", col_green
+            else:
+                seconds, obstacle, point, speed = impact
+                if obstacle is frame.target:
+                    soft = speed <= Planet.MAX_ACCEPTABLE_LANDING_VELOCITY
+                    forecast = f"Touchdown in {seconds:.2f} s at {speed * val_scale:.4f}"
+                    forecast_color = (255 * (not soft), 255 * soft, 0)
+                else:
+                    forecast = f"{type(obstacle).__name__} impact in {seconds:.2f} s"
+                    forecast_color = (255, 0, 0)
+            draw_text((txtx, txty), f"{forecast} ({trajectory.update_ms:.2f} ms)", forecast_color, 22);  txty += 20
+        if net:
+            race = f"Race: player {net.player + 1} of {net.players}"
+            if net.winner < net.players:
+                race += f", player {net.winner + 1} won the last level"
+            draw_text((txtx, txty), race, col_green, 22);   txty += 20
+            draw_text((txtx, txty), f"Net: {net.report()}", col_green, 22);  txty += 20
+        draw_text((txtx, txty), f"Timing: {timer.report()}", col_green, 22);  txty += 20
+        if governor:
+            draw_text((txtx, txty), f"Quality: {governor.report()}", col_green, 22);  txty += 20
+        if video:
+            draw_text((txtx, txty), f"Capture: {video.report()}", col_green, 22);  txty += 20
 
     pygame.init()
     display = (SCREEN_WIDTH, SCREEN_HEIGHT)
@@ -497,56 +639,185 @@ def main():
     glDepthFunc(GL_LESS)
     glEnable(GL_BLEND)
 
-    glMatrixMode(GL_PROJECTION)
-    gluPerspective(45, (display[0] / display[1]), 0.1, 500.0)
-
-    glMatrixMode(GL_MODELVIEW)
-
-    # pygame clock
-    clock = pygame.time.Clock()
-    x = 0
-    while True:
-        # init level if needed
-        if init_new_level:
-            initialize_level()
-
-        ## EVENT HANDLING ##
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                quit()
-            elif event.type in (pygame.KEYDOWN, pygame.KEYUP):
-                env = {
-                    "ship": ship
-                }
-                # print(event)
-                if event.type == pygame.KEYDOWN and event.key == 118: # V
-                    # glMatrixMode(GL_MODELVIEW)
-                    # glLoadIdentity()
-                    # gluLookAt(0, 0, -10, *ship.pos, 0, 1, 0)
-                    # print(glGetDoublev(GL_MODELVIEW_MATRIX))
-                    initialize_level()
-
-                handleKeyEvent(env, event)
-
-        ## RENDERING ##
+    set_projection(*display)
+
+    # input
+    keymap = InputMap.load(U_KEYS, KEYMAP_FILE)
+    key_dispatch = keymap.dispatch
+    input_state = InputState()
+
+    # n-body solver, rebuilt every tick
+    if gravity:
+        from utils.gravity import BarnesHut, apply_gravity, body_mass  # only loaded when gravity is on
+        gravity_solver = BarnesHut(theta=BH_THETA) if BH_THETA is not None else None
+
+    # first frame is a loading screen, the level's meshes load after it is up
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    draw_2d(draw_centered_text, "Loading...", (0, 255, 0), 40)
+    pygame.display.flip()
+    if first_frame_exit:    # --measure-startup child
+        print(f"FIRST_FRAME_MS {1000 * (time.perf_counter() - START_TIME):.1f}")
+        pygame.quit()
+        return
+
+    if autopilot:
+        toggle_autopilot()
+    if PREDICT_SECONDS:
+        from utils.trajectory import Trajectory
+        trajectory = Trajectory(PREDICT_SECONDS, TIME_SCALE)
+    if PARTICLES:
+        from utils.particles import ParticleSystem, emit_thruster, emit_impact
+        particles = ParticleSystem()
+    if SHADERS:
+        from utils.shaders import LightingProgram, SUN, ship_spotlight
+        lighting = LightingProgram.create()
+    if GOVERNOR:
+        from utils.governor import Governor
+        governor = Governor(*display, FRAME_TARGET_MS)
+    if capture:
+        from utils.capture import FrameCapture
+        video = FrameCapture.create(capture, *display, fps=CAPTURE_FPS, drop=CAPTURE_DROP)
+    if net:     # everyone starts together
+        from utils.flight import FlightState
+        from utils.net import START, EVENT_HIT, EVENT_CRASH, EVENT_LANDED
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-        # consider looping through objs and rendering in two lines
-        ship.point_arrow_at(planetd.pos)
-
-        ship.render() # render ship
-        planetd.render()    # render planet
-        for asteroid in asteroids:  # render asteroids
-            asteroid.render()
-
-        # Draw Axes
-        # draw_vec((1,0,0),add_vecs(ship.pos,(3,3,3)),col=(1,0,0))
-        # draw_vec((0,1,0),add_vecs(ship.pos,(3,3,3)),col=(0,1,0))
-        # draw_vec((0,0,1),add_vecs(ship.pos,(3,3,3)),col=(0,0,1))
+        draw_2d(draw_centered_text, f"Waiting for {net.players} players...", (0, 255, 0), 40)
+        pygame.display.flip()
+        while not net.started:
+            pygame.event.pump()
+            net.poll()
+            time.sleep(.01)
+
+    # One tick of everything but drawing: the race connection, input, flight, the scene, collisions.
+    # Runs on the simulation thread when there is one. False while the game is held for a message or a new level.
+    def simulate():
+        nonlocal asteroids, race_events
+
+        if net:
+            net.poll()
+        if init_new_level or message or (net and net.level != level_counter):
+            return False
+        if net:
+            corrected = net.reconcile()
+            if corrected is not None:   # the server saw our ship differently, take its word for it
+                corrected.to_ship(ship)
+        race_events = 0
+
+        # this tick's input snapshot, the window thread adds key events to it
+        with input_lock:
+            held, pressed, active = input_state.held, input_state.pressed, input_state.active
+            input_state.begin_tick()
+
+        if recorder and pressed & Input.QUICKSAVE:
+            recorder.save(SAVE_FILE)
+        if pressed & Input.AUTOPILOT:
+            toggle_autopilot()
+
+        planets = scene.objects(Planet)
+        # holding rewind steps back through the recorded ticks instead of simulating
+        rewinding = bool(recorder and held & Input.REWIND) and recorder.rewind(REWIND_SPEED)
+        if rewinding:
+            asteroids = scene.objects(Asteroid)     # the ones hit since are back
+            flight_bits = 0
+            if pilot:
+                pilot.reset()
+        elif pilot:
+            flight_bits = pilot.tick(ship, planetd, pilot_obstacles())
+        else:
+            flight_bits = active
+        ship.apply_input(flight_bits)
+
+        ## SIMULATION ##
+        if not rewinding:
+            if gravity:
+                # belt asteroids are carried by their pivots, only free ones fall
+                free_asteroids = [a for a in asteroids if a.node.drift]
+                apply_gravity(ship, free_asteroids, scene.objects(Planet), TIME_SCALE, MUTUAL_GRAVITY, gravity_solver)
+            ship.update(TIME_SCALE)
+            scene.update(TIME_SCALE)    # move what moves, recompute only those subtrees
+        if particles:
+            emit_thruster(particles, ship)
+            particles.update(TIME_SCALE)
+
+        if trajectory:
+            # the path the ship takes if it keeps flying these inputs
+            attractors = ([p.pos for p in planets], [body_mass(p.radius) for p in planets]) if gravity else None
+            trajectory.update(ship, flight_bits, asteroids + planets, attractors)
 
         ## COLLISION AND GAME LOGIC ##
-        check_collisions()
+        if not rewinding:
+            check_collisions()
+            if recorder:
+                recorder.record()
+        if net:     # this tick's inputs and what came of them
+            net.send(flight_bits | race_events, FlightState.from_ship(ship))
+        return True
+
+    # copy what the renderer needs out of this tick
+    def capture_frame(frame):
+        frame.set_objects(scene.objects())
+        frame.target = planetd
+        frame.target_pos = tuple(planetd.node.world.pos)    # target's cached world position
+        frame.ship = ShipView(ship, frame.target_pos)
+        frame.asteroid_pos = np.array([a.pos for a in asteroids], dtype=float).reshape(-1, 3)
+        if debug.enabled:
+            frame.asteroid_vel = np.array([a.vel for a in asteroids], dtype=float).reshape(-1, 3)
+        frame.path = trajectory.freeze() if trajectory else None
+        frame.message = message
+
+    # Axes, collision spheres and velocities of everything in the frame, and the target's landing circle.
+    # Velocities are drawn 60 ticks long.
+    def draw_debug(frame):
+        pos = frame.matrices[:, 3, :3]
+        debug.axes(pos, frame.matrices[:, :3, :3].transpose(0, 2, 1), 3.0)
+        debug.spheres(pos, [o.colr for o in frame.objects])
+        if len(frame.asteroid_vel) == len(frame.asteroid_pos):
+            debug.vectors(frame.asteroid_pos, frame.asteroid_vel, (1, .5, 0), 60)
+        debug.vectors(frame.ship.pos, frame.ship.vel, (0, 1, 1), 60)
+
+        target = frame.target
+        center = np.asarray(frame.target_pos)
+        point = np.asarray(target.landingplanept)
+        rim = np.sqrt(max(target.radius ** 2 - point @ point, 0))     # where the landing plane cuts the planet
+        debug.circles(center + point, point, rim)
+        debug.marker(center, f"target {np.linalg.norm(center - frame.ship.pos) - target.radius:.0f}", (0, 255, 0))
+
+    # draw a tick: the world as it was left, the camera for the next frame, then the HUD and radar.
+    # Everything the simulation moves is read from the frame. Particles are drawn as they are, they don't
+    # affect anything.
+    def render(frame):
+        if governor:    # the scene may go to a smaller framebuffer
+            governor.begin_scene()
+            visible = governor.visible(frame.objects, frame.matrices, frame.ship.pos)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        if lighting:    # the sun and every ship's spotlight
+            lighting.begin([SUN, ship_spotlight(frame.ship)] + [ship_spotlight(r) for r in rivals.values()])
+        for i, (obj, mat) in enumerate(zip(frame.objects, frame.matrices)):  # ship, planets, moons and asteroids
+            if isinstance(obj, Spaceship):      # thrusters and arrow as of this frame too
+                obj.render(mat, frame.ship)
+            elif not governor or visible[i] or obj is frame.target:    # the target is never culled
+                obj.render(mat)
+        if net:
+            for player, pos, orient in net.rivals():
+                if player not in rivals:
+                    rivals[player] = Spaceship()
+                rival = rivals[player]
+                rival.pos = tuple(pos)
+                rival.orient = tuple(orient)
+                rival.point_arrow_at(frame.target_pos)
+                rival.render()
+        if lighting:
+            lighting.end()
+        if frame.path is not None:
+            trajectory.draw(frame.target, Planet.MAX_ACCEPTABLE_LANDING_VELOCITY, frame.path)
+        if debug.enabled:
+            draw_debug(frame)
+            debug.flush()   # one draw for all of it
+        if particles:
+            particles.draw()    # after everything solid, it doesn't write depth
+        if governor:
+            governor.end_scene()
 
         ## LIGHTING ##
         calc_ambient()
@@ -554,17 +825,215 @@ def main():
         ## VIEW ##
         glLoadIdentity() # load identity to recalculate glu_lookat
 
-        env = {
-            "ship": ship
-        }
-        calc_view(env)
+        calc_view(frame.ship)
 
         ## HUD ##
-        draw_2d(draw_hud)
+        if governor:    # redrawn every few frames when short of time
+            draw_2d(governor.draw_hud, draw_hud, frame)
+        else:
+            draw_2d(draw_hud, frame)
+        radar_index.refit(frame.asteroid_pos)  # cheap while asteroids stay in their cells
+        draw_2d(draw_radar, frame.ship, frame.target_pos, radar_index, frame.asteroid_pos)
+        if frame.message:
+            draw_2d(draw_centered_text, *frame.message, 40)
+
+    # the window was resized, the HUD and radar are laid out from SCREEN_WIDTH and SCREEN_HEIGHT
+    def resize(width, height):
+        global SCREEN_WIDTH, SCREEN_HEIGHT
+        SCREEN_WIDTH, SCREEN_HEIGHT = width, height
+        set_projection(width, height)
+        if governor:
+            governor.resize(width, height)
+        if video:
+            video.resize(width, height)
+
+    input_lock = threading.Lock()   # input_state is shared with the simulation thread
+    sim = SimThread(simulate, capture_frame).start() if sim_thread else None
+    timer = sim.timer if sim else TickTimer()
+    frame = Frame()     # the only frame when ticking inline
+    shown = None        # last frame drawn
+    shown_tick = -1
 
+    # pygame clock
+    clock = pygame.time.Clock()
+    while True:
+        ## EVENT HANDLING ##
+        pressed = 0     # actions that went down since the last frame, for the ones handled here
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                if sim:
+                    sim.stop()
+                print(f"{'simulation thread' if sim else 'inline'}: {timer.report()}")
+                if governor:
+                    print("\n".join([governor.report()] + governor.log()))
+                if video:   # whatever is still being read back gets written first
+                    video.close()
+                    print(f"Capture: {video.report()}")
+                print("\n".join(pool.report()))
+                pygame.quit()
+                quit()
+            elif event.type == pygame.KEYDOWN:
+                if message:     # any key carries on
+                    message = None
+                    continue
+                bit = key_dispatch.get(event.key, 0)
+                pressed |= bit
+                with input_lock:
+                    input_state.press(bit)
+            elif event.type == pygame.KEYUP:
+                with input_lock:
+                    input_state.release(key_dispatch.get(event.key, 0))
+            elif event.type == pygame.VIDEORESIZE:
+                resize(*event.size)
+
+        # init level if needed. Levels load meshes so they are built here, with the simulation held.
+        new_level = (init_new_level or (net and net.level != level_counter)) and not message
+        new_level = new_level or bool(pressed & Input.NEW_LEVEL and not net)
+        load = bool(recorder and pressed & Input.QUICKLOAD) and os.path.exists(SAVE_FILE)
+        if new_level or load:
+            if sim:
+                sim.pause()
+            if load:
+                saved = read_save(SAVE_FILE)
+                random.setstate(rng_state(saved['level_rng']))     # build the saved level again
+                level_counter = int(saved['level']) - 1
+            initialize_level()
+            if load:
+                recorder.load(saved)
+            if sim:
+                sim.resume()
+            if governor:    # loading isn't a slow frame
+                governor.skip()
+
+        handle_view_input(pressed, shown.ship if shown else ship)
+        if pressed & Input.DEBUG_DRAW:
+            debug.toggle()
+
+        if sim:
+            latest = sim.acquire()
+            if latest is None:  # the simulation hasn't finished a tick since the last frame
+                time.sleep(.001)
+                continue
+        else:
+            timer.tick()
+            if simulate():
+                capture_frame(frame)
+                frame.stamp(frame.tick + 1)
+            latest = frame
+
+        render(latest)
+        if video:   # the back buffer, before the flip leaves it undefined
+            video.grab()
         pygame.display.flip()   # flip buffers
-        clock.tick()    # tick the clock
+        if latest.tick != shown_tick:
+            timer.shown(latest.published)
+            shown, shown_tick = latest, latest.tick
+        if governor:
+            governor.frame_done()
+        if not sim:
+            clock.tick(net.rate if net else 0)    # tick the clock, races run at the server's tick rate
+
+
+# Run the game with -X importtime until its first frame and report where the startup time goes.
+# The fastest of STARTUP_RUNS runs is compared with the baseline in STARTUP_BASELINE_FILE, which is
+# written by the first run on a machine or by --record-baseline. Returns non-zero on a regression.
+def measure_startup(top=15, record=False):
+    import json
+    import subprocess
+
+    best = None
+    for run in range(STARTUP_RUNS):
+        t = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", sys.argv[0], "--first-frame-exit"],
+            capture_output=True, text=True
+        )
+        wall_ms = 1000 * (time.perf_counter() - t)
+        if proc.returncode:
+            print(proc.stderr)
+            return proc.returncode
+        first_frame_ms = float(proc.stdout.split("FIRST_FRAME_MS")[1].split()[0])
+        if best is None or first_frame_ms < best[0]:
+            best = (first_frame_ms, wall_ms, proc.stderr)
+    first_frame_ms, wall_ms, stderr = best
+
+    # import time: self [us] | cumulative | imported package
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            self_us, cum_us, name = line[len("import time:"):].split("|")
+            if not name[1:].startswith(" "):    # top level imports only, nested ones are indented
+                imports.append((int(cum_us), int(self_us), name.strip()))
+    imports.sort(reverse=True)
+    import_ms = sum(i[0] for i in imports) / 1000
+
+    print(f"{'module':<36}{'cumulative (ms)':>16}{'self (ms)':>12}")
+    for cum_us, self_us, name in imports[:top]:
+        print(f"{name:<36}{cum_us / 1000:>16.1f}{self_us / 1000:>12.1f}")
+    print(f"\nfastest of {STARTUP_RUNS} runs")
+    print(f"imports: {import_ms:.1f} ms")
+    print(f"first frame (in process): {first_frame_ms:.1f} ms")
+    print(f"first frame (wall, incl. interpreter start): {wall_ms:.1f} ms")
+
+    if record or not os.path.exists(STARTUP_BASELINE_FILE):
+        with open(STARTUP_BASELINE_FILE, "w") as f:
+            json.dump({"first_frame_ms": first_frame_ms, "import_ms": import_ms,
+                       "imports": {name: cum_us for cum_us, self_us, name in imports}}, f, indent=1)
+        print(f"baseline recorded in {STARTUP_BASELINE_FILE}")
+        return 0
+
+    with open(STARTUP_BASELINE_FILE) as f:
+        baseline = json.load(f)
+    print(f"baseline: first frame {baseline['first_frame_ms']:.1f} ms, imports {baseline['import_ms']:.1f} ms")
+    new = [name for cum_us, self_us, name in imports if name not in baseline["imports"]]
+    if new:
+        print("imported since the baseline: " + ", ".join(new))
+    if first_frame_ms > baseline["first_frame_ms"] * (1 + STARTUP_TOLERANCE):
+        print(f"REGRESSION: first frame {first_frame_ms:.1f} ms is more than {100 * STARTUP_TOLERANCE:.0f}% over "
+              f"the {baseline['first_frame_ms']:.1f} ms baseline")
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Interplanetary Space Jaunt")
+    parser.add_argument("--measure-startup", action="store_true",
+                        help="report per-module import cost and time to the first frame against the recorded "
+                             "baseline, then exit")
+    parser.add_argument("--record-baseline", action="store_true",
+                        help="with --measure-startup, record this run as the new startup baseline")
+    parser.add_argument("--autopilot", action="store_true", help="let the landing autopilot fly (P toggles it)")
+    parser.add_argument("--host", type=int, metavar="PLAYERS", help="host a race for this many players and join it")
+    parser.add_argument("--join", metavar="HOST[:PORT]", help="join a race")
+    parser.add_argument("--port", type=int, help="race port")
+    parser.add_argument("--sim-thread", action="store_true",
+                        help="simulate on a worker thread, the window draws the newest tick")
+    parser.add_argument("--debug-draw", nargs="?", const="all", metavar="CATEGORIES",
+                        help="show debug geometry, all of it or a comma separated list of "
+                             "vectors, axes, colliders, boxes, landing and markers (G toggles it)")
+    parser.add_argument("--seed", type=int, help="seed for the run of levels, random by default")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="record the window to a directory of PNG frames, a .rgba file of raw frames "
+                             "or a video file encoded by ffmpeg")
+    parser.add_argument("--first-frame-exit", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_startup:
+        sys.exit(measure_startup(record=args.record_baseline))
+    net = None
+    if args.host or args.join:
+        from utils.net import Server, Client, HOST, PORT
+        port = args.port or PORT
+        if args.host:
+            Server(args.host, port=port, dt=TIME_SCALE).start()
+            net = Client(HOST, port, dt=TIME_SCALE)
+        else:
+            host, _, join_port = args.join.partition(":")
+            net = Client(host, int(join_port) if join_port else port, dt=TIME_SCALE)
+    main(first_frame_exit=args.first_frame_exit, autopilot=args.autopilot or AUTOPILOT, net=net,
+         sim_thread=args.sim_thread or SIM_THREAD, seed=args.seed,
+         debug_draw=DEBUG_DRAW if args.debug_draw is None else
+         CATEGORIES if args.debug_draw == "all" else args.debug_draw.split(","),
+         capture=args.capture or CAPTURE)
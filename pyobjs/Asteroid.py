@@ -4,7 +4,6 @@ Author: Jay Kmetz
 """
 
 # PYTHON IMPORTS
-import numpy as np
 import random as random
 from OpenGL.GL import *
 
@@ -16,27 +15,42 @@ from pyobjs.ColObj import *
 
 
 # GLOBALS
-display_cache = None
+display_cache = {}  # variant -> DisplayObj, None is the stock asteroid.obj
+hull_cache = {}     # variant -> DisplayObj only collided with, never drawn
 
 
 class Asteroid(ColObj):
     ASTEROID_VEL = .03
 
-    def __init__(self, pos=(0, 0, 0), aa=(1, 0, 0, 0)):
-        global display_cache
+    # variant is None for the stock mesh or (seed, detail) for a procedurally generated one. hull is the
+    # variant collisions are tested against, the drawn one by default. A lower detail can be drawn while
+    # hits still come from the full mesh.
+    def __init__(self, pos=(0, 0, 0), aa=(1, 0, 0, 0), variant=None, hull=None):
         super().__init__(pos, True)
 
         self.quat = axisangle_to_q(aa[0:3], aa[3]) # create rotation from axis angle
-        if not display_cache:
-            self.obj = DisplayObj()                     # Initialize display obj
-            self.obj.objFileImport("./wfobjs/asteroid") # Use asteroid
-            display_cache = self.obj                    # cache it
+        if variant not in display_cache:
+            if variant is None:
+                obj = DisplayObj()                      # Initialize display obj
+                obj.objFileImport("./wfobjs/asteroid")  # Use asteroid
+            else:
+                from utils.meshgen import asteroid_variant
+                obj = asteroid_variant(*variant)        # generated, or read back from the disk cache
+            obj.cached = True                           # every asteroid of this variant shares it
             if self.isstatic:                           # if this is a static object...
-                self.obj.register()                     # register it into a call list
-        else:
-            self.obj = display_cache
-
-        self.colr = 2 * self.obj.maxr / 3   # 2/3rds the max sphere that bounds it
+                obj.register()                          # register it into a call list
+            display_cache[variant] = obj                # cache it
+        self.obj = display_cache[variant]
+
+        hull_obj = self.obj
+        if hull is not None and hull != variant:
+            if hull not in hull_cache:
+                from utils.meshgen import asteroid_variant
+                hull_cache[hull] = display_cache[hull] if hull in display_cache else asteroid_variant(*hull)
+            hull_obj = hull_cache[hull]
+
+        self.colr = 2 * hull_obj.maxr / 3   # 2/3rds the max sphere that bounds it
+        self.tree = hull_obj.sphere_tree    # built once per mesh, shared through the caches
         # choose random velocity vector and scale it by asteroid velocity
         self.vel = tuple(
             map(
@@ -45,16 +59,20 @@ class Asteroid(ColObj):
             )
         )
 
-    def render(self):
-        # glMatrixMode(GL_MODELVIEW)
-        glPushMatrix()
+    # orientation lives in the transform so the model matrix is only rebuilt when it changes
+    @property
+    def quat(self):
+        return self.transform.quat
 
-        v, a = q_to_axisangle(self.quat)    # grab openGL happy rotation
+    @quat.setter
+    def quat(self, quat):
+        self.transform.quat = quat
 
-        self.pos = add_vecs(self.pos,self.vel)  # move position by velocity vector
+    def render(self, mat=None):
+        # glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
 
-        glTranslatef(*self.pos)     # translate
-        glRotatef(a*180/np.pi, *v)  # rotate
+        self.transform.apply(mat)   # translate and rotate with the cached model matrix
 
         self.obj.drawObj()      # draw object
 
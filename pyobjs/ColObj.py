@@ -2,22 +2,121 @@
 File: ColObj.py
 Author: Jay Kmetz
 """
+import numpy as np
 from OpenGL.GL import *
 
-from utils.util import is_colliding
+from utils.util import is_colliding, sweep_spheres, sub_vecs, add_vecs, scalar_mult
+from utils.quat import q_to_mat4
+from utils.Transform import Transform
+
+
+# GLOBALS
+NARROW_STEP = .25   # most the relative position moves between mesh tests while sweeping a step
+NARROW_BATCH = 8    # of those tests walked down the trees together
 
 
 # Common object... refactor later
 class ColObj:
     def __init__(self, pos, static=False):
         self.colr = 0
-        self.pos = pos
+        self.tree = None        # sphere tree of the mesh, objects that have one collide mesh against mesh
+        self.transform = Transform(pos)     # position and orientation, caches the model matrix
+        self.prev_pos = pos     # position at the start of the current step
         self.isstatic = static
         self.obj = None
+        self.node = None        # scene graph node, set when added to a scene
+
+    @property
+    def pos(self):
+        return self.transform.pos
+
+    @pos.setter
+    def pos(self, pos):
+        self.transform.pos = pos
+
+    # radius of the sphere round the whole mesh, the broad phase for objects with a tree
+    @property
+    def boundr(self):
+        return self.obj.maxr
 
     def is_colliding(self, other):
         return is_colliding(self.pos, self.colr, other.pos, other.colr)
 
+    # how far this object moved over the last step
+    def step_delta(self):
+        return sub_vecs(self.prev_pos, self.pos)
+
+    # fraction of the last step at which this object first touched other, None if it never did
+    def time_of_impact(self, other):
+        toi = sweep_spheres(self.prev_pos, self.step_delta(), self.colr,
+                            other.prev_pos, other.step_delta(), other.colr)[0]
+        return None if toi == float("inf") else toi
+
+    # position of this object a fraction t of the way through the last step
+    def contact_pos(self, t):
+        return add_vecs(self.prev_pos, scalar_mult(t, self.step_delta()))
+
+    # place the object without sweeping through the space in between
+    def teleport(self, pos):
+        self.pos = pos
+        self.prev_pos = pos
+
     def deregister(self):
-        if self.isstatic:           # if the object is static...
-            self.obj.deregister()   # deregister it
+        if self.isstatic and not self.obj.cached:   # if the object is static and its mesh isn't shared...
+            self.obj.deregister()                   # deregister it
+
+
+# First fraction of the last step from t0 on at which a's and b's meshes touch, inf if they don't.
+# b is placed in a's frame with both orientations as they are at the end of the step, and the step is
+# sampled finely enough that their relative position moves at most NARROW_STEP between tests. Only the part
+# of the step where the trees' root spheres overlap is sampled, outside it the meshes can't touch, and the
+# samples go through the trees NARROW_BATCH at a time.
+def narrow_time_of_impact(a, b, t0=0.0):
+    ra = q_to_mat4(a.transform.quat)[:3, :3].astype(float)
+    rb = q_to_mat4(b.transform.quat)[:3, :3].astype(float)
+    rot = ra.T @ rb
+    rel0 = ra.T @ np.subtract(b.prev_pos, a.prev_pos)
+    drel = ra.T @ np.subtract(b.step_delta(), a.step_delta())
+    if not len(a.tree) or not len(b.tree):
+        return np.inf
+
+    # |gap + t * drel| <= reach between the root spheres, an interval of t as the motion is a straight line
+    gap = rel0 + rot @ b.tree.center[0] - a.tree.center[0]
+    reach = a.tree.radius[0] + b.tree.radius[0]
+    qa, qb, qc = drel @ drel, 2 * gap @ drel, gap @ gap - reach * reach
+    if qa > 0:
+        disc = qb * qb - 4 * qa * qc
+        if disc < 0:
+            return np.inf
+        t_in, t_out = (-qb - np.sqrt(disc)) / (2 * qa), (-qb + np.sqrt(disc)) / (2 * qa)
+    elif qc <= 0:
+        t_in, t_out = t0, 1.0
+    else:
+        return np.inf
+    t_in, t_out = max(t0, t_in), min(1.0, t_out)
+    if t_in > t_out:
+        return np.inf
+
+    n = max(1, int(np.ceil(np.sqrt(qa) * (t_out - t_in) / NARROW_STEP)))
+    ts = np.linspace(t_in, t_out, n + 1)
+    for i in range(0, len(ts), NARROW_BATCH):
+        first = a.tree.first_overlap(b.tree, rot, rel0 + ts[i:i + NARROW_BATCH, None] * drel)
+        if first >= 0:
+            return float(ts[i + first])
+    return np.inf
+
+
+# Sweep obj against every object in others in one go.
+# Returns an array of impact fractions parallel with others, inf where there is no contact.
+# Pairs that both have sphere trees are swept with their bounding spheres and then tested mesh against mesh.
+def times_of_impact(obj, others):
+    if not others:
+        return np.empty(0)
+    ps = [o.prev_pos for o in others]
+    ds = [o.step_delta() for o in others]
+    exact = np.array([obj.tree is not None and o.tree is not None for o in others])
+    rs = [obj.boundr + o.boundr if e else obj.colr + o.colr for o, e in zip(others, exact)]
+    tois = sweep_spheres(obj.prev_pos, obj.step_delta(), 0, ps, ds, rs)
+    for i in np.flatnonzero(exact & np.isfinite(tois)):
+        tois[i] = narrow_time_of_impact(obj, others[i], tois[i])
+    return tois
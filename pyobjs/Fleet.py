@@ -0,0 +1,256 @@
+"""
+File: Fleet.py
+Author: Jay Kmetz
+"""
+
+# PYTHON IMPORTS
+import numpy as np
+
+# LOCAL IMPORTS
+from pyobjs.Spaceship import Spaceship
+from utils import flight
+from utils.flight import FlightState, ROT_STEADY, ROT_RESET, THRUST_OPP
+from utils.util import KP_UP
+
+
+# Many ships' flight state in arrays, one row a ship, for wingmen, ghost replays and batch training.
+# It has Spaceship's methods, each working on every ship at once or on the rows picked by ships, with the
+# same arithmetic in the same order. A row of a fleet flies exactly like a Spaceship given the same input.
+# Actions are flight controls: rot[:, mode] and thrusting hold what Spaceship keeps in actions and thrusting.
+class Fleet:
+    def __init__(self, n=1, pos=(0, 0, 0), orient=(0, 1, 0, 0), lose_cond=None):
+        self.state = FlightState(n)
+        self.state.pos[:] = pos
+        self.state.orient[:] = orient
+        self.prev_pos = self.state.pos.copy()   # positions at the start of the current step
+        self.rot = np.zeros((n, 3), dtype=np.int8)      # ROT_STEADY, Spaceship.LEFT / RIGHT or ROT_RESET
+        self.thrusting = np.zeros(n, dtype=np.int8)     # 0, Spaceship.THF / THB or THRUST_OPP
+
+        # lose condition function, called with the ships that lost their last health point
+        self.lose_cond_func = lose_cond
+
+    def __len__(self):
+        return len(self.state)
+
+    @property
+    def pos(self):
+        return self.state.pos
+
+    @property
+    def vel(self):
+        return self.state.vel
+
+    @property
+    def force(self):
+        return self.state.force
+
+    @property
+    def orient(self):
+        return self.state.orient
+
+    @property
+    def rpy(self):
+        return self.state.rpy
+
+    @property
+    def fuel(self):
+        return self.state.fuel
+
+    @property
+    def health(self):
+        return self.state.health
+
+    # a fleet flying these ships from where they are, with the controls they have
+    @staticmethod
+    def from_ships(ships, lose_cond=None):
+        fleet = Fleet(len(ships), lose_cond=lose_cond)
+        for i, ship in enumerate(ships):
+            for name in ("pos", "vel", "force", "orient", "rpy", "fuel", "health"):
+                getattr(fleet.state, name)[i] = getattr(ship, name)
+            fleet.prev_pos[i] = ship.prev_pos
+            for mode, action in enumerate(ship.actions):
+                if action[0] == Spaceship.ROTSET:
+                    fleet.rot[i, mode] = action[1][1]
+                elif action[0] == Spaceship.ROTRESET:
+                    fleet.rot[i, mode] = ROT_RESET
+            fleet.thrusting[i] = ship.thrusting
+        return fleet
+
+    # put row i back into a ship, controls included
+    def to_ship(self, ship, i=0):
+        self.state.to_ship(ship, i)
+        ship.prev_pos = tuple(self.prev_pos[i])
+        for mode, r in enumerate(self.rot[i].tolist()):
+            if r == ROT_RESET:
+                ship.resetRot(mode)
+            elif r:
+                ship.setRot(mode, r)
+            else:
+                ship.setRot(mode, up=KP_UP)
+        ship.thrusting = int(self.thrusting[i])
+
+    # Set rotation based on roll, pitch, yaw, and direction
+    def setRot(self, mode, d=Spaceship.RIGHT, up=0, ships=slice(None)):
+        self.rot[ships, mode] = ROT_STEADY if up == KP_UP else d
+
+    # bleed off rotation roll pitch yaw based on mode and up
+    def resetRot(self, mode, up=0, ships=slice(None)):
+        self.rot[ships, mode] = ROT_STEADY if up == KP_UP else ROT_RESET
+
+    # set positional acceleration
+    def setThrust(self, mode=Spaceship.THF, up=0, ships=slice(None)):
+        if up == KP_UP:
+            self.state.force[ships] = 0
+            self.thrusting[ships] = 0
+        else:
+            self.thrusting[ships] = mode
+
+    # apply force opposite to current velocity
+    def applyOppThrust(self, up=0, ships=slice(None)):
+        self.setThrust(THRUST_OPP, up, ships)
+
+    # Set every ship's controls from its bitset of held actions, one bitset for all of them or one each
+    def apply_input(self, bits):
+        self.rot[:], self.thrusting[:] = flight.bits_to_controls(bits)
+        self.state.force[self.thrusting == 0] = 0   # letting go of thrust clears the force, like Spaceship
+
+    # apply velocity to position, dt multiplies the positional step
+    def applyVel(self, dt=1.0):
+        self.prev_pos[:] = self.state.pos
+        flight.apply_vel(self.state, dt)
+
+    # adjust rotational and positional acceleration based on current controls, over dt ticks
+    def adjust(self, dt=1.0):
+        flight.adjust(self.state, self.rot, self.thrusting, dt)
+
+    # turn every ship by dt ticks of its roll, pitch and yaw rates
+    def rotate(self, dt=1.0):
+        flight.rotate(self.state, dt)
+
+    # add dt ticks of force to velocity
+    def applyThrust(self, dt=1.0):
+        flight.apply_thrust(self.state, dt)
+
+    # burn dt ticks of fuel for thrusting, ships that run out are damaged and refuelled. Returns which ran out.
+    def calc_fuel_loss(self, dt=1.0):
+        empty = flight.burn_fuel(self.state, self.thrusting, dt)
+        self._check_lost(empty, "You ran out of fuel!")
+        return empty
+
+    # Take a health point from the ships picked. Returns which ships are still alive.
+    def damage(self, ships, dmgtxt=""):
+        hit = np.zeros(len(self), dtype=bool)
+        hit[ships] = True
+        self.state.health -= hit
+        return self._check_lost(hit, dmgtxt)
+
+    def _check_lost(self, hit, dmgtxt):
+        alive = self.state.health > 0
+        lost = hit & ~alive
+        if self.lose_cond_func and lost.any():
+            self.lose_cond_func(ships=np.flatnonzero(lost), dmgtxt=dmgtxt)
+        return alive
+
+    # Spaceship.update for every ship. The phases run fused, compiled when utils.kernels can.
+    def update(self, dt=1.0):
+        self.prev_pos[:] = self.state.pos
+        empty = flight.step(self.state, self.rot, self.thrusting, dt)
+        self._check_lost(empty, "You ran out of fuel!")
+        return empty
+
+    def getHeading(self):
+        return flight.headings(self.state.orient)
+
+    def getUpVec(self):
+        return flight.up_vectors(self.state.orient)
+
+    # get velocity magnitudes
+    def getVelMag(self):
+        return np.linalg.norm(self.state.vel, axis=1)
+
+
+# A fleet flown against the same ships flown one Spaceship at a time on random held inputs, then ship-ticks a
+# second for both: python -m pyobjs.Fleet [ships] [ticks]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from pyobjs.ColObj import ColObj
+    from utils import kernels
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    rng = np.random.default_rng(0)
+
+    # just the flight model, no meshes or GL
+    def bare_ship(pos, vel, orient, rpy):
+        ship = Spaceship.__new__(Spaceship)
+        ColObj.__init__(ship, pos, True)
+        ship.orient, ship.rpy, ship.vel, ship.force = orient, rpy, vel, (0, 0, 0)
+        ship.actions = [Spaceship.STEADY] * 3
+        ship.thrusting = 0
+        ship.health, ship.fuel = Spaceship.HEALTH, Spaceship.FUEL
+        ship.lose_cond_func = None
+        return ship
+
+    orient = rng.normal(size=(n, 4))
+    orient /= np.linalg.norm(orient, axis=1, keepdims=True)
+    start = [(tuple(p), tuple(v), tuple(q), list(r)) for p, v, q, r in
+             zip(rng.uniform(-100, 100, (n, 3)).tolist(), rng.normal(scale=.2, size=(n, 3)).tolist(),
+                 orient.tolist(), rng.uniform(-.05, .05, (n, 3)).tolist())]
+    # random inputs held 20 ticks at a time, like a player or an autopilot block
+    held = flight.controls_to_bits(rng.choice((-1, 0, 1, 2), (ticks // 20 + 1, n, 3)),
+                                   rng.choice((0, 1, -1, 2), (ticks // 20 + 1, n)))
+    bits = np.repeat(held, 20, axis=0)[:ticks]
+
+    ships = [bare_ship(*s) for s in start]
+    fleets = {"fleet, phase by phase": Fleet.from_ships(ships), "fleet, numpy": Fleet.from_ships(ships),
+              "fleet, kernels": Fleet.from_ships(ships)}
+    for t in range(ticks):
+        for ship, b in zip(ships, bits[t].tolist()):
+            ship.apply_input(b)
+            ship.update()
+        for name, fleet in fleets.items():
+            fleet.apply_input(bits[t])
+            if name == "fleet, phase by phase":
+                fleet.applyVel()
+                fleet.adjust()
+                fleet.rotate()
+                fleet.applyThrust()
+                fleet.calc_fuel_loss()
+            else:
+                enabled, kernels.ENABLED = kernels.ENABLED, kernels.ENABLED and name == "fleet, kernels"
+                fleet.update()
+                kernels.ENABLED = enabled
+
+    expected = Fleet.from_ships(ships)
+    print(f"{n} ships, {ticks} ticks of random held inputs against Spaceship.update:")
+    for name, fleet in fleets.items():
+        if name == "fleet, kernels" and not kernels.ENABLED:
+            continue
+        diff = max(np.abs(getattr(fleet.state, a) - getattr(expected.state, a)).max()
+                   for a in ("pos", "vel", "force", "orient", "rpy", "fuel", "health"))
+        print(f"  {name:<22} max diff {diff:.1e}, prev_pos max diff {np.abs(fleet.prev_pos - expected.prev_pos).max():.1e}")
+
+    # ship-ticks a second, one Spaceship at a time and as fleets of growing size
+    def rate(func, count, reps):
+        best = float('inf')
+        for i in range(reps):
+            t = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t)
+        return count / best
+
+    b = int(bits[0, 0])
+    loop = rate(lambda: [(s.apply_input(b), s.update()) for s in ships], len(ships), 5)
+    print(f"\nship-ticks a second (input and update), Spaceship one at a time: {loop:,.0f}")
+    for size in (1, 100, 1000, 10000, 100000):
+        fleet = Fleet(size)
+        fleet.apply_input(np.full(size, b))
+        fleet.state.vel[:] = .1
+        line = []
+        for mode in (False, True) if kernels.ENABLED else (False,):
+            enabled, kernels.ENABLED = kernels.ENABLED, mode
+            line.append(f"{'kernels' if mode else 'numpy'} {rate(fleet.update, size, 20):>14,.0f}")
+            kernels.ENABLED = enabled
+        print(f"  fleet of {size:>6}: " + ", ".join(line))
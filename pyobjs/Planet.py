@@ -13,8 +13,20 @@ from utils.quat import *
 from utils.DisplayObj import DisplayObj
 from utils.DisplayObj import Material
 from utils.util import *
+from utils import kernels
 from pyobjs.ColObj import *
 
+# GLOBALS
+tree_cache = None   # tree display object, shared by every planet
+
+# Material definition for planet surface (Material.001 in wfobjs/sphere.mtl)
+planet_material = Material(
+    amb=(0.509254, 0.053280, 0.640000),
+    diff=(0.509254, 0.053280, 0.640000),
+    spec=(0.318799, 0.033313, 0.399551),
+    emm=(0.000000, 0.000000, 0.000000)
+)
+
 # Material definition for landing zone
 landing_material = Material(
     amb=(0.069405, 0.640000, 0.047737),
@@ -29,22 +41,34 @@ class Planet(ColObj):
     MAX_ACCEPTABLE_LANDING_VELOCITY = .1
     LANDING_ANGLE_TOLERANCE = np.pi/6   # 30 degree landing angle tolerance
 
+    # Planet mesh quality setting: "ico" with DETAIL subdivisions, or "uv" with DETAIL rings
+    SPHERE = "ico"
+    DETAIL = 3
+    TREE_SHARE = 1.0    # share of the NUM_TREES trees placed that are drawn, they are all placed either way
+
     def __init__(self, landingplanept, radius=20, pos=(0, 0, 0)):
+        global tree_cache
 
-        # creating call list for tree
-        self.tree_obj = DisplayObj()
-        self.tree_obj.objFileImport("./wfobjs/tree")
-        self.tree_obj.register()
+        # creating call list for tree, once
+        if not tree_cache:
+            tree_cache = DisplayObj()
+            tree_cache.objFileImport("./wfobjs/tree")
+            tree_cache.cached = True
+            tree_cache.register()
+        self.tree_obj = tree_cache
 
         # Radius and landing plane point for planet
         self.radius = radius
+        if landingplanept is None:  # not a landing target, put the landing plane outside the planet
+            landingplanept = (0, 2 * radius, 0)
         self.landingplanept = landingplanept
 
         super().__init__(pos, True)
 
-        # Planet display object
-        self.obj = DisplayObj()
-        self.obj.objFileImport("./wfobjs/sphere")
+        # Planet display object, a unit sphere generated at the current quality setting
+        from utils.meshgen import sphere_obj    # loaded with the first level, after the loading frame is up
+        self.obj = sphere_obj(Planet.SPHERE, Planet.DETAIL, "Material.001")
+        self.obj.mats["Material.001"] = planet_material
 
         # collision radius set to maxr. This is a sphere after all
         self.colr = self.radius
@@ -57,19 +81,27 @@ class Planet(ColObj):
         self.choose_landing_spot()
 
         if self.isstatic:
+            self.trees = self.place_trees()[:round(Planet.NUM_TREES * Planet.TREE_SHARE)]
             self.obj.register(self.populate_trees) # Throw in the trees to minimize call list
-
-    def render(self):
+            for position, v, a in self.trees:   # the shader path bakes them into the planet's vertex buffer
+                tree = q_to_mat4(axisangle_to_q(v, a)) if any(v) else np.identity(4, 'f')
+                tree[:3, 3] = position
+                self.obj.parts.append((self.tree_obj, tree))
+        else:
+            self.trees = []
+
+    def render(self, mat=None):
         # glMatrixMode(GL_MODELVIEW)
         glPushMatrix()
 
-        glTranslatef(*self.pos)
+        self.transform.apply(mat)
 
         self.obj.drawObj()
 
         glPopMatrix()
 
-    def populate_trees(self):
+    # random spots outside the landing area, (position, rotation axis, rotation angle) for every tree
+    def place_trees(self):
         # Normal vector is from 0,0,0 to the landing point i.e. the landing point
         nvec = self.landingplanept
         d = dot_vecs(nvec,self.landingplanept) # get dot from nvec and landingplanept to do outside calcs
@@ -93,9 +125,11 @@ class Planet(ColObj):
 
             return vert, rv, ra
 
-        for i in range(Planet.NUM_TREES):
+        return [generate_tree() for i in range(Planet.NUM_TREES)]
+
+    def populate_trees(self):
+        for position, v, a in self.trees:
             glPushMatrix()
-            position, v, a = generate_tree()
             glTranslatef(*position)
             glRotatef(a * 180 / np.pi, *v)
             self.tree_obj.drawObj()
@@ -107,23 +141,25 @@ class Planet(ColObj):
         return dot_vecs(nvec, pt) < d
 
     def deregister(self):
-        super().deregister()
-        self.tree_obj.deregister()
+        super().deregister()    # the tree list is shared, it stays
 
     def choose_landing_spot(self):
-        nvec = self.landingplanept
+        nvec = np.asarray(self.landingplanept)
         d = dot_vecs(nvec,self.landingplanept) # landingplanept is both the normal vector and the point on the plane
-        marked_verts = set()
 
-        # for each of the verticies...
-        for i,vert in enumerate(self.obj.verts):
-            vert = scalar_mult(self.radius, vert)
-            if dot_vecs(nvec, vert) >= d:   # if the vert is on the opposite side of the plane than the center...
-                marked_verts.add(i) # Mark that john
+        if kernels.ENABLED:     # the same test in one compiled pass over the faces
+            landable = kernels.landing_faces(self.obj.verts, float(self.radius), nvec.astype(float), float(d),
+                                             self.obj.face_verts, self.obj.face_offsets)
+            self.obj.set_face_material(landable, "landable")
+            return
+
+        # mark every vertex on the opposite side of the plane than the center
+        marked_verts = (self.radius * self.obj.verts) @ nvec >= d
 
-        for i,surf in enumerate(self.obj.surfs):    # for each surf...
-            if set(surf[0]).issubset(marked_verts): # if each of the surf verts exist in the marked_verts...
-                self.obj.cols[i] = "landable"   # color it with the landable color
+        # a face is landable if all of its verticies are marked
+        marked_corners = marked_verts[self.obj.face_verts]
+        landable = np.logical_and.reduceat(marked_corners, self.obj.face_offsets[:-1])
+        self.obj.set_face_material(landable, "landable")   # color it with the landable color
 
     def ejectpoint(self):
         # Grab the landing plane vector, make it of length radius + 20, and then add it to the position
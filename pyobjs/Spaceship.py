@@ -11,6 +11,7 @@ from OpenGL.GL import *
 from utils.quat import *
 from utils.DisplayObj import DisplayObj
 from utils.util import *
+from utils import Input
 
 from pyobjs.ColObj import *
 
@@ -46,6 +47,13 @@ class Spaceship(ColObj):
     WAVER_SPEED = np.pi/20  # higher is faster for the arrow waver speed
     WAVER_SCALE = .7        # how far arrow waver oscillates in each direction
 
+    # (left, right, center) input bits for roll, pitch and yaw
+    ROT_INPUTS = (
+        (Input.ROLL_LEFT, Input.ROLL_RIGHT, Input.ROLL_CENTER),
+        (Input.PITCH_LEFT, Input.PITCH_RIGHT, Input.PITCH_CENTER),
+        (Input.YAW_LEFT, Input.YAW_RIGHT, Input.YAW_CENTER)
+    )
+
     def __init__(self, pos=(0, 0, 0), orient=(0, 1, 0, 0), lose_cond=None):
         global display_cache
         super().__init__(pos, True)
@@ -59,11 +67,13 @@ class Spaceship(ColObj):
         if not display_cache:   # load display object
             self.obj = DisplayObj()
             self.obj.objFileImport("./wfobjs/spaceship")
+            self.obj.cached = True
             # self.obj.register()
             display_cache["ship"] = self.obj
 
             self.arrow_obj = DisplayObj()
             self.arrow_obj.objFileImport("./wfobjs/arrow")
+            self.arrow_obj.cached = True
             self.arrow_obj.register()
             display_cache["arrow"] = self.arrow_obj
         else:
@@ -71,6 +81,7 @@ class Spaceship(ColObj):
             self.arrow_obj = display_cache["arrow"]
 
         self.colr = 2 * self.obj.maxr / 3
+        self.tree = self.obj.sphere_tree    # asteroid hits are tested against the mesh
         self.health = Spaceship.HEALTH
         self.fuel = Spaceship.FUEL
 
@@ -103,9 +114,9 @@ class Spaceship(ColObj):
         else:
             self.thrusting = mode
 
-    # add force to velocity
-    def applyThrust(self):
-        self.vel = add_vecs(self.force, self.vel)
+    # add force to velocity, dt ticks of it
+    def applyThrust(self, dt=1.0):
+        self.vel = add_vecs(scalar_mult(dt, self.force), self.vel)
 
     # apply force opposite to current velocity
     def applyOppThrust(self, up=0):
@@ -115,40 +126,64 @@ class Spaceship(ColObj):
         else:
             self.thrusting = 2
 
-    # apply velocity to position
-    def applyVel(self):
-        self.pos = add_vecs(self.vel, self.pos)
+    # apply velocity to position, dt multiplies the positional step
+    def applyVel(self, dt=1.0):
+        self.prev_pos = self.pos
+        self.pos = add_vecs(scalar_mult(dt, self.vel), self.pos)
         # self.orient[3][0:3] = add_vecs(self.vel, self.orient[3][0:3])
 
+    # Set roll, pitch, yaw and thrust modes from the bitset of actions held this tick
+    def apply_input(self, bits):
+        for mode, (left, right, center) in enumerate(Spaceship.ROT_INPUTS):
+            if bits & left:
+                self.setRot(mode, Spaceship.LEFT)
+            elif bits & right:
+                self.setRot(mode, Spaceship.RIGHT)
+            elif bits & center:
+                self.resetRot(mode)
+            else:
+                self.setRot(mode, up=KP_UP)
+
+        if bits & Input.THRUST_CENTER:
+            self.applyOppThrust()
+        elif bits & Input.THRUST_UP:
+            self.setThrust(Spaceship.THF)
+        elif bits & Input.THRUST_DOWN:
+            self.setThrust(Spaceship.THB)
+        else:
+            self.setThrust(up=KP_UP)
+
     # set rotation calculation - set angular velocity to itself + the direction * the rotational
-    # acceleration or the Max rotational acceleration... whichever is higher
-    def setRotCalc(self, mode: int, d=RIGHT) -> None:
+    # acceleration (dt ticks of it) or the Max rotational acceleration... whichever is higher
+    def setRotCalc(self, mode: int, d=RIGHT, dt=1.0) -> None:
+        racc = Spaceship.RACC * dt
         if np.sign(d) == 1:
-            self.rpy[mode] = min(self.rpy[mode] + d * Spaceship.RACC, Spaceship.RMAX)
+            self.rpy[mode] = min(self.rpy[mode] + racc, Spaceship.RMAX)
         elif np.sign(d) == -1:
-            self.rpy[mode] = max(self.rpy[mode] + d * Spaceship.RACC, -Spaceship.RMAX)
+            self.rpy[mode] = max(self.rpy[mode] - racc, -Spaceship.RMAX)
         # on sign==0, pass
 
-    # Bleed off current rotational velocity by applying a 'force' which is opposite
-    def resetRotCalc(self, mode: int) -> None:
+    # Bleed off current rotational velocity by applying a 'force' which is opposite, dt ticks of it
+    def resetRotCalc(self, mode: int, dt=1.0) -> None:
+        racc = Spaceship.RACC * dt
         if np.sign(self.rpy[mode]) == 1:
-            self.rpy[mode] -= Spaceship.RACC
+            self.rpy[mode] -= racc
         elif np.sign(self.rpy[mode]) == -1:
-            self.rpy[mode] += Spaceship.RACC
+            self.rpy[mode] += racc
 
-        if abs(self.rpy[mode]) <= Spaceship.RACC:
+        if abs(self.rpy[mode]) <= racc:
             self.rpy[mode] = 0
         # on sign==0, pass
 
-    # adjust rotational and positional acceleration based on current state variables
-    def adjust(self):
+    # adjust rotational and positional acceleration based on current state variables, over dt ticks
+    def adjust(self, dt=1.0):
         # Rotational Acceleration
         for rpy in range(3):        # for rpy indicies...
             if self.actions[rpy][0] != Spaceship.STEADY:    # if we are not trying to be steady...
                 if self.actions[rpy][0] == Spaceship.ROTSET:    # if we are applying rotation...
-                    self.setRotCalc(*self.actions[rpy][1])  # send mode and direction to setRotCalc
+                    self.setRotCalc(*self.actions[rpy][1], dt)  # send mode and direction to setRotCalc
                 elif self.actions[rpy][0] == Spaceship.ROTRESET:    # if we are resetting rotation...
-                    self.resetRotCalc(self.actions[rpy][1]) # send mode to resetRotCalc
+                    self.resetRotCalc(self.actions[rpy][1], dt) # send mode to resetRotCalc
 
         # Positional Acceleration
         if self.thrusting == 2: # If we are applying an opposite thrust...
@@ -163,34 +198,36 @@ class Spaceship(ColObj):
             self.force = tuple(map(lambda val: np.sign(self.thrusting) * Spaceship.PACC * val, self.getHeading()))
 
     # See Asteroid for further clarification... Take axis and rotate by angle... turn to quat
-    # multiply. Success.
-    def rotate(self):
+    # multiply. Success. The angle is dt ticks of each rate.
+    def rotate(self, dt=1.0):
         if self.rpy[0]:
-            rot_x = normalize(axisangle_to_q((1.0, 0.0, 0.0), self.rpy[0]))
+            rot_x = normalize(axisangle_to_q((1.0, 0.0, 0.0), self.rpy[0] * dt))
             self.orient = q_mult(self.orient, rot_x)
 
         if self.rpy[1]:
-            rot_z = normalize(axisangle_to_q((0.0, 0.0, 1.0), self.rpy[1]))
+            rot_z = normalize(axisangle_to_q((0.0, 0.0, 1.0), self.rpy[1] * dt))
             self.orient = q_mult(self.orient, rot_z)
 
         if self.rpy[2]:
-            rot_y = normalize(axisangle_to_q((0.0, 1.0, 0.0), self.rpy[2]))
+            rot_y = normalize(axisangle_to_q((0.0, 1.0, 0.0), self.rpy[2] * dt))
             self.orient = q_mult(self.orient, rot_y)
 
     def showMat(self):
         print(self.orient)
 
     # Set thruster color based on current force
-    def setThrusterColor(self):
-        if self.thrusting == -1:  # backwards
+    # thrusting defaults to the ship's own, a frame drawn from a copy passes the copy's
+    def setThrusterColor(self, thrusting=None):
+        thrusting = self.thrusting if thrusting is None else thrusting
+        if thrusting == -1:  # backwards
             kd = (0.800000, 0.002302, 0.001986)
             ks = (1.000000, 0.002732, 0.002428)
             ke = (2.000000, 0.005755, 0.004965)
-        elif self.thrusting == 1:  # forwards
+        elif thrusting == 1:  # forwards
             kd = (0.160080, 0.640000, 0.632630)
             ks = (0.160080, 0.640000, 0.632630)
             ke = (0.400200, 1.600000, 1.581574)
-        elif self.thrusting == 2:  # stabalize
+        elif thrusting == 2:  # stabalize
             kd = (0.007062, 0.800000, 0.000000)
             ks = (0.008568, 1.000000, 0.000000)
             ke = (0.017654, 2.000000, 0.000000)
@@ -212,14 +249,17 @@ class Spaceship(ColObj):
     def point_arrow_at(self, pt):
         self.arrow_vec = normalize(sub_vecs(self.pos, pt))
 
-    def render_arrow(self):
+    # orient and arrow_vec default to the ship's own
+    def render_arrow(self, orient=None, arrow_vec=None):
+        orient = orient or self.orient
+        arrow_vec = arrow_vec or self.arrow_vec
         arrow_pos_mag = self.colr + np.sin(self.arrow_waver_angle) * Spaceship.WAVER_SCALE
         self.arrow_waver_angle = (self.arrow_waver_angle + Spaceship.WAVER_SPEED) % (2*np.pi)
 
         # arrow position is supposed to be between the ship and the point
         # take the vector which points towards the planet, multiply it by some value to get away from the ship,
         # multiply that by the opposite rotation of the ship to get the point we want
-        arrow_pos = qv_mult(q_conjugate(self.orient), scalar_mult(arrow_pos_mag,self.arrow_vec))
+        arrow_pos = qv_mult(q_conjugate(orient), scalar_mult(arrow_pos_mag,arrow_vec))
 
         rv = cross_vecs((0, 1, 0), arrow_pos)  # rotation vector axis is cross between y axis and the position from the ship
         ra = np.arccos(dot_vecs((0, 1, 0), arrow_pos)/arrow_pos_mag)  # rotation angle calculation
@@ -234,11 +274,12 @@ class Spaceship(ColObj):
 
         glPopMatrix()
 
-    def calc_fuel_loss(self):
+    # burn dt ticks of fuel for the current thrust
+    def calc_fuel_loss(self, dt=1.0):
         if self.thrusting in (-1, 1): # backwards or forwards
-            self.fuel -= Spaceship.THRUST_LOSS
+            self.fuel -= Spaceship.THRUST_LOSS * dt
         elif self.thrusting == 2: # Opposite thrust
-            self.fuel -= Spaceship.THRUST_OPP_LOSS
+            self.fuel -= Spaceship.THRUST_OPP_LOSS * dt
 
         if self.fuel <= 0:
             self.damage("You ran out of fuel!")
@@ -252,40 +293,50 @@ class Spaceship(ColObj):
     def get_spot_direction(self):
         return qv_mult(self.orient, (1,1,0))
 
-    def render(self):
-        self.applyVel()
+    # advance the flight model dt ticks: position, rotation, thrust and fuel burn all move dt ticks' worth
+    def update(self, dt=1.0):
+        self.applyVel(dt)
+
+        # do ypr calculations
+        self.adjust(dt)
+        self.rotate(dt)
+
+        self.applyThrust(dt)
 
+        self.calc_fuel_loss(dt)
+
+    # view is a ShipView to draw the thrusters and arrow from instead of the live ship, mat its model matrix
+    def render(self, mat=None, view=None):
         # glMatrixMode(GL_MODELVIEW)
         glPushMatrix()
 
         # Set the thruster color to necessary material
-        self.setThrusterColor()
-
-        # Translate and rotate
-        v, a = q_to_axisangle(self.orient)
+        self.setThrusterColor(view and view.thrusting)
 
-        glTranslatef(*self.pos)
-        glRotatef(a * 180 / np.pi, *v)
+        # Translate and rotate with the cached model matrix
+        self.transform.apply(mat)
 
         # self.render_lights()
 
-        # do ypr calculations
-
-        self.adjust()
-        self.rotate()
-
-        self.applyThrust()
-
-        self.calc_fuel_loss()
-
         # Cube.draw_cube()  # eventually draw ship
-        # self.draw_collision_sphere() # collision sphere
         self.obj.drawObj()
 
-        self.render_arrow()
+        if view:
+            self.render_arrow(view.orient, view.arrow_vec)
+        else:
+            self.render_arrow()
 
         glPopMatrix()
 
+    # orientation lives in the transform so the model matrix is only rebuilt when it changes
+    @property
+    def orient(self):
+        return self.transform.quat
+
+    @orient.setter
+    def orient(self, orient):
+        self.transform.quat = orient
+
     def getHeading(self):
         return qv_mult(self.orient, (1.0, 0.0, 0.0))
 
@@ -1,42 +1,96 @@
 import os
 import numpy as np
 from OpenGL.GL import *
-from PIL.Image import open as pilopen
+
+from utils.glpool import pool, LIST
 
 
 class DisplayObj:
-    def __init__(self, verts=None, norms=None, edges=None, surfs=None, uvs=None, cols=None, nam=None, mats=None):
-        self.verts = verts  # vertex list
-        self.norms = norms  # vertex norm list
-        self.edges = edges  # edge list
-        self.surfs = surfs  # surface, surface uv, surface norm
-        self.uvs = uvs      # uv map points
-        self.cols = cols    # color list, parallel with surface
-        self.name = nam     # name
-        self.mats = mats    # Materials: hashmap materialname -> Material
+    program = None  # utils.shaders.LightingProgram drawing every mesh while it is bound
+
+    def __init__(self, nam=None, mats=None):
+        self.verts = None       # vertex positions, float32 (V, 3)
+        self.norms = None       # normals, float32 (N, 3)
+        self.uvs = None         # uv map points, float32 (T, 2)
+        self.face_verts = None  # vertex index of every face corner, int32, faces laid end to end
+        self.face_uvs = None    # uv index of every face corner, int32, parallel with face_verts
+        self.face_offsets = None    # face i owns corners face_offsets[i]:face_offsets[i+1], int32 (F + 1)
+        self.face_norms = None  # normal index per face, int32 (F)
+        self.face_mats = None   # material index per face into mat_names, -1 for none, int16 (F)
+        self.mat_names = []     # material names, face_mats indexes into this
+        self.name = nam         # name
+        self.mats = mats if mats is not None else {}   # Materials: hashmap materialname -> Material
         self.maxr = 0       # max radius
         self.scale = 1.0    # scale
         self.curdir = None  # current directory
 
         self.dlindex = -1   # display list index
+        self.cached = False # kept in a mesh cache for the whole game, its GL resources don't belong to a level
+        self.mesh = None    # utils.shaders.ShadedMesh, built on the first draw with shaders
+        self.parts = []     # (DisplayObj, 4x4 row major model matrix) drawn along with this one by the shader path
 
         self.usetex = False # use texture
-        self.texfile = None # Texture file
+        self.texfile = None # Texture file, uploaded on first draw or register
         self.texindex = -1  # texture list index
+        self.texpath = None # path of the uploaded texture, shared with every object using the same image
+
+        # computed on first access
+        self._edges = None
+        self._adjacency = None
+        self._batches = None
+        self._sphere_tree = None
+
+    @property
+    def num_faces(self):
+        return len(self.face_norms)
+
+    # Fill the mesh from arrays. Faces are given as flat corner indices plus per-face offsets.
+    def set_arrays(self, verts, norms, face_verts, face_offsets, face_norms,
+                   uvs=None, face_uvs=None, face_mats=None, mat_names=None):
+        self.verts = np.ascontiguousarray(verts, dtype=np.float32).reshape(-1, 3)
+        self.norms = np.ascontiguousarray(norms, dtype=np.float32).reshape(-1, 3)
+        self.uvs = np.ascontiguousarray(uvs if uvs is not None else (), dtype=np.float32).reshape(-1, 2)
+        self.face_verts = np.ascontiguousarray(face_verts, dtype=np.int32)
+        self.face_offsets = np.ascontiguousarray(face_offsets, dtype=np.int32)
+        self.face_norms = np.ascontiguousarray(face_norms, dtype=np.int32)
+        if face_uvs is None:
+            face_uvs = np.zeros(len(self.face_verts))
+        self.face_uvs = np.ascontiguousarray(face_uvs, dtype=np.int32)
+        if face_mats is None:
+            face_mats = np.full(len(self.face_norms), -1)
+        self.face_mats = np.ascontiguousarray(face_mats, dtype=np.int16)
+        self.mat_names = [str(n) for n in mat_names] if mat_names is not None else []
+
+        self.maxr = float(np.sqrt(np.max(np.einsum('ij,ij->i', self.verts, self.verts)))) if len(self.verts) else 0
+        self._edges = None
+        self._adjacency = None
+        self._batches = None
+        self._sphere_tree = None
+
+    # the mesh as named arrays, set_arrays(**obj.arrays()) rebuilds it
+    def arrays(self):
+        return dict(
+            verts=self.verts, norms=self.norms, face_verts=self.face_verts, face_offsets=self.face_offsets,
+            face_norms=self.face_norms, uvs=self.uvs, face_uvs=self.face_uvs, face_mats=self.face_mats,
+            mat_names=np.array(self.mat_names, dtype=str)
+        )
 
     def objFileImport(self, objName):
         # Init vars
         objFname = objName + ".obj"
-        curmat = None
+        curmat = -1
 
-        # Reset current ivars
-        self.verts = []
-        self.norms = []
-        self.edges = []
-        self.surfs = []
-        self.cols = []
-        self.uvs = []
-        self.mats = None
+        # Parse into flat python lists, they become typed arrays at the end
+        verts = []
+        norms = []
+        uvs = []
+        face_verts = []
+        face_uvs = []
+        face_offsets = [0]
+        face_norms = []
+        face_mats = []
+        mat_names = []
+        self.mats = {}
         self.usetex = False
 
         if not os.path.exists(objFname):
@@ -44,10 +98,9 @@ class DisplayObj:
 
         self.curdir = os.path.dirname(os.path.abspath(objFname))
 
-        # Read in verts, edges, and surfs
+        # Read in verts and surfs
         with open(objFname) as fp:
-            line = fp.readline()
-            while line:
+            for line in fp:
                 args = line.strip().split(" ")  # get line args
                 cmd = args[0]
 
@@ -59,50 +112,93 @@ class DisplayObj:
                 elif cmd == "o": # object name
                     self.name = args[1]
                 elif cmd == "v": # vertex
-                    vert = (float(args[1]),float(args[2]),float(args[3]))
-                    self.verts.append(vert)
-                    sum_squares = sum(map(lambda a: a*a, vert))
-                    if self.maxr < sum_squares:
-                        self.maxr = sum_squares
+                    verts.extend((float(args[1]),float(args[2]),float(args[3])))
                 elif cmd == "vn": # vertex normal
-                    self.norms.append((float(args[1]),float(args[2]),float(args[3])))
+                    norms.extend((float(args[1]),float(args[2]),float(args[3])))
                 elif cmd == "vt": # vertex texture
-                    self.uvs.append((float(args[1]),float(args[2])))
+                    uvs.extend((float(args[1]),float(args[2])))
                 elif cmd == "usemtl": # use material
-                    curmat = args[1]
+                    if args[1] not in mat_names:
+                        mat_names.append(args[1])
+                    curmat = mat_names.index(args[1])
                 elif cmd == "f": # face
-                    self.loadFaceCmd(args[1:])
-                    if self.mats and curmat: # if we have a material to load...
-                        self.cols.append(curmat)
-                line = fp.readline()
-            self.maxr = np.sqrt(self.maxr)
+                    norm = self.loadFaceCmd(args[1:], face_verts, face_uvs)
+                    face_offsets.append(len(face_verts))
+                    face_norms.append(norm)
+                    face_mats.append(curmat)
 
-    def loadFaceCmd(self, args):
-        # EDGES
-        vertlist = []
-        texlist = []
+        self.set_arrays(verts, norms, face_verts, face_offsets, face_norms,
+                        uvs, face_uvs, face_mats, mat_names)
+
+    # Append the vertex and uv indices of one face command, returns the face normal index
+    def loadFaceCmd(self, args, face_verts, face_uvs):
         tmp = None
         for arg in args:
             tmp = arg.split("/")
-            vertlist.append( int(tmp[0])-1 ) # append the vertex number (first number in str) -1 to make index
+            face_verts.append( int(tmp[0])-1 ) # append the vertex number (first number in str) -1 to make index
             if tmp[1]:
-                texlist.append( int(tmp[1])-1 ) # append the tex number if it exists
+                face_uvs.append( int(tmp[1])-1 ) # append the tex number if it exists
             else:
-                texlist.append(0)
+                face_uvs.append(0)
+
+        return int(tmp[2])-1 # grab the vertex normal number
+
+    # unique undirected edges, int32 (E, 2), built on first access
+    @property
+    def edges(self):
+        if self._edges is None:
+            self._edges = np.unique(np.sort(self._corner_edges(), axis=1), axis=0).astype(np.int32)
+        return self._edges
+
+    # pairs of faces sharing an edge, int32 (P, 2), built on first access
+    @property
+    def adjacency(self):
+        if self._adjacency is None:
+            edges = np.sort(self._corner_edges(), axis=1)
+            corner_face = np.repeat(np.arange(self.num_faces, dtype=np.int32), np.diff(self.face_offsets))
+            order = np.lexsort((edges[:, 1], edges[:, 0]))     # group corners of the same edge together
+            edges = edges[order]
+            corner_face = corner_face[order]
+            same = np.all(edges[1:] == edges[:-1], axis=1)   # neighbours in the sorted list share an edge
+            self._adjacency = np.stack((corner_face[:-1][same], corner_face[1:][same]), axis=1).astype(np.int32)
+        return self._adjacency
 
-        norm = int(tmp[2])-1 # grab the vertex normal number
+    # bounding sphere hierarchy over the triangles, for exact collisions, built on first access
+    @property
+    def sphere_tree(self):
+        if self._sphere_tree is None:
+            from utils.spheretree import SphereTree
+            self._sphere_tree = SphereTree(self.verts[self.face_verts[self._fan_corners()[0]]].reshape(-1, 3, 3))
+        return self._sphere_tree
 
-        for i in range(len(vertlist) - 1):
-            edge = (vertlist[i],vertlist[i+1])  # get edge of face
-            if edge not in self.edges and (edge[1],edge[0]) not in self.edges: # if we don't have a copy of this yet...
-                self.edges.append(edge)
+    # Faces split into fans of triangles: corner indices (3 per triangle, into face_verts) and the face of each
+    def _fan_corners(self):
+        counts = np.diff(self.face_offsets)
+        ntris = counts - 2
+        tri_face = np.repeat(np.arange(self.num_faces), ntris)     # face each fan triangle comes from
+        first = self.face_offsets[tri_face]
+        step = np.arange(len(tri_face)) - np.repeat(np.cumsum(ntris) - ntris, ntris) + 1
+        return np.stack((first, first + step, first + step + 1), axis=1).ravel(), tri_face
 
-        edge = (vertlist[-1],vertlist[0])  # append last and first
-        if edge not in self.edges and (edge[1], edge[0]) not in self.edges:  # if we don't have a copy of this yet...
-            self.edges.append(edge)
+    # (start, end) vertex index of every face side, one row per corner
+    def _corner_edges(self):
+        nxt = np.arange(1, len(self.face_verts) + 1)
+        nxt[self.face_offsets[1:] - 1] = self.face_offsets[:-1]    # last corner wraps to the first
+        return np.stack((self.face_verts, self.face_verts[nxt]), axis=1)
 
-        # FACE
-        self.surfs.append((tuple(vertlist), tuple(texlist), norm))
+    # mark the faces in mask with the named material, adding it to the material table if needed
+    def set_face_material(self, mask, matname):
+        if matname not in self.mat_names:
+            self.mat_names.append(matname)
+        self.face_mats[mask] = self.mat_names.index(matname)
+        self._batches = None
+
+    # bytes used by the mesh arrays
+    def nbytes(self):
+        return sum(a.nbytes for a in (
+            self.verts, self.norms, self.uvs, self.face_verts, self.face_uvs,
+            self.face_offsets, self.face_norms, self.face_mats
+        ) if a is not None)
 
     def loadMats(self, fname):
         # Init vars
@@ -131,7 +227,7 @@ class DisplayObj:
                     mats[curmat].trans = float(args[1])
                 elif cmd == "map_Kd": # texture map
                     self.usetex = True
-                    self.register_texture(args[1])
+                    self.texfile = args[1]  # uploaded once there is a GL context to upload to
                 else:  # anything else
                     pass
 
@@ -139,55 +235,68 @@ class DisplayObj:
 
         return mats
 
+    # texture from the pool, uploaded the first time any object uses this image
     def register_texture(self, fname):
-        im = pilopen(os.path.join(self.curdir,fname))
-        try:
-            ix, iy, image = im.size[0], im.size[1], im.tobytes("raw", "RGB", 0, -1)
-        except SystemError:
-            ix, iy, image = im.size[0], im.size[1], im.tobytes("raw", "RGBX", 0, -1)
-        self.texindex = glGenTextures(1)                # generate texture index
-        glBindTexture(GL_TEXTURE_2D, self.texindex)     # bind the texture
-        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)           # set the pixel store to unpack alignment
-        glTexImage2D(                                   # load the texture
-            GL_TEXTURE_2D, 0, 3, ix, iy, 0,
-            GL_RGB, GL_UNSIGNED_BYTE, image
-        )
+        self.texpath = os.path.join(self.curdir, fname)
+        self.texindex = pool.texture(self.texpath, self, upload_texture)
+
+    # Triangulated vertex arrays grouped by material, built on first draw:
+    # list of (material index, positions, normals, uvs)
+    def _draw_batches(self):
+        if self._batches is None:
+            corners, tri_face = self._fan_corners()
+            corner_face = np.repeat(tri_face, 3)
+
+            self._batches = []
+            for mat in np.unique(self.face_mats):
+                sel = self.face_mats[corner_face] == mat
+                uvs = self.uvs[self.face_uvs[corners[sel]]] if self.usetex and len(self.uvs) else None
+                self._batches.append((
+                    int(mat),
+                    np.ascontiguousarray(self.verts[self.face_verts[corners[sel]]]),
+                    np.ascontiguousarray(self.norms[self.face_norms[corner_face[sel]]]),
+                    uvs
+                ))
+        return self._batches
 
     def drawObj(self):
+        if DisplayObj.program is not None:  # GLSL lighting, drawn from a vertex buffer instead
+            DisplayObj.program.draw(self)
+            return
+
+        if self.usetex and self.texindex == -1:
+            self.register_texture(self.texfile)
+
         if self.dlindex == -1:  # Immediate mode
             glScalef(self.scale, self.scale, self.scale)
-            for col, vertex_uv_norm in zip(self.cols, self.surfs): # for the color, surface, surface_norm
-                mat = self.mats[col] if col in self.mats else Material()
+            glEnableClientState(GL_VERTEX_ARRAY)
+            glEnableClientState(GL_NORMAL_ARRAY)
+            for mat, pos, norm, uv in self._draw_batches():  # one draw per material
                 # Set material properties
                 if not self.usetex:
+                    mat = self.mats.get(self.mat_names[mat], Material()) if mat >= 0 else Material()
                     glMaterialfv(GL_FRONT, GL_AMBIENT, mat.amb)
                     glMaterialfv(GL_FRONT, GL_DIFFUSE, mat.diff)
                     glMaterialfv(GL_FRONT, GL_SPECULAR, mat.spec)
                     glMaterialfv(GL_FRONT, GL_EMISSION, mat.emm)
-
-                surface = vertex_uv_norm[0] # surface verticies
-                uv = vertex_uv_norm[1]      # uv points
-                norm = vertex_uv_norm[2]    # surface norm
-                if len(surface) == 3:   # if there are 3 verticies...
-                    glBegin(GL_TRIANGLES)
-                elif len(surface) == 4: # if there are 4 verticies...
-                    glBegin(GL_QUADS)
-                else:                   # if there are more than 5 verticies...
-                    glBegin(GL_POLYGON)
-                glNormal3fv(self.norms[norm])
-                for vertex, uv in zip(surface,uv):
-                    if self.usetex:
-                        glTexCoord2f(*self.uvs[uv])
-                    glVertex3fv(self.verts[vertex])
-                glEnd()
+                if uv is not None:
+                    glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+                    glTexCoordPointer(2, GL_FLOAT, 0, uv)
+                glVertexPointer(3, GL_FLOAT, 0, pos)
+                glNormalPointer(GL_FLOAT, 0, norm)
+                glDrawArrays(GL_TRIANGLES, 0, len(pos))
+                if uv is not None:
+                    glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+            glDisableClientState(GL_NORMAL_ARRAY)
+            glDisableClientState(GL_VERTEX_ARRAY)
             glScalef(1.0,1.0,1.0)
 
             # glBegin(GL_LINES)
             # glColor3fv((0.0, 0.0, 0.0))
-            # for edge in self.edges:
-            #     for vertex in edge:
-            #         glVertex3fv(self.verts[vertex])
-            # glEnd()
+            # glEnableClientState(GL_VERTEX_ARRAY)
+            # glVertexPointer(3, GL_FLOAT, 0, self.verts[self.edges].reshape(-1, 3))
+            # glDrawArrays(GL_LINES, 0, 2 * len(self.edges))
+            # glDisableClientState(GL_VERTEX_ARRAY)
         else: # Display List
             if self.usetex:
                 # Texture init
@@ -201,16 +310,46 @@ class DisplayObj:
                 glDisable(GL_TEXTURE_2D)
 
     def register(self, extraFunc=None):
-        index = glGenLists(1)
+        if self.usetex and self.texindex == -1:
+            self.register_texture(self.texfile)     # upload before compiling, glGenTextures can't go in a list
+        if self.dlindex != -1:
+            pool.release(LIST, self.dlindex)
+        index = pool.gen(LIST, self, shared=self.cached)
         glNewList(index,GL_COMPILE)
         self.drawObj()
         if extraFunc:
             extraFunc()
         glEndList()
         self.dlindex = index
+        self._batches = None    # the display list holds the geometry now
 
+    # give the display list, texture and vertex buffer back to the pool
     def deregister(self):
-        glDeleteLists(self.dlindex, 1)
+        if self.dlindex != -1:
+            pool.release(LIST, self.dlindex)
+            self.dlindex = -1
+        if self.texpath is not None:
+            pool.release_texture(self.texpath)
+            self.texpath = None
+            self.texindex = -1
+        if self.mesh is not None:
+            self.mesh.delete()
+            self.mesh = None
+
+
+# load the image at path into the bound texture
+def upload_texture(path):
+    from PIL.Image import open as pilopen   # PIL is only needed once something is textured
+    im = pilopen(path)
+    try:
+        ix, iy, image = im.size[0], im.size[1], im.tobytes("raw", "RGB", 0, -1)
+    except SystemError:
+        ix, iy, image = im.size[0], im.size[1], im.tobytes("raw", "RGBX", 0, -1)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)           # set the pixel store to unpack alignment
+    glTexImage2D(                                   # load the texture
+        GL_TEXTURE_2D, 0, 3, ix, iy, 0,
+        GL_RGB, GL_UNSIGNED_BYTE, image
+    )
 
 
 class Material:
@@ -226,3 +365,39 @@ class Material:
         self.diff = d
         self.spec = s
         self.emm  = e
+
+
+# Deep size of the old list-of-tuples layout for the same mesh, for comparison
+def _legacy_nbytes(obj):
+    from sys import getsizeof
+
+    def deep(x):
+        if isinstance(x, (list, tuple)):
+            return getsizeof(x) + sum(deep(i) for i in x)
+        return getsizeof(x)
+
+    faces = [
+        (tuple(obj.face_verts[a:b].tolist()), tuple(obj.face_uvs[a:b].tolist()), int(n))
+        for a, b, n in zip(obj.face_offsets[:-1], obj.face_offsets[1:], obj.face_norms)
+    ]
+    names = [obj.mat_names[m] if m >= 0 else None for m in obj.face_mats]
+    return sum((
+        deep([tuple(v) for v in obj.verts.tolist()]),
+        deep([tuple(v) for v in obj.norms.tolist()]),
+        deep([tuple(v) for v in obj.uvs.tolist()]),
+        deep([tuple(e) for e in obj.edges.tolist()]),
+        deep(faces),
+        getsizeof(names)    # names themselves are shared strings
+    ))
+
+
+# Memory report for every mesh in wfobjs: python -m utils.DisplayObj
+if __name__ == "__main__":
+    import glob
+
+    print(f"{'mesh':<22}{'verts':>7}{'faces':>7}{'lists (B)':>12}{'arrays (B)':>12}{'saved':>8}")
+    for fname in sorted(glob.glob("./wfobjs/*.obj")):
+        d = DisplayObj()
+        d.objFileImport(fname[:-4])
+        old, new = _legacy_nbytes(d), d.nbytes()
+        print(f"{os.path.basename(fname):<22}{len(d.verts):>7}{d.num_faces:>7}{old:>12}{new:>12}{1 - new / old:>8.0%}")
@@ -0,0 +1,113 @@
+"""
+File: Input.py
+Author: Jay Kmetz
+"""
+import json
+import os
+
+
+# ACTION BITS
+# Every action gets one bit so everything held during a tick fits in a single int
+ROLL_LEFT       = 1 << 0
+ROLL_RIGHT      = 1 << 1
+ROLL_CENTER     = 1 << 2
+PITCH_LEFT      = 1 << 3
+PITCH_RIGHT     = 1 << 4
+PITCH_CENTER    = 1 << 5
+YAW_LEFT        = 1 << 6
+YAW_RIGHT       = 1 << 7
+YAW_CENTER      = 1 << 8
+THRUST_UP       = 1 << 9
+THRUST_DOWN     = 1 << 10
+THRUST_CENTER   = 1 << 11
+VIEW_FL         = 1 << 12
+VIEW_BR         = 1 << 13
+VIEW_T          = 1 << 14
+VIEW_STATIC     = 1 << 15
+VIEW_ORBIT      = 1 << 16
+NEW_LEVEL       = 1 << 17
+AUTOPILOT       = 1 << 18
+REWIND          = 1 << 19
+QUICKSAVE       = 1 << 20
+QUICKLOAD       = 1 << 21
+DEBUG_DRAW      = 1 << 22
+
+# action name (as used in the key binding table) -> action bit
+ACTIONS = {
+    'RL': ROLL_LEFT,
+    'RR': ROLL_RIGHT,
+    'RC': ROLL_CENTER,
+    'PL': PITCH_LEFT,
+    'PR': PITCH_RIGHT,
+    'PC': PITCH_CENTER,
+    'YL': YAW_LEFT,
+    'YR': YAW_RIGHT,
+    'YC': YAW_CENTER,
+    'TU': THRUST_UP,
+    'TD': THRUST_DOWN,
+    'TC': THRUST_CENTER,
+    'VFL': VIEW_FL,
+    'VBR': VIEW_BR,
+    'VT': VIEW_T,
+    'VS': VIEW_STATIC,
+    'VO': VIEW_ORBIT,
+    'NL': NEW_LEVEL,
+    'AP': AUTOPILOT,
+    'RW': REWIND,
+    'QS': QUICKSAVE,
+    'QL': QUICKLOAD,
+    'DD': DEBUG_DRAW
+}
+
+
+class InputMap:
+    def __init__(self, bindings):
+        self.bindings = dict(bindings)  # action name -> key code
+        # compiled once: key code -> action bit
+        self.dispatch = {key: ACTIONS[name] for name, key in self.bindings.items()}
+
+    # Build a map from the default bindings, overridden by a JSON file of {"action name": key} if it exists.
+    # Keys can be pygame key codes or pygame key names such as "a" or "up".
+    @staticmethod
+    def load(defaults, fname=None):
+        bindings = dict(defaults)
+        if fname and os.path.exists(fname):
+            with open(fname) as fp:
+                overrides = json.load(fp)
+            for name, key in overrides.items():
+                if name not in ACTIONS:
+                    raise KeyError(f"{fname}: unknown action '{name}'")
+                if isinstance(key, str):
+                    import pygame
+                    key = pygame.key.key_code(key)
+                bindings[name] = key
+        return InputMap(bindings)
+
+
+class InputState:
+    __slots__ = ("held", "pressed", "released", "tick")
+
+    def __init__(self):
+        self.held = 0       # actions held down at the end of the tick
+        self.pressed = 0    # actions that went down during the tick
+        self.released = 0   # actions that went up during the tick
+        self.tick = 0
+
+    # clear the edges and start collecting the next tick
+    def begin_tick(self):
+        self.pressed = 0
+        self.released = 0
+        self.tick += 1
+
+    def press(self, bit):
+        self.held |= bit
+        self.pressed |= bit
+
+    def release(self, bit):
+        self.held &= ~bit
+        self.released |= bit
+
+    # everything that was down at some point this tick, so a tap shorter than a frame still counts
+    @property
+    def active(self):
+        return self.held | self.pressed
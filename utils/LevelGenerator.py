@@ -0,0 +1,232 @@
+"""
+File: LevelGenerator.py
+Author: Jay Kmetz
+"""
+import struct
+
+import numpy as np
+
+from utils.util import logistic_approaches
+
+
+# GLOBALS
+LEVEL_MAGIC = b'ISJL'
+LEVEL_VERSION = 1
+# magic, version, seed, level, planet position, radius, landing point, then the table lengths:
+# variant seeds, orbiters, belts, asteroids
+LEVEL_HEADER = struct.Struct('<4sHQI3ff3fHHHI')
+
+NOISE = 40              # how far free asteroids stray from the line to the planet
+ASTEROID_SPEED = .03    # Asteroid.ASTEROID_VEL
+VARIANTS = 6            # distinct asteroid shapes per level
+SEED_POOL = 32          # variant seeds come from this pool so the mesh cache stays warm
+
+# Planets and moons on spinning pivots. Parents come before their children, -1 is the target planet.
+ORBITER = np.dtype([('parent', 'i1'), ('distance', '<f4'), ('radius', '<f4'), ('plane', '<f4', (4,)), ('rate', '<f4')])
+# Asteroid rings turning around an orbiter
+BELT = np.dtype([('parent', 'i1'), ('plane', '<f4', (4,)), ('rate', '<f4')])
+# pos is in the belt pivot's frame for belt asteroids, belt is -1 for the free ones drifting at vel.
+# aa is the axis and angle of the asteroid's rotation, variant indexes the variant seeds.
+ASTEROID = np.dtype([('pos', '<f4', (3,)), ('aa', '<f4', (4,)), ('vel', '<f4', (3,)), ('variant', 'u1'), ('belt', 'i1')])
+
+
+# points for rho, theta and phi arrays, (..., 3)
+def spherical_to_cartesian(rho, theta, phi):
+    return np.stack((rho * np.sin(phi) * np.cos(theta), rho * np.sin(phi) * np.sin(theta), rho * np.cos(phi)), axis=-1)
+
+
+# unit quaternions for rows of rotation axes and angles, like quat.axisangle_to_q
+def axisangle_quats(axes, angles):
+    length = np.linalg.norm(axes, axis=1, keepdims=True)
+    axes = np.divide(axes, length, out=np.zeros_like(axes), where=length > 0)
+    return np.column_stack((np.cos(angles / 2), axes * np.sin(angles / 2)[:, None]))
+
+
+# rows of quaternion products, like quat.q_mult
+def q_mult(q1, q2):
+    w1, x1, y1, z1 = q1.T
+    w2, x2, y2, z2 = q2.T
+    return np.column_stack((
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2,
+        w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
+    ))
+
+
+# Everything a level is made of as plain numbers: the target planet, its moons and neighbours, their belts,
+# and every asteroid. Arrays are stored at the width they are saved at, so a level read back from a file
+# is the same level.
+class Level:
+    def __init__(self, seed, number, planet_pos, planet_radius, landing_point, variant_seeds, orbiters, belts, asteroids):
+        self.seed = seed
+        self.number = number
+        self.planet_pos = np.asarray(planet_pos, dtype='<f4')
+        self.planet_radius = np.float32(planet_radius)
+        self.landing_point = np.asarray(landing_point, dtype='<f4')    # from the planet's centre
+        self.variant_seeds = np.asarray(variant_seeds, dtype='<u2')
+        self.orbiters = np.asarray(orbiters, dtype=ORBITER)
+        self.belts = np.asarray(belts, dtype=BELT)
+        self.asteroids = np.asarray(asteroids, dtype=ASTEROID)
+
+    def __eq__(self, other):
+        return isinstance(other, Level) and self.tobytes() == other.tobytes()
+
+    def tobytes(self):
+        header = LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, self.seed, self.number, *self.planet_pos,
+                                   self.planet_radius, *self.landing_point, len(self.variant_seeds),
+                                   len(self.orbiters), len(self.belts), len(self.asteroids))
+        return b''.join((header, self.variant_seeds.tobytes(), self.orbiters.tobytes(),
+                         self.belts.tobytes(), self.asteroids.tobytes()))
+
+    @staticmethod
+    def frombytes(data):
+        (magic, version, seed, number, px, py, pz, radius, lx, ly, lz,
+         nvariants, norbiters, nbelts, nasteroids) = LEVEL_HEADER.unpack_from(data)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            raise ValueError(f"not a version {LEVEL_VERSION} level")
+        offset = LEVEL_HEADER.size
+        tables = []
+        for dtype, count in (('<u2', nvariants), (ORBITER, norbiters), (BELT, nbelts), (ASTEROID, nasteroids)):
+            tables.append(np.frombuffer(data, dtype, count, offset))
+            offset += tables[-1].nbytes
+        return Level(seed, number, (px, py, pz), radius, (lx, ly, lz), *tables)
+
+    def save(self, fname):
+        with open(fname, 'wb') as fp:
+            fp.write(self.tobytes())
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as fp:
+            return Level.frombytes(fp.read())
+
+
+# Levels from a seed. Every level number gets its own random stream, so any level can be made on its own,
+# in any order, and comes out the same every time. Everything is sampled a table at a time.
+class LevelGenerator:
+    def __init__(self, seed, variants=VARIANTS, seed_pool=SEED_POOL):
+        self.seed = seed
+        self.variants = variants
+        self.seed_pool = seed_pool
+
+    # level number, asteroids overrides how many drift between the ship and the planet
+    def generate(self, number, asteroids=None):
+        rng = np.random.default_rng((self.seed, number))
+
+        # planet, further out every level
+        radius = rng.uniform(16, 25)
+        planet_pos = spherical_to_cartesian(rng.uniform(200 + number * 50, 200 + number * 75),
+                                            rng.uniform(0, 2 * np.pi), rng.uniform(0, np.pi))
+        # landing plane point, moving further out as levels go on
+        lrho = radius * rng.uniform(logistic_approaches(number,     minval=.45, maxval=.95, growth=.91, center=3.6),
+                                    logistic_approaches(number + 1, minval=.45, maxval=.95, growth=.91, center=3.6))
+        landing_point = spherical_to_cartesian(lrho, rng.uniform(0, 2 * np.pi), rng.uniform(0, np.pi))
+
+        # moons around the target, and from level 3 on neighbouring planets with a moon half the time and a belt
+        moons = rng.integers(0, 2 + number // 3)
+        neighbours = min((number - 1) // 2, 3)
+        orbiters = [(-1, radius + rng.uniform(12, 30), rng.uniform(2.5, 5)) for i in range(moons)]
+        belts = []
+        for i in range(neighbours):
+            body = len(orbiters)
+            r = rng.uniform(7, 12)
+            orbiters.append((-1, rng.uniform(70, 130), r))
+            if rng.random() < .5:
+                orbiters.append((body, r + rng.uniform(6, 12), rng.uniform(1.5, 3)))
+            belts.append((body, rng.integers(6, 12 + number), r + rng.uniform(10, 16)))
+        orbiters = np.array(orbiters, dtype=float).reshape(-1, 3)
+
+        otable = np.zeros(len(orbiters), ORBITER)
+        otable['parent'], otable['distance'], otable['radius'] = orbiters.T
+        otable['plane'], otable['rate'] = self.orbits(rng, len(otable))
+        btable = np.zeros(len(belts), BELT)
+        btable['parent'] = [b[0] for b in belts]
+        btable['plane'], btable['rate'] = self.orbits(rng, len(btable))
+
+        # free asteroids somewhere along the line to the planet, at least two more every level
+        n = rng.integers(4 + number * 2, 6 + number * 2) if asteroids is None else asteroids
+        counts = [b[1] for b in belts]
+        atable = np.zeros(n + sum(counts), ASTEROID)
+        free, ringed = atable[:n], atable[n:]
+        free['pos'] = planet_pos * rng.uniform(.1, .9, (n, 1)) + NOISE * rng.uniform(-1, 1, (n, 3))
+        heading = rng.uniform(-1, 1, (n, 3))
+        free['vel'] = ASTEROID_SPEED * heading / np.linalg.norm(heading, axis=1, keepdims=True)
+        free['belt'] = -1
+
+        # belt asteroids evenly round their ring with a little jitter, riding the pivot
+        belt = np.repeat(np.arange(len(belts)), counts)
+        slot = np.arange(len(ringed)) - np.repeat(np.cumsum(counts) - counts, counts)
+        count = np.repeat(counts, counts)
+        ang = 2 * np.pi * slot / np.maximum(count, 1) + rng.uniform(-.1, .1, len(ringed))
+        r = np.repeat([b[2] for b in belts], counts) + rng.uniform(-3, 3, len(ringed))
+        ringed['pos'] = np.column_stack((r * np.cos(ang), rng.uniform(-1.5, 1.5, len(ringed)), r * np.sin(ang)))
+        ringed['belt'] = belt
+
+        atable['aa'] = np.column_stack((rng.uniform(-1, 1, (len(atable), 3)), rng.uniform(0, 2 * np.pi, len(atable))))
+        seeds = rng.choice(self.seed_pool, min(self.variants, self.seed_pool), replace=False)
+        atable['variant'] = rng.integers(0, max(1, len(seeds)), len(atable))
+
+        return Level(self.seed, number, planet_pos, radius, landing_point, seeds, otable, btable, atable)
+
+    # random tilted orbit planes with random starting phases, and rates for orbits taking 40 to 90 seconds
+    # at 60 ticks a second
+    @staticmethod
+    def orbits(rng, n):
+        axes = np.column_stack((rng.uniform(-1, 1, n), np.zeros(n), rng.uniform(-1, 1, n)))
+        tilt = axisangle_quats(axes, rng.uniform(0, .4, n))
+        phase = axisangle_quats(np.tile((0.0, 1.0, 0.0), (n, 1)), rng.uniform(0, 2 * np.pi, n))
+        return q_mult(tilt, phase), 2 * np.pi / (60 * rng.uniform(40, 90, n))
+
+
+# 10k asteroid levels generated with tables against the per asteroid loop initialize_level used, and the
+# level file round trip: python -m utils.LevelGenerator
+if __name__ == "__main__":
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+
+    from utils.quat import normalize
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    reps = 20
+
+    # the old loop, one asteroid at a time with tuple arithmetic
+    def loop_asteroids(ppos, n):
+        out = []
+        for i in range(n):
+            percent = random.uniform(.1, .9)
+            noise = (NOISE * random.uniform(-1, 1), NOISE * random.uniform(-1, 1), NOISE * random.uniform(-1, 1))
+            apos = map(lambda a: a*percent, ppos)
+            apos = tuple(map(sum, zip(apos, noise)))
+            aaa = (random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(0, 2 * np.pi))
+            vel = tuple(map(lambda a: a*ASTEROID_SPEED, normalize(tuple(random.uniform(-1, 1) for i in range(3)))))
+            out.append((apos, aaa, vel))
+        return out
+
+    def best_ms(func):
+        best = float('inf')
+        for i in range(reps):
+            t = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t)
+        return 1000 * best
+
+    gen = LevelGenerator(1234)
+    level = gen.generate(7, count)
+    gen_ms = best_ms(lambda: gen.generate(7, count))
+    loop_ms = best_ms(lambda: loop_asteroids(tuple(level.planet_pos.tolist()), count))
+
+    fname = os.path.join(tempfile.gettempdir(), "level_bench.isjl")
+    save_ms = best_ms(lambda: level.save(fname))
+    load_ms = best_ms(lambda: Level.load(fname))
+    size = os.path.getsize(fname)
+    same = Level.load(fname) == level == gen.generate(7, count)
+    os.remove(fname)
+
+    print(f"level 7 with {len(level.asteroids)} asteroids ({len(level.orbiters)} orbiters, {len(level.belts)} belts)")
+    print(f"generate: {gen_ms:.2f} ms, per asteroid loop: {loop_ms:.1f} ms")
+    print(f"file: {size / 1000:.0f} kB ({size / len(level.asteroids):.0f} bytes an asteroid), "
+          f"save {save_ms:.2f} ms, load {load_ms:.2f} ms, round trip and regeneration identical: {same}")
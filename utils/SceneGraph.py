@@ -0,0 +1,134 @@
+"""
+File: SceneGraph.py
+Author: Jay Kmetz
+"""
+from utils.quat import *
+from utils.util import add_vecs, scalar_mult
+from utils.Transform import Transform
+
+
+class SceneNode:
+    def __init__(self, obj=None, pos=(0, 0, 0), quat=(1, 0, 0, 0), spin=None, drift=False, free=False):
+        self.obj = obj          # object drawn and collided at this node, if any
+        self.local = Transform(pos, quat)   # transform relative to the parent
+        # world transform, cached. Objects render from their own transform so share it.
+        self.world = obj.transform if obj else Transform(pos, quat)
+        self.parent = None
+        self.children = []
+        self.depth = 0
+
+        self.spin = spin        # (axis, radians per tick) the node turns around, orbits hang off spinning pivots
+        self.drift = drift      # move by obj.vel every tick, in the parent's frame
+        self.free = free        # world transform is driven by the object itself (the player ship)
+        self.stamp = -1         # last tick the world transform was recomputed
+
+        if obj is not None:
+            obj.node = self
+
+    @property
+    def moving(self):
+        return self.spin is not None or self.drift
+
+    # recompute this node's world transform from its parent, then do the same for its subtree
+    def refresh(self, stamp):
+        if not self.free:
+            parent = self.parent.world
+            if self.parent.parent is None:  # parent is the root, world is local
+                pos, quat = self.local.pos, self.local.quat
+            else:
+                pos = add_vecs(parent.pos, qv_mult(parent.quat, self.local.pos))
+                quat = q_mult(parent.quat, self.local.quat)
+            if self.obj is not None:
+                self.obj.prev_pos = self.world.pos
+            self.world.pos = pos
+            self.world.quat = quat
+        self.stamp = stamp
+        for child in self.children:
+            child.refresh(stamp)
+
+
+class SceneGraph:
+    def __init__(self):
+        self.root = SceneNode()
+        self.movers = []        # nodes that change every tick
+        self.tick = 0
+        self._moved = []        # nodes recomputed last tick
+        self._objs = {}         # type -> objects in walk order, rebuilt when the tree changes
+
+    def add(self, node, parent=None):
+        parent = parent or self.root
+        node.parent = parent
+        parent.children.append(node)
+        for n in self.walk(node):
+            n.depth = n.parent.depth + 1
+            if n.moving:
+                self.movers.append(n)
+        self.movers.sort(key=lambda n: n.depth)    # shallowest first, see update
+        node.refresh(self.tick)
+        for n in self.walk(node):
+            if n.obj is not None:
+                n.obj.prev_pos = n.world.pos   # placed, not swept into position
+        self._objs = {}
+        return node
+
+    def remove(self, node):
+        node.parent.children.remove(node)
+        gone = set(map(id, self.walk(node)))
+        self.movers = [n for n in self.movers if id(n) not in gone]
+        node.parent = None
+        self._objs = {}
+
+    # every node under start, parents before children
+    def walk(self, start=None):
+        stack = [start or self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    # Advance the moving nodes and recompute world transforms of the subtrees that moved.
+    # Cost follows the number of moving nodes (and what hangs off them), not the scene size.
+    def update(self, dt=1.0):
+        self.tick += 1
+
+        # anything recomputed last tick but not this tick has stopped moving
+        for node in self._moved:
+            if node.obj is not None:
+                node.obj.prev_pos = node.world.pos
+
+        for node in self.movers:
+            if node.spin is not None:
+                axis, rate = node.spin
+                node.local.quat = normalize(q_mult(node.local.quat, axisangle_to_q(axis, rate * dt)))
+            if node.drift:
+                node.local.pos = add_vecs(node.local.pos, scalar_mult(dt, node.obj.vel))
+
+        # shallowest first so each subtree is recomputed once, from its topmost moving node
+        moved = []
+        for node in self.movers:
+            if node.stamp != self.tick:
+                node.refresh(self.tick)
+                moved.extend(self.walk(node))
+        self._moved = moved
+
+    # Recompute the moving subtrees from their local transforms after those were set directly.
+    # Objects are placed rather than swept into position.
+    def reset(self):
+        self.tick += 1
+        for node in self.movers:
+            if node.stamp != self.tick:
+                node.refresh(self.tick)
+                for n in self.walk(node):
+                    if n.obj is not None:
+                        n.obj.prev_pos = n.world.pos
+        self._moved = []
+
+    # objects in the scene, optionally only those of a type
+    def objects(self, kind=object):
+        if kind not in self._objs:
+            self._objs[kind] = [n.obj for n in self.walk() if n.obj is not None and isinstance(n.obj, kind)]
+        return self._objs[kind]
+
+    def render(self):
+        for obj in self.objects():
+            obj.render()
@@ -0,0 +1,68 @@
+"""
+File: Transform.py
+Author: Jay Kmetz
+"""
+import numpy as np
+from OpenGL.GL import *
+
+from utils.quat import q_to_mat4
+
+
+class Transform:
+    def __init__(self, pos=(0, 0, 0), quat=(1, 0, 0, 0)):
+        self._pos = pos         # position
+        self._quat = quat       # orientation quaternion
+        self._mat = None        # cached column major model matrix, ready for glMultMatrixf
+        self.rot_dirty = True   # rotation part of the matrix needs rebuilding
+        self.pos_dirty = True   # translation part of the matrix needs rebuilding
+
+    @property
+    def pos(self):
+        return self._pos
+
+    @pos.setter
+    def pos(self, pos):
+        self._pos = pos
+        self.pos_dirty = True
+
+    @property
+    def quat(self):
+        return self._quat
+
+    @quat.setter
+    def quat(self, quat):
+        self._quat = quat
+        self.rot_dirty = True
+
+    # model matrix, only rebuilt from the quaternion when the orientation changed
+    def matrix(self):
+        if self.rot_dirty:
+            # q_to_mat4 is row major, OpenGL wants column major so store the transpose
+            self._mat = q_to_mat4(self._quat).T.copy()
+            self.rot_dirty = False
+            self.pos_dirty = True
+        if self.pos_dirty:
+            self._mat[3, 0:3] = self._pos   # translation lives in the last row when column major
+            self.pos_dirty = False
+        return self._mat
+
+    # multiply the current OpenGL matrix by this transform, or by a copy of its matrix taken earlier
+    def apply(self, mat=None):
+        glMultMatrixf(self.matrix() if mat is None else mat)
+
+
+# Column major camera matrix equivalent to gluLookAt(eye, center, up)
+def look_at_mat4(eye, center, up):
+    eye = np.asarray(eye, dtype='f')
+    f = np.asarray(center, dtype='f') - eye     # forward
+    f /= np.linalg.norm(f)
+    s = np.cross(f, up)                         # side
+    s /= np.linalg.norm(s)
+    u = np.cross(s, f)                          # recomputed up
+
+    m = np.identity(4, dtype='f')
+    m[0:3, 0] = s
+    m[0:3, 1] = u
+    m[0:3, 2] = -f
+    m[3, 0:3] = -(m[0:3, 0:3].T @ eye)          # move the world by -eye in camera space
+    return m
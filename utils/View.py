@@ -3,6 +3,7 @@ File: View.py
 Author: Jay Kmetz
 """
 from utils.quat import *
+from utils.Transform import look_at_mat4
 
 from OpenGL.GL import *
 from OpenGL.GLU import *
@@ -25,40 +26,38 @@ class View:
         self.st_up = None
         self.orbitr = orbitr
         self.th = 0
+        self._stack_offsets()
 
-    def local_gluLookAt(self, s_pos, s_quat):
-        shipx, shipy, shipz = s_pos
+    # offsets rotated by the ship orientation, stacked so one matrix product handles all three
+    def _stack_offsets(self):
+        self.offsets = np.array((self.posoff, self.lookat, self.upvec), dtype='f')
 
+    # Build the camera matrix directly instead of going through gluLookAt
+    def view_matrix(self, s_pos, s_quat):
         if self.type == View.VT_STATIC: # STATIC VIEW
-            px, py, pz = self.st_pos    # constant position
-            ux, uy, uz = self.st_up     # constant up
-            gluLookAt(
-                px, py, pz,
-                shipx, shipy, shipz,
-                ux, uy, uz)
+            # constant position and up, look at the ship
+            return look_at_mat4(self.st_pos, s_pos, self.st_up)
+
+        rot = q_to_mat4(s_quat)[0:3, 0:3]   # ship orientation as a rotation matrix
+        ship = np.asarray(s_pos, dtype='f')
 
-        elif self.type == View.VT_SHIP_RELATIVE: # SHIP RELATIVE VIEW
-            px, py, pz = qv_mult(s_quat, self.posoff)   # ship orientation with the position offset
-            ex, ey, ez = qv_mult(s_quat, self.lookat)   # lookat with the ship orientation
-            ux, uy, uz = qv_mult(s_quat, self.upvec)    # up vec with the ship orientation
-            gluLookAt(
-                shipx + px, shipy + py, shipz + pz,
-                shipx + ex, shipy + ey, shipz + ez,
-                ux, uy, uz)
+        if self.type == View.VT_SHIP_RELATIVE: # SHIP RELATIVE VIEW
+            # position offset, lookat and up vec with the ship orientation
+            p, e, u = self.offsets @ rot.T
+            return look_at_mat4(ship + p, ship + e, u)
 
         elif self.type == View.VT_ORBIT: # ORBIT VIEW
             py = self.posoff[1] # constant y
             px, pz = (self.orbitr * np.cos(self.th), self.orbitr * np.sin(self.th)) # r,theta -> x,z
-            px, py, pz = qv_mult(s_quat, (px,py,pz))    # multiply the orbit by the orientation
-            self.th = (self.th + np.pi/60) % (2*np.pi)  # add to the thetas and mod 2 pi
+            # multiply the orbit and up by the orientation
+            p, u = np.array(((px, py, pz), self.upvec), dtype='f') @ rot.T
+            return look_at_mat4(ship + p, ship, u)
 
-            ux, uy, uz = qv_mult(s_quat, self.upvec)    # rotate up with ship orientation
+    def local_gluLookAt(self, s_pos, s_quat):
+        glMultMatrixf(self.view_matrix(s_pos, s_quat))
 
-            gluLookAt(
-                shipx + px, shipy + py, shipz + pz,
-                shipx, shipy, shipz,
-                ux, uy, uz
-            )
+        if self.type == View.VT_ORBIT:
+            self.th = (self.th + np.pi/60) % (2*np.pi)  # add to the thetas and mod 2 pi
 
     def get_position(self):
         if self.type in (View.VT_SHIP_RELATIVE, View.VT_STATIC):
@@ -75,3 +74,4 @@ class View:
         self.posoff = v_pos
         self.upvec = v_up
         self.st_up = qv_mult(s_quat, v_up)
+        self._stack_offsets()
@@ -0,0 +1,408 @@
+"""
+File: autopilot.py
+Author: Jay Kmetz
+"""
+import time
+
+import numpy as np
+
+from pyobjs.Planet import Planet
+from pyobjs.Spaceship import Spaceship
+from utils.flight import *
+from utils import kernels
+
+
+# GLOBALS
+PLAN_BUDGET_MS = 5.0    # planning time allowed per tick
+BLOCK = 15              # ticks a sampled control is held
+BLOCKS = 8              # blocks in the planning horizon
+MIN_SAMPLES = 64
+MAX_SAMPLES = 8192
+COST_EVERY = 3          # ticks between evaluations of the shaping costs, contacts are checked every tick
+COST_DECAY = .95        # how fast a slice's measured cost forgets a slow run, per run of that slice
+
+# guidance
+STANDOFF = 15           # height of the point above the landing cap the approach starts from
+CLEARANCE = 10          # how far to pass from the surface on the way there
+APPROACH_CONE = np.pi / 9   # inside this angle of the cap centre the ship descends straight down
+V_MAX = .45             # cruise speed, faster runs out of fuel before the brakes are done
+V_LAND = .08            # touchdown speed
+GAIN = .5               # fraction of the braking limited speed to fly at
+ATTITUDE_ALT = 20       # altitude below which the ship starts to right itself
+
+# cost weights
+W_VEL = 10.0            # velocity error against the guidance velocity, per tick
+W_UP = 2.0              # up vector away from the surface, per tick at touchdown height
+W_FUEL = .5             # per unit of fuel
+W_DIST = .5             # distance left to the cap at the end of the horizon
+LAND_REWARD = 1e4
+CRASH_COST = 2e4        # touched the planet badly
+HIT_COST = 5e3          # per tick inside an obstacle
+EMPTY_COST = 50         # ran out of fuel, costs a health point but refills the tank
+
+# sampling probabilities, rotation (steady, left, right, reset) and thrust (none, forward, back, slow down)
+ROT_CHOICES = np.array((ROT_STEADY, Spaceship.LEFT, Spaceship.RIGHT, ROT_RESET), dtype=np.int8)
+ROT_P = (.4, .2, .2, .2)
+THRUST_CHOICES = np.array((0, Spaceship.THF, Spaceship.THB, THRUST_OPP), dtype=np.int8)
+THRUST_P = (.4, .3, .1, .2)
+MUTATE_P = .25          # chance a warm start control is resampled
+# each choice repeated in proportion to its probability, a uniform index into these draws from them far
+# faster than rng.choice does with p
+ROT_TABLE = np.repeat(ROT_CHOICES, np.round(np.array(ROT_P) * 100).astype(int))
+THRUST_TABLE = np.repeat(THRUST_CHOICES, np.round(np.array(THRUST_P) * 100).astype(int))
+
+
+# Model-predictive landing autopilot. Every BLOCK ticks it commits to the next block of its best plan,
+# and while that block flies it searches for a better plan for the blocks after it: thousands of random
+# control sequences, rolled out together through the batched flight model and scored on the way.
+# The search is sliced across ticks, one rollout tick a slice. Every tick runs one slice, and more only
+# while their measured cost still fits in this tick's budget. The number of sampled sequences follows
+# whatever fit in the budget last time. prime plans the first block outside the frame, which also compiles
+# the kernels and measures the slices.
+class Autopilot:
+    def __init__(self, budget_ms=PLAN_BUDGET_MS, samples=1024, dt=1.0, seed=None):
+        self.budget = budget_ms / 1000
+        self.dt = dt            # the game's time scale
+        self.samples = samples
+        self.rng = np.random.default_rng(seed)
+        self.colr = 0
+        self.slice_cost = {}    # seconds per sample for each kind of slice, decaying from the slowest run
+
+        # stats
+        self.tick_ms = 0.0      # planning time this tick
+        self.avg_tick_ms = 0.0
+        self.max_tick_ms = 0.0
+        self.plan_ms = 0.0      # planning time of the last finished plan
+        self.plans = 0
+        self.misses = 0         # blocks that started before their plan was ready
+        self.prime_ms = 0.0     # time spent on the last untimed first plan
+        self.reset()
+
+    # forget the current plan, after a new level or a teleport
+    def reset(self):
+        self.plan = np.zeros((BLOCKS, 4), dtype=np.int8)
+        self.plan[:, :3] = ROT_RESET
+        self.tick_in_block = 0
+        self.job = None
+        self.next_slice = None  # kind of the job's next slice
+        self.pending = None
+        self.job_time = 0.0
+
+    # Plan all at once and off the tick budget, the search tick would otherwise start on its first call.
+    # The first block holds the reset plan, as it always has, and the blocks after it are planned. The search
+    # runs twice, the first time loads the kernels and the second measures the slices. Called when a level is
+    # loaded or the autopilot engaged, tick does it itself if nobody has.
+    def prime(self, ship, planet, obstacles=()):
+        t = time.perf_counter()
+        self.reset()
+        self.colr = ship.colr
+        for measure in (False, True):
+            job = self._search(FlightState.from_ship(ship), self.plan, planet, obstacles)
+            kind = "start"
+            try:
+                while True:
+                    kind = self._run_slice(job, kind, measure)
+            except StopIteration as done:
+                best = done.value
+        self.pending = np.concatenate((self.plan[:1], best[:-1]))
+        self.prime_ms = 1000 * (time.perf_counter() - t)
+
+    # Run the job's next slice of the given kind and remember what it cost, returns the kind after it.
+    # The cost is this thread's CPU time, time spent preempted by other threads or processes says nothing
+    # about the slice and would keep its estimate out of the budget long after.
+    def _run_slice(self, job, kind, measure=True):
+        t = time.thread_time()
+        try:
+            return next(job)
+        finally:
+            if measure:
+                cost = (time.thread_time() - t) / self.samples
+                self.slice_cost[kind] = max(cost, COST_DECAY * self.slice_cost.get(kind, 0.0))
+
+    # Input bits for this tick. obstacles are ColObjs to steer clear of, they are assumed to keep moving
+    # the way they moved last tick.
+    def tick(self, ship, planet, obstacles=()):
+        if not self.slice_cost:     # never planned, do it before the tick is timed
+            self.prime(ship, planet, obstacles)
+        t0 = time.perf_counter()
+        if self.tick_in_block == 0:
+            self._next_block(ship, planet, obstacles)
+        rot, thrust = self.plan[0, :3], self.plan[0, 3]
+        bits = int(controls_to_bits(rot[None], thrust[None])[0])
+        self.tick_in_block = (self.tick_in_block + 1) % BLOCK
+
+        # spend what is left of the budget on the plan for the next block, a slice at a time while the next
+        # one is expected to fit. The first slice always runs, an estimate left high by one slow run would
+        # otherwise never be measured again and the plan would never finish.
+        if self.job is not None:
+            deadline = t0 + self.budget
+            t = time.perf_counter()
+            try:
+                self.next_slice = self._run_slice(self.job, self.next_slice)
+                while time.perf_counter() + self.slice_cost.get(self.next_slice, 0.0) * self.samples < deadline:
+                    self.next_slice = self._run_slice(self.job, self.next_slice)
+            except StopIteration as done:
+                self.pending = done.value
+                self.job = None
+            self.job_time += time.perf_counter() - t
+            if self.job is None:
+                self._finished()
+
+        self.tick_ms = 1000 * (time.perf_counter() - t0)
+        self.avg_tick_ms += .05 * (self.tick_ms - self.avg_tick_ms)
+        self.max_tick_ms = max(self.max_tick_ms, self.tick_ms)
+        return bits
+
+    def report(self):
+        return (f"{self.samples} samples, {self.avg_tick_ms:.2f} ms/tick (max {self.max_tick_ms:.2f}, "
+                f"budget {1000 * self.budget:.1f}), {self.plans} plans, {self.misses} late, "
+                f"first plan {self.prime_ms:.0f} ms")
+
+    # switch to the plan for the block that starts now and start planning the one after
+    def _next_block(self, ship, planet, obstacles):
+        warm = np.concatenate((self.plan[1:], self.plan[-1:]))
+        if self.job is not None:    # not done in time, keep flying the old plan and sample less
+            self.job.close()
+            self.job = None
+            self.misses += 1
+            self.samples = max(MIN_SAMPLES, int(.7 * self.samples))
+            self.plan = warm
+        elif self.pending is not None:
+            self.plan = self.pending
+        else:
+            self.plan = warm
+        self.pending = None
+        self.job_time = 0.0
+
+        self.colr = ship.colr
+        start = FlightState.from_ship(ship)
+        self.job = self._search(start, self.plan, planet, obstacles)
+        self.next_slice = "start"
+
+    # size the next search by how long this one took against the time a block allows
+    def _finished(self):
+        self.plans += 1
+        self.plan_ms = 1000 * self.job_time
+        available = .8 * self.budget * BLOCK
+        scale = np.clip(available / max(self.job_time, 1e-6), .5, 1.5)
+        self.samples = int(np.clip(self.samples * scale, MIN_SAMPLES, MAX_SAMPLES))
+
+    # random control sequences, half of them variations on the warm start
+    def _candidates(self, warm):
+        n = self.samples
+        ctrl = np.empty((n, BLOCKS, 4), dtype=np.int8)
+        ctrl[:, :, :3] = ROT_TABLE[self.rng.integers(0, len(ROT_TABLE), (n, BLOCKS, 3))]
+        ctrl[:, :, 3] = THRUST_TABLE[self.rng.integers(0, len(THRUST_TABLE), (n, BLOCKS))]
+        half = n // 2
+        keep = self.rng.random((half, BLOCKS, 4)) >= MUTATE_P
+        ctrl[:half] = np.where(keep, warm, ctrl[:half])
+        ctrl[0] = warm
+        ctrl[1, :, :3] = ROT_RESET      # stop turning and slow down
+        ctrl[1, :, 3] = THRUST_OPP
+        ctrl[2, :, :3] = ROT_RESET      # stop turning and coast
+        ctrl[2, :, 3] = 0
+        return ctrl
+
+    # Generator that rolls the candidates out one tick per next() and returns the best sequence. Each next()
+    # yields the kind of slice that comes after it, so its cost can be checked against the time left first.
+    # now is the plan for the current block, the search starts from where it leaves the ship.
+    def _search(self, start, now, planet, obstacles):
+        for i in range(BLOCK):
+            step(start, now[None, 0, :3], now[None, 0, 3], self.dt)
+        yield "sample"
+
+        ctrl = self._candidates(np.concatenate((now[1:], now[-1:])))
+        yield "setup"
+
+        n = len(ctrl)
+        state = FlightState(n)
+        for name in ("pos", "vel", "force", "orient", "rpy", "fuel", "health"):
+            getattr(state, name)[:] = getattr(start, name)
+        goal = _Goal(planet, self.colr)
+        obs = _reachable(obstacles, start, self.colr, self.dt * BLOCK * BLOCKS)
+        cost = np.zeros(n)
+        alive = np.ones(n, dtype=bool)
+
+        t = 0
+        for b in range(BLOCKS):
+            rot, thrust = ctrl[:, b, :3], ctrl[:, b, 3]
+            for i in range(BLOCK):
+                yield "shape" if (t + 1) % COST_EVERY == 0 else "step"
+                t += 1
+                step(state, rot, thrust, self.dt)
+                goal.contact_cost(state, alive, cost)
+                if obs is not None:
+                    _obstacle_cost(state, obs, t, alive, cost)
+                if t % COST_EVERY == 0:
+                    goal.shaping_cost(state, alive, cost, COST_EVERY)
+        yield "finish"
+
+        used = start.fuel[0] - state.fuel + Spaceship.FUEL * (start.health[0] - state.health)
+        cost += W_FUEL * used + EMPTY_COST * (start.health[0] - state.health)
+        cost += alive * W_DIST * goal.distance_left(state.pos)
+        return ctrl[np.argmin(cost)]
+
+
+# Target planet geometry for scoring: the landing cap and the guidance velocity towards it
+class _Goal:
+    def __init__(self, planet, colr):
+        self.center = np.asarray(planet.pos, dtype=float)
+        lp = np.asarray(planet.landingplanept, dtype=float)
+        self.normal = lp / np.linalg.norm(lp)
+        self.touch = planet.radius + colr   # centre distance at contact
+        self.cap_cos = min(np.linalg.norm(lp) / planet.radius, 1.0)
+        self.cap = self.center + self.normal * self.touch               # where to touch down
+        self.entry = self.center + self.normal * (self.touch + STANDOFF)    # where to start descending
+        side = np.cross(self.normal, (1.0, 0.0, 0.0))
+        if np.linalg.norm(side) < .1:
+            side = np.cross(self.normal, (0.0, 1.0, 0.0))
+        self.side = side / np.linalg.norm(side)     # way around when the ship is right behind the planet
+        self.cone_cos = np.cos(APPROACH_CONE)
+
+    # landings and crashes this tick, those rollouts stop scoring
+    def contact_cost(self, state, alive, cost):
+        rel = state.pos - self.center
+        r2 = rel[:, 0] * rel[:, 0] + rel[:, 1] * rel[:, 1] + rel[:, 2] * rel[:, 2]
+        contact = alive & (r2 <= self.touch * self.touch)
+        if not contact.any():
+            return
+        idx = np.flatnonzero(contact)
+        rel = rel[idx]
+        r = np.sqrt(r2[idx])
+        speed = np.linalg.norm(state.vel[idx], axis=1)
+        up = up_vectors(state.orient[idx])
+        up_cos = np.einsum('ij,ij->i', up, rel) / (np.linalg.norm(up, axis=1) * r)
+        good = (speed <= Planet.MAX_ACCEPTABLE_LANDING_VELOCITY) & (up_cos >= np.cos(Planet.LANDING_ANGLE_TOLERANCE)) & (rel @ self.normal >= r * self.cap_cos)
+        cost[idx] += np.where(good, -LAND_REWARD, CRASH_COST)
+        alive[idx] = False
+
+    # guidance point for every position: the cap from inside the approach cone, otherwise the entry point
+    # above it, or a point part way round when the planet is in the way
+    def _waypoints(self, pos):
+        rel = pos - self.center
+        r = np.linalg.norm(rel, axis=1)
+        cos = rel @ self.normal / r
+        to_entry = self.entry - pos
+        along = np.clip(-np.einsum('ij,ij->i', rel, to_entry) / np.einsum('ij,ij->i', to_entry, to_entry), 0, 1)
+        closest = rel + along[:, None] * to_entry
+        blocked = np.einsum('ij,ij->i', closest, closest) < (self.touch + CLEARANCE) ** 2
+        around = rel / r[:, None] + self.normal + 1e-3 * self.side
+        around = self.center + around / np.linalg.norm(around, axis=1)[:, None] * (self.touch + STANDOFF + CLEARANCE)
+        inside = cos >= self.cone_cos
+        target = np.where(inside[:, None], self.cap, np.where(blocked[:, None], around, self.entry))
+        beyond = np.where(inside, 0.0, np.where(blocked, 2 * STANDOFF, STANDOFF))
+        return target, beyond
+
+    def distance_left(self, pos):
+        target, beyond = self._waypoints(pos)
+        return np.linalg.norm(target - pos, axis=1) + beyond
+
+    # following the guidance velocity and, near the planet, keeping the up vector off the surface
+    def shaping_cost(self, state, alive, cost, ticks):
+        target, beyond = self._waypoints(state.pos)
+        to = target - state.pos
+        d = np.linalg.norm(to, axis=1)
+        speed = np.clip(GAIN * np.sqrt(2 * Spaceship.PACC * (d + beyond)), V_LAND, V_MAX)
+        err = state.vel - to * (speed / np.maximum(d, 1e-9))[:, None]
+        cost += alive * (ticks * W_VEL) * np.einsum('ij,ij->i', err, err)
+
+        rel = state.pos - self.center
+        r = np.linalg.norm(rel, axis=1)
+        low = np.clip(1 - (r - self.touch) / ATTITUDE_ALT, 0, 1)    # 0 at ATTITUDE_ALT up to 1 at the surface
+        near = alive & (low > 0)
+        if near.any():
+            up = up_vectors(state.orient[near])
+            up_cos = np.einsum('ij,ij->i', up, rel[near]) / r[near]
+            cost[near] += ticks * W_UP * low[near] ** 2 * (1 - up_cos)
+
+
+# positions, per tick motion and squared contact radii of the obstacles the ship could get to within ticks, or None
+def _reachable(obstacles, start, colr, ticks):
+    if not obstacles:
+        return None
+    pos = np.array([o.pos for o in obstacles], dtype=float)
+    vel = np.array([o.step_delta() for o in obstacles], dtype=float)  # drifting, orbiting or riding a belt
+    rad = np.array([o.colr for o in obstacles], dtype=float) + colr
+    speed = np.linalg.norm(start.vel[0])
+    reach = speed * ticks + .5 * Spaceship.PACC * ticks * ticks + np.linalg.norm(vel, axis=1) * ticks + rad
+    near = np.linalg.norm(pos - start.pos[0], axis=1) <= reach
+    if not near.any():
+        return None
+    # the search starts a block from now
+    return pos[near] + BLOCK * vel[near], vel[near], rad[near] ** 2
+
+
+def _obstacle_cost(state, obs, t, alive, cost):
+    pos, vel, rad2 = obs
+    if kernels.ENABLED:
+        cost += (alive & kernels.obstacle_hits(state.pos, pos, vel, float(t), rad2)) * HIT_COST
+        return
+    d = state.pos[:, None, :] - (pos + t * vel)[None]
+    hit = (np.einsum('nmk,nmk->nm', d, d) <= rad2).any(axis=1)
+    cost += (alive & hit) * HIT_COST
+
+
+# Headless landing runs: python -m utils.autopilot [runs]
+# Planets are placed the way game.py places the first levels, and the ship is flown by the batched
+# flight model, which matches Spaceship.update. Touchdowns are judged by Planet.is_good_landing where the
+# ship touched, like the game does.
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import sys
+    from types import SimpleNamespace
+
+    from utils.util import sweep_spheres
+
+    class SimShip:
+        colr = 4.42     # Spaceship.colr for wfobjs/spaceship
+
+        def __init__(self):
+            self.state = FlightState(1)
+
+        def __getattr__(self, name):
+            return getattr(self.state, name)[0]
+
+    # just the planet's geometry and its landing test
+    class SimPlanet(SimpleNamespace):
+        is_landing_area_pt = Planet.is_landing_area_pt
+        is_good_landing = Planet.is_good_landing
+
+    def scenario(rng, level):
+        radius = rng.uniform(16, 25)
+        dist = rng.uniform(200 + level * 50, 200 + level * 75)
+        pos = rng.normal(size=3)
+        lp = rng.normal(size=3)
+        lp *= radius * rng.uniform(.45, .8) / np.linalg.norm(lp)
+        return SimPlanet(pos=tuple(pos / np.linalg.norm(pos) * dist), radius=radius, landingplanept=tuple(lp))
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+    landed = 0
+    worst_ms = 0.0
+    print(f"{'run':>4}{'result':>10}{'ticks':>7}{'speed':>8}{'angle':>8}{'fuel':>7}{'hp':>4}  planning")
+    for run in range(runs):
+        planet = scenario(rng, 1 + run % 3)
+        ship = SimShip()
+        pilot = Autopilot(seed=run)
+        pilot.prime(ship, planet)   # the game does this while the level loads
+        result, angle = "timeout", float("nan")
+        for t in range(6000):
+            rot, thrust = bits_to_controls(np.array([pilot.tick(ship, planet)]))
+            prev = ship.pos.copy()
+            step(ship.state, rot, thrust)
+            toi = sweep_spheres(prev, ship.pos - prev, ship.colr, planet.pos, (0, 0, 0), planet.radius)[0]
+            if toi != float("inf"):
+                s_pos = tuple(prev + toi * (ship.pos - prev))
+                rel = np.subtract(s_pos, planet.pos)
+                up = up_vectors(ship.state.orient)[0]
+                angle = np.arccos(up @ rel / (np.linalg.norm(up) * np.linalg.norm(rel)))
+                with contextlib.redirect_stdout(io.StringIO()):     # it prints what it judged
+                    good, dmgtxt = planet.is_good_landing(s_pos, np.linalg.norm(ship.vel), tuple(up))
+                result = "landed" if good else "crashed"
+                landed += good
+                break
+        speed = np.linalg.norm(ship.vel)
+        worst_ms = max(worst_ms, pilot.max_tick_ms)
+        print(f"{run:>4}{result:>10}{t:>7}{speed:>8.3f}{np.degrees(angle):>8.1f}{ship.fuel:>7.1f}{ship.health:>4}  {pilot.report()}")
+    print(f"landed {landed}/{runs}, slowest tick {worst_ms:.2f} ms against a {PLAN_BUDGET_MS} ms budget")
@@ -0,0 +1,345 @@
+"""
+File: capture.py
+Author: Jay Kmetz
+"""
+import ctypes
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from OpenGL.GL import *
+
+from utils.glpool import pool, BUFFER
+
+
+# GLOBALS
+RING_SLOTS = 4          # pixel buffers in flight between the GPU, the writer and the next read
+CAPTURE_FPS = 60        # frames taken a second at most, None takes every frame drawn
+MAP_LAG = 2             # frames a read is left to finish when the driver has no fences
+FRAME_PATTERN = "frame_{:06d}.png"  # file names in a capture directory
+PNG_LEVEL = 1           # zlib level for PNG frames, fast beats small when keeping up with the game
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.webm', '.avi', '.mov')
+RAW_EXTENSION = '.rgba'     # frames appended to one file as they come, cheapest to keep up with, encode later
+# raw RGBA frames piped in bottom row first, the way OpenGL reads them
+ENCODER = ("ffmpeg", "-loglevel", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgba", "-s", "{width}x{height}",
+           "-r", "{fps}", "-i", "-", "-vf", "vflip", "-pix_fmt", "yuv420p", "{path}")
+TIMING_SAMPLES = 600    # per frame overheads kept for the report
+
+FREE, READING, WRITING = range(3)   # slot states
+
+
+# One pixel buffer of the ring and the frame in it
+class Slot:
+    __slots__ = ('handle', 'capacity', 'size', 'state', 'fence', 'frame', 'issued')
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.capacity = 0       # bytes allocated
+        self.size = (0, 0)      # of the frame in it
+        self.state = FREE
+        self.fence = None
+        self.frame = 0
+        self.issued = 0         # grab count when the read went in
+
+
+# Frames of the window read back without waiting on them. Each grab asks for the back buffer to be copied
+# into the next free pixel buffer of a small ring and returns, the copy is mapped a frame or two later once
+# its fence has passed, and the mapped memory itself goes to a writer thread that saves it as an image or
+# pipes it to an encoder. The buffer is unmapped and reused when the writer gives it back. All the GL work
+# stays on the thread that owns the context.
+# With drop on, a frame that finds every buffer busy is skipped rather than holding up the game, with it
+# off the frame waits for the writer.
+class FrameCapture:
+    def __init__(self, path, width, height, fps=CAPTURE_FPS, slots=RING_SLOTS, drop=True, encoder=ENCODER):
+        self.width = width
+        self.height = height
+        self.interval = 1 / fps if fps else 0
+        self.fps = fps or 60
+        self.drop = drop
+        self.fences = bool(glFenceSync) and bool(glClientWaitSync)
+        self.slots = [Slot(pool.gen(BUFFER, self, shared=True)) for i in range(slots)]
+        self.work = queue.Queue()       # slots mapped for the writer, None stops it
+        self.done = queue.Queue()       # slots the writer is finished with
+        self.grabs = 0
+        self.next_due = 0.0
+        self.captured = self.written = self.dropped = 0
+        self.off_size = 0               # of the dropped, frames not at the stream's size
+        self.overhead = deque(maxlen=TIMING_SAMPLES)    # render thread ms per grab
+        self.write_ms = deque(maxlen=TIMING_SAMPLES)    # writer ms per frame
+        self.backlog = 0                # most frames queued for the writer at once
+        self.error = None
+
+        self.path = path
+        self.proc = None
+        self.stream_size = None         # encoder and raw streams take one frame size throughout, set by _read
+        ext = os.path.splitext(path)[1].lower()
+        self.raw = None
+        if ext in VIDEO_EXTENSIONS:
+            if shutil.which(encoder[0]) is None:
+                raise RuntimeError(f"encoder '{encoder[0]}' not found")
+            self.encoder = encoder
+        elif ext == RAW_EXTENSION:
+            self.encoder = None
+            self.raw = open(path, 'wb')
+        else:
+            self.encoder = None
+            self.pattern = path if '{' in path else os.path.join(path, FRAME_PATTERN)
+            os.makedirs(os.path.dirname(self.pattern) or '.', exist_ok=True)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    # None, with the reason printed, if the capture can't be set up
+    @staticmethod
+    def create(path, width, height, **kwargs):
+        try:
+            return FrameCapture(path, width, height, **kwargs)
+        except Exception as e:     # no pixel buffers, no encoder, no room for the frames
+            print(f"Capture unavailable: {str(e).splitlines()[0]}")
+            return None
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+
+    # Take the frame just drawn, call it before the buffers are flipped. Returns at once unless drop is off
+    # and the writer is a whole ring behind.
+    def grab(self):
+        t = time.perf_counter()
+        self.grabs += 1
+        self._collect(wait=False)
+        if t >= self.next_due:
+            self.next_due = max(self.next_due + self.interval, t) if self.interval else 0
+            self._read()
+        self.overhead.append(1000 * (time.perf_counter() - t))
+
+    # start copying the back buffer into a free slot
+    def _read(self):
+        size = (self.width, self.height)
+        if (self.encoder or self.raw) and self.stream_size not in (None, size):
+            self.dropped += 1       # the stream's frame size can't change, frames at another size are left out
+            self.off_size += 1
+            return
+        slot = self._free_slot()
+        if slot is None:
+            self.dropped += 1
+            return
+        if self.encoder or self.raw:
+            self.stream_size = size     # fixed by the first frame read, not the first one the writer gets to
+
+        nbytes = 4 * size[0] * size[1]
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, slot.handle)
+        if slot.capacity < nbytes:
+            glBufferData(GL_PIXEL_PACK_BUFFER, nbytes, None, GL_STREAM_READ)
+            slot.capacity = nbytes
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        glReadPixels(0, 0, *size, GL_RGBA, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        if self.fences:
+            slot.fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        slot.size = size
+        slot.state = READING
+        slot.frame = self.captured
+        slot.issued = self.grabs
+        self.captured += 1
+
+    # a slot to read into, None if they are all busy and frames are being dropped
+    def _free_slot(self):
+        while True:
+            for slot in self.slots:
+                if slot.state == FREE:
+                    return slot
+            if self.drop:
+                return None
+            self._collect(wait=True)
+
+    # Unmap what the writer gave back and hand finished reads to it, oldest first. wait blocks until a read
+    # finishes or, with none left to finish, until the writer gives something back.
+    def _collect(self, wait):
+        self._unmap(block=False)
+        if not self._map(block=wait) and wait:
+            self._unmap(block=True)
+
+    def _unmap(self, block):
+        try:
+            slot = self.done.get(timeout=1) if block else self.done.get_nowait()
+            while True:
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, slot.handle)
+                glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+                slot.state = FREE
+                slot = self.done.get_nowait()
+        except queue.Empty:
+            pass
+
+    # map finished reads for the writer, True if there were any
+    def _map(self, block):
+        mapped = False
+        for slot in sorted((s for s in self.slots if s.state == READING), key=lambda s: s.frame):
+            if not self._finished(slot, block):
+                break   # later reads can't be done before this one
+            nbytes = 4 * slot.size[0] * slot.size[1]
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, slot.handle)
+            ptr = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, nbytes, GL_MAP_READ_BIT)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            mapped = True
+            if not ptr:
+                self.dropped += 1
+                slot.state = FREE
+                continue
+            pixels = np.frombuffer((ctypes.c_ubyte * nbytes).from_address(ctypes.cast(ptr, ctypes.c_void_p).value),
+                                   dtype=np.uint8)
+            slot.state = WRITING
+            self.work.put((slot, pixels))
+            self.backlog = max(self.backlog, self.work.qsize())
+            block = False   # only wait for the oldest
+        return mapped
+
+    def _finished(self, slot, block):
+        if slot.fence is None:
+            return block or self.grabs - slot.issued >= MAP_LAG
+        status = glClientWaitSync(slot.fence, GL_SYNC_FLUSH_COMMANDS_BIT, 1_000_000_000 if block else 0)
+        if status in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+            glDeleteSync(slot.fence)
+            slot.fence = None
+            return True
+        return False
+
+    # writer thread: mapped frames in, files or encoder input out
+    def _write(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            slot, pixels = item
+            item = None
+            t = time.perf_counter()
+            try:
+                if self.error is None:
+                    self._save(slot, pixels)
+                    self.written += 1
+            except Exception as e:     # disk full, encoder gone
+                self.error = str(e).splitlines()[0] if str(e) else type(e).__name__
+            self.write_ms.append(1000 * (time.perf_counter() - t))
+            pixels = None   # nothing may hold on to the memory once it goes back to be unmapped
+            self.done.put(slot)
+
+    def _save(self, slot, pixels):
+        width, height = slot.size
+        if self.raw is not None:
+            self.raw.write(pixels)
+            return
+        if self.encoder is None:
+            from PIL import Image
+            image = Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, -1)   # rows bottom up
+            image.save(self.pattern.format(slot.frame), compress_level=PNG_LEVEL)
+            return
+        if self.proc is None:
+            self.proc = subprocess.Popen([arg.format(width=width, height=height, fps=self.fps, path=self.path)
+                                          for arg in self.encoder], stdin=subprocess.PIPE)
+        self.proc.stdin.write(pixels)
+
+    # Write out everything still in flight, stop the writer and free the buffers
+    def close(self):
+        while any(s.state in (READING, WRITING) for s in self.slots) and self.thread.is_alive():
+            self._collect(wait=True)
+        self.work.put(None)
+        self.thread.join()
+        self._collect(wait=False)
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+        if self.raw is not None:
+            self.raw.close()
+        for slot in self.slots:
+            if slot.fence is not None:
+                glDeleteSync(slot.fence)
+            pool.release(BUFFER, slot.handle)
+        self.slots = []
+
+    def report(self):
+        over = np.array(self.overhead) if self.overhead else np.zeros(1)
+        text = (f"{self.captured} frames to {self.path}, {self.written} written, {self.dropped} dropped"
+                f"{f' ({self.off_size} resized)' if self.off_size else ''}, "
+                f"{over.mean():.2f} ms a frame on the render thread (p95 {np.percentile(over, 95):.2f})")
+        if self.write_ms:
+            text += f", writer {np.mean(self.write_ms):.1f} ms a frame, backlog {self.backlog}"
+        if self.error:
+            text += f", stopped: {self.error}"
+        return text
+
+
+# A scene drawn at 720p with no capture, a glReadPixels after every frame, and the pixel buffer ring, on an
+# offscreen context: PYOPENGL_PLATFORM=egl python -m utils.capture [frames] [output]
+if __name__ == "__main__":
+    import sys
+    import tempfile
+
+    from OpenGL.GLU import gluPerspective, gluLookAt
+
+    from utils.util import offscreen_context
+    from utils import capture   # the pool and classes the game uses, not this __main__ copy
+    from pyobjs.Asteroid import Asteroid
+    from pyobjs.Planet import Planet
+
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    out = sys.argv[2] if len(sys.argv) > 2 else os.path.join(tempfile.mkdtemp(), "frames")
+    width, height = 1280, 720
+    offscreen_context(width, height)
+    glMatrixMode(GL_PROJECTION)
+    gluPerspective(45, width / height, 0.1, 1000.0)
+    glMatrixMode(GL_MODELVIEW)
+    gluLookAt(0, 20, 90, 0, 0, 0, 0, 1, 0)
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+
+    scene = [Planet((0, 15, 0), radius=20)] + [Asteroid((6 * i - 30, 0, 30), variant=(i, 2)) for i in range(11)]
+
+    def draw():
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        for obj in scene:
+            obj.render()
+
+    def run(grab=None):
+        times = []
+        for i in range(frames):
+            t = time.perf_counter()
+            draw()
+            if grab:
+                grab()
+            glFinish()      # stands in for the buffer swap, which waits on the frame
+            times.append(1000 * (time.perf_counter() - t))
+        return np.mean(times)
+
+    # what grabbing after the flip used to cost: wait for the frame, copy it out, write it on the spot
+    def sync_grab(fname):
+        def grab():
+            pixels = glReadPixels(0, 0, width, height, GL_RGBA, GL_UNSIGNED_BYTE)
+            if fname.endswith(RAW_EXTENSION):
+                with open(fname, 'ab') as fp:
+                    fp.write(pixels)
+            else:
+                from PIL import Image
+                Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, -1).save(
+                    fname, compress_level=PNG_LEVEL)
+        return grab
+
+    os.makedirs(out, exist_ok=True)
+    run()
+    plain = run()
+    print(f"{frames} frames at {width}x{height}, {plain:.1f} ms a frame drawing")
+    for name, target in (("png", out), ("raw", os.path.join(out, "frames" + RAW_EXTENSION))):
+        sync = run(sync_grab(os.path.join(out, "sync" + (RAW_EXTENSION if name == "raw" else ".png"))))
+        cap = capture.FrameCapture(target, width, height, fps=None)
+        ring = run(cap.grab)
+        cap.close()
+        print(f"{name}: capture adds {sync - plain:.1f} ms a frame reading and writing synchronously, "
+              f"{ring - plain:.1f} ms with the ring")
+        print("  " + cap.report())
+    print(f"{len([f for f in os.listdir(out) if f.startswith('frame_')])} png frames and "
+          f"{os.path.getsize(os.path.join(out, 'frames' + RAW_EXTENSION)) // (4 * width * height)} raw frames in {out}")
@@ -0,0 +1,240 @@
+"""
+File: debugdraw.py
+Author: Jay Kmetz
+"""
+import numpy as np
+from OpenGL.GL import *
+
+
+# GLOBALS
+CATEGORIES = ('vectors', 'axes', 'colliders', 'boxes', 'landing', 'markers')
+CAPACITY = 1 << 14      # line vertices to start with, doubles when a frame needs more
+SEGMENTS = 24           # line segments per circle
+FONT_SIZE = 18
+
+# unit circle in the xz plane as line segment endpoints, (SEGMENTS * 2, 3)
+_ang = np.linspace(0, 2 * np.pi, SEGMENTS + 1)
+_ring = np.stack((np.cos(_ang), np.zeros_like(_ang), np.sin(_ang)), axis=1)
+CIRCLE = np.stack((_ring[:-1], _ring[1:]), axis=1).reshape(-1, 3)
+# three great circles, one round each axis
+SPHERE = np.concatenate((CIRCLE, CIRCLE[:, [1, 0, 2]], CIRCLE[:, [0, 2, 1]]))
+# the 12 edges of the unit cube from 0 to 1
+_corners = np.array([(x, y, z) for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=float)
+BOX = _corners[[0, 1, 0, 2, 0, 4, 1, 3, 1, 5, 2, 3, 2, 6, 3, 7, 4, 5, 4, 6, 5, 7, 6, 7]]
+
+
+# rows of RGBA for n items from one color or one per item, RGB gets full alpha
+def _rgba(color, n):
+    color = np.asarray(color, dtype=np.float32)
+    if color.shape[-1] == 3:
+        color = np.concatenate((color, np.ones(color.shape[:-1] + (1,), dtype=np.float32)), axis=-1)
+    return np.broadcast_to(color, (n, 4))
+
+
+# Lines, circles, spheres, boxes and text markers collected over a frame into one vertex and one color array
+# and drawn with a single glDrawArrays. Everything submitted to a category that is switched off, or while the
+# whole thing is off, returns before doing any work. Submit from the thread that flushes.
+class DebugDraw:
+    def __init__(self, capacity=CAPACITY):
+        self.enabled = False
+        self.categories = {name: True for name in CATEGORIES}
+        self.verts = np.zeros((capacity, 3), dtype=np.float32)
+        self.colors = np.zeros((capacity, 4), dtype=np.float32)
+        self.count = 0          # vertices this frame, two a line
+        self.markers = []       # (position, text, color)
+        self._text = {}         # (text, color) -> (width, height, RGBA bytes)
+        self.font = None
+
+    def on(self, category):
+        return self.enabled and self.categories.get(category, False)
+
+    def toggle(self, category=None):
+        if category is None:
+            self.enabled = not self.enabled
+        else:
+            self.categories[category] = not self.categories[category]
+
+    # switch on just these categories
+    def only(self, categories):
+        for name in self.categories:
+            self.categories[name] = name in categories
+
+    # room for n more vertices
+    def _reserve(self, n):
+        need = self.count + n
+        if need > len(self.verts):
+            size = max(need, 2 * len(self.verts))
+            self.verts = np.resize(self.verts, (size, 3))
+            self.colors = np.resize(self.colors, (size, 4))
+        a = self.count
+        self.count = need
+        return slice(a, need)
+
+    # segments from starts to ends, (N, 3) each
+    def lines(self, starts, ends, color=(1, 1, 1), category='vectors'):
+        if not self.on(category):
+            return
+        starts = np.asarray(starts, dtype=np.float32).reshape(-1, 3)
+        n = len(starts)
+        verts = self.verts[self._reserve(2 * n)]
+        verts[0::2] = starts
+        verts[1::2] = np.asarray(ends, dtype=np.float32).reshape(-1, 3)
+        self.colors[self.count - 2 * n:self.count] = np.repeat(_rgba(color, n), 2, axis=0)
+
+    # vecs drawn from origins, like util.draw_vec for a whole array at once
+    def vectors(self, origins, vecs, color=(1, 1, 1), scale=1.0, category='vectors'):
+        if not self.on(category):
+            return
+        origins = np.asarray(origins, dtype=np.float32).reshape(-1, 3)
+        self.lines(origins, origins + scale * np.asarray(vecs, dtype=np.float32).reshape(-1, 3), color, category)
+
+    # red, green and blue axes of frames at positions, rotations (N, 3, 3) take local directions to world ones
+    def axes(self, positions, rotations, size=1.0, category='axes'):
+        if not self.on(category):
+            return
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+        rotations = np.asarray(rotations, dtype=np.float32).reshape(-1, 3, 3)
+        for axis, color in enumerate(((1, 0, 0), (0, 1, 0), (0, 0, 1))):
+            self.vectors(positions, rotations[:, :, axis], color, size, category)
+
+    # template (K, 3) of segment endpoints placed at every center, scaled per item and optionally rotated
+    def _shapes(self, template, centers, sizes, color, category, rotations=None):
+        if not self.on(category):
+            return
+        centers = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        n, k = len(centers), len(template)
+        pts = np.broadcast_to(template.astype(np.float32), (n, k, 3))
+        if rotations is not None:
+            pts = pts @ np.asarray(rotations, dtype=np.float32).reshape(-1, 3, 3).transpose(0, 2, 1)
+        pts = pts * np.asarray(sizes, dtype=np.float32).reshape(-1, 1, 1 if np.ndim(sizes) < 2 else 3)
+        s = self._reserve(n * k)
+        self.verts[s] = (pts + centers[:, None]).reshape(-1, 3)
+        self.colors[s] = np.repeat(_rgba(color, n), k, axis=0)
+
+    # wireframe spheres, three great circles each
+    def spheres(self, centers, radii, color=(1, 1, 0), category='colliders'):
+        self._shapes(SPHERE, centers, radii, color, category)
+
+    # circles of radii round centers, facing normals
+    def circles(self, centers, normals, radii, color=(0, 1, 0), category='landing'):
+        if not self.on(category):
+            return
+        normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+        normals = normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-9)
+        # any two directions perpendicular to the normal and each other span the circle
+        helper = np.where(np.abs(normals[:, 1:2]) < .9, (0, 1, 0), (1, 0, 0)).astype(np.float32)
+        u = np.cross(normals, helper)
+        u /= np.linalg.norm(u, axis=1, keepdims=True)
+        w = np.cross(u, normals)
+        self._shapes(CIRCLE, centers, radii, color, category, np.stack((u, normals, w), axis=2))
+
+    # axis aligned boxes from their min and max corners
+    def boxes(self, mins, maxs, color=(0, 1, 1), category='boxes'):
+        mins = np.asarray(mins, dtype=np.float32).reshape(-1, 3)
+        self._shapes(BOX, mins, np.asarray(maxs, dtype=np.float32).reshape(-1, 3) - mins, color, category)
+
+    # text drawn at a point in the world
+    def marker(self, position, text, color=(255, 255, 255), category='markers'):
+        if self.on(category):
+            self.markers.append((tuple(position), text, tuple(color)))
+
+    # draw everything collected this frame, one call for the lines, and start the next frame
+    def flush(self):
+        if not self.count and not self.markers:
+            return
+        glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
+        if self.count:
+            glEnableClientState(GL_VERTEX_ARRAY)
+            glEnableClientState(GL_COLOR_ARRAY)
+            glVertexPointer(3, GL_FLOAT, 0, self.verts)
+            glColorPointer(4, GL_FLOAT, 0, self.colors)
+            glDrawArrays(GL_LINES, 0, self.count)
+            glDisableClientState(GL_COLOR_ARRAY)
+            glDisableClientState(GL_VERTEX_ARRAY)
+        if self.markers:
+            glDisable(GL_DEPTH_TEST)    # labels go on top
+            for position, text, color in self.markers:
+                width, height, pixels = self._render_text(text, color)
+                glRasterPos3f(*position)    # nothing is drawn if the point is off screen
+                glDrawPixels(width, height, GL_RGBA, GL_UNSIGNED_BYTE, pixels)
+        glPopAttrib()
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.markers.clear()
+
+    # rendered text, kept while the same labels keep coming up
+    def _render_text(self, text, color):
+        key = (text, color)
+        if key not in self._text:
+            import pygame
+            if self.font is None:
+                pygame.font.init()
+                self.font = pygame.font.Font(None, FONT_SIZE)
+            if len(self._text) > 256:
+                self._text.clear()
+            surf = self.font.render(text, True, color, (0, 0, 0, 0))
+            self._text[key] = (surf.get_width(), surf.get_height(), pygame.image.tostring(surf, "RGBA", True))
+        return self._text[key]
+
+
+# shared by everything that draws debug geometry
+debug = DebugDraw()
+
+
+# Thousands of velocity vectors and collision spheres drawn one util.draw_vec at a time against one batch,
+# on an offscreen context: PYOPENGL_PLATFORM=egl python -m utils.debugdraw [objects]
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from OpenGL.GLU import gluPerspective, gluLookAt
+
+    from utils.util import offscreen_context, draw_vec
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    offscreen_context(640, 480)
+    glMatrixMode(GL_PROJECTION)
+    gluPerspective(45, 640 / 480, 0.1, 1000.0)
+    glMatrixMode(GL_MODELVIEW)
+    gluLookAt(0, 0, 300, 0, 0, 0, 0, 1, 0)
+
+    rng = np.random.default_rng(0)
+    pos = rng.uniform(-100, 100, (n, 3))
+    vel = rng.normal(size=(n, 3))
+    radii = rng.uniform(1, 4, n)
+
+    def best_ms(func, reps=5):
+        best = float('inf')
+        for i in range(reps):
+            glFinish()
+            t = time.perf_counter()
+            func()
+            glFinish()
+            best = min(best, time.perf_counter() - t)
+        return 1000 * best
+
+    # immediate mode, spheres as the same three circles drawn with draw_vec
+    def one_at_a_time():
+        for p, v in zip(pos.tolist(), vel.tolist()):
+            draw_vec(tuple(5 * c for c in v), tuple(p), (1, 1, 1))
+        for p, r in zip(pos[:n // 10].tolist(), radii.tolist()):
+            for a, b in (SPHERE * r + p).reshape(-1, 2, 3):
+                draw_vec(tuple(b - a), tuple(a), (1, 1, 0))
+
+    def batched():
+        debug.vectors(pos, vel, (1, 1, 1), 5)
+        debug.spheres(pos[:n // 10], radii[:n // 10])
+        debug.flush()
+
+    debug.enabled = True
+    slow = best_ms(one_at_a_time, 2)
+    fast = best_ms(batched)
+    debug.enabled = False
+    off = best_ms(batched)
+    lines = n + n // 10 * len(SPHERE) // 2
+    print(f"{n} vectors and {n // 10} spheres, {lines} lines: draw_vec {slow:.1f} ms, batched {fast:.2f} ms, "
+          f"switched off {1000 * off:.1f} us")
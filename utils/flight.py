@@ -0,0 +1,218 @@
+"""
+File: flight.py
+Author: Jay Kmetz
+"""
+import numpy as np
+
+from pyobjs.Spaceship import Spaceship
+from utils import Input
+from utils import kernels
+
+
+# Batched version of the Spaceship flight model. State is a set of arrays with one row per ship,
+# controls are small ints instead of action tuples:
+#   rot[:, mode]  0 steady, Spaceship.LEFT / Spaceship.RIGHT rotate, ROT_RESET bleed off rotation
+#   thrust        Spaceship.thrusting values, 0 none, THF / THB forward/back, THRUST_OPP slow down
+ROT_STEADY = 0
+ROT_RESET = 2
+THRUST_OPP = 2
+
+# Hamilton product of rows of q1 and q2, same operation order as utils.quat.q_mult
+def q_mult(q1, q2):
+    w1, x1, y1, z1 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    w2, x2, y2, z2 = q2[..., 0], q2[..., 1], q2[..., 2], q2[..., 3]
+    return np.stack((
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 + y1 * w2 + z1 * x2 - x1 * z2,
+        w1 * z2 + z1 * w2 + x1 * y2 - y1 * x2
+    ), axis=-1)
+
+
+# rotate vector v by every quaternion in q, same as utils.quat.qv_mult
+def qv_mult(q, v):
+    qv = np.zeros(q.shape)
+    qv[..., 1:] = v
+    conj = q * (1.0, -1.0, -1.0, -1.0)
+    return q_mult(q_mult(q, qv), conj)[..., 1:]
+
+
+# Heading (local x axis) of every orientation. q * (0, 1, 0, 0) written out, then times the conjugate,
+# which is the same arithmetic qv_mult does with the zero terms dropped.
+def headings(q):
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    out = np.empty((len(q), 3))
+    out[:, 0] = -x * -x + w * w + z * -z - -y * -y
+    out[:, 1] = -x * -y + z * w + -y * -x - w * -z
+    out[:, 2] = -x * -z + -y * w + w * -y - z * -x
+    return out
+
+
+# Up vector (local y axis) of every orientation, q * (0, 0, 1, 0) times the conjugate like headings
+def up_vectors(q):
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    out = np.empty((len(q), 3))
+    out[:, 0] = -y * -x + -z * w + w * -z - x * -y
+    out[:, 1] = -y * -y + w * w + x * -x - -z * -z
+    out[:, 2] = -y * -z + x * w + -z * -y - w * -x
+    return out
+
+
+# orient = orient * (cos(a/2), sin(a/2) * axis) in place, for rotations about one local axis.
+# An angle of 0 leaves the row unchanged, like the rpy checks in Spaceship.rotate.
+def _turn(orient, angle, axis):
+    c = np.cos(angle / 2)
+    s = np.sin(angle / 2)
+    w, x, y, z = orient[:, 0].copy(), orient[:, 1].copy(), orient[:, 2].copy(), orient[:, 3].copy()
+    if axis == 0:       # roll, about x
+        orient[:, 0] = w * c - x * s
+        orient[:, 1] = w * s + x * c
+        orient[:, 2] = y * c + z * s
+        orient[:, 3] = z * c - y * s
+    elif axis == 2:     # pitch, about z
+        orient[:, 0] = w * c - z * s
+        orient[:, 1] = x * c + y * s
+        orient[:, 2] = y * c - x * s
+        orient[:, 3] = w * s + z * c
+    else:               # yaw, about y
+        orient[:, 0] = w * c - y * s
+        orient[:, 1] = x * c - z * s
+        orient[:, 2] = w * s + y * c
+        orient[:, 3] = z * c + x * s
+
+
+# local axis turned by roll, pitch and yaw, see Spaceship.rotate
+ROT_AXES = (0, 2, 1)
+
+
+class FlightState:
+    def __init__(self, n=1):
+        self.pos = np.zeros((n, 3))
+        self.vel = np.zeros((n, 3))
+        self.force = np.zeros((n, 3))
+        self.orient = np.tile((0.0, 1.0, 0.0, 0.0), (n, 1))
+        self.rpy = np.zeros((n, 3))
+        self.fuel = np.full(n, float(Spaceship.FUEL))
+        self.health = np.full(n, Spaceship.HEALTH)
+
+    def __len__(self):
+        return len(self.pos)
+
+    # copy of one ship's flight state, repeated n times
+    @staticmethod
+    def from_ship(ship, n=1):
+        state = FlightState(n)
+        state.pos[:] = ship.pos
+        state.vel[:] = ship.vel
+        state.force[:] = ship.force
+        state.orient[:] = ship.orient
+        state.rpy[:] = ship.rpy
+        state.fuel[:] = ship.fuel
+        state.health[:] = ship.health
+        return state
+
+    # put row i back into a ship, teleported so the jump isn't swept for collisions
+    def to_ship(self, ship, i=0):
+        ship.teleport(tuple(self.pos[i]))
+        ship.vel = tuple(self.vel[i])
+        ship.force = tuple(self.force[i])
+        ship.orient = tuple(self.orient[i])
+        ship.rpy = list(self.rpy[i])
+        ship.fuel = float(self.fuel[i])
+        ship.health = int(self.health[i])
+
+
+# rotation and thrust controls from input bitsets, same priorities as Spaceship.apply_input
+def bits_to_controls(bits):
+    bits = np.asarray(bits, dtype=np.int64)
+    rot = np.zeros(bits.shape + (3,), dtype=np.int8)
+    for mode, (left, right, center) in enumerate(Spaceship.ROT_INPUTS):
+        rot[..., mode] = np.select(
+            (bits & left != 0, bits & right != 0, bits & center != 0),
+            (Spaceship.LEFT, Spaceship.RIGHT, ROT_RESET), ROT_STEADY)
+    thrust = np.select(
+        (bits & Input.THRUST_CENTER != 0, bits & Input.THRUST_UP != 0, bits & Input.THRUST_DOWN != 0),
+        (THRUST_OPP, Spaceship.THF, Spaceship.THB), 0).astype(np.int8)
+    return rot, thrust
+
+
+# input bitsets that produce the given controls
+def controls_to_bits(rot, thrust):
+    bits = np.zeros(np.shape(thrust), dtype=np.int64)
+    for mode, (left, right, center) in enumerate(Spaceship.ROT_INPUTS):
+        r = rot[..., mode]
+        bits |= np.where(r == Spaceship.LEFT, left, 0) | np.where(r == Spaceship.RIGHT, right, 0)
+        bits |= np.where(r == ROT_RESET, center, 0)
+    bits |= np.where(thrust == THRUST_OPP, Input.THRUST_CENTER, 0)
+    bits |= np.where(thrust == Spaceship.THF, Input.THRUST_UP, 0) | np.where(thrust == Spaceship.THB, Input.THRUST_DOWN, 0)
+    return bits
+
+
+# The phases of Spaceship.update over every row, in place. step runs them in order, a Fleet can call them
+# one at a time.
+
+# applyVel
+def apply_vel(state, dt=1.0):
+    state.pos[:] = dt * state.vel + state.pos
+
+
+# adjust, rotational then positional acceleration, dt ticks of rotational acceleration
+def adjust(state, rot, thrust, dt=1.0):
+    racc, rmax = Spaceship.RACC * dt, Spaceship.RMAX
+    rpy = state.rpy
+    bled = rpy - np.sign(rpy) * racc
+    bled[np.abs(bled) <= racc] = 0
+    rpy[:] = np.where(rot == Spaceship.RIGHT, np.minimum(rpy + racc, rmax),
+                      np.where(rot == Spaceship.LEFT, np.maximum(rpy - racc, -rmax),
+                               np.where(rot == ROT_RESET, bled, rpy)))
+
+    opp = thrust == THRUST_OPP
+    state.force[:] = (np.sign(thrust) * Spaceship.PACC)[:, None] * headings(state.orient)
+    if opp.any():
+        vel = state.vel
+        speed = np.sqrt(vel[:, 0] * vel[:, 0] + vel[:, 1] * vel[:, 1] + vel[:, 2] * vel[:, 2])
+        stop = opp & (speed <= Spaceship.TOL)
+        brake = opp & ~stop
+        state.force[brake] = Spaceship.PACC * (-vel[brake] / speed[brake, None])
+        state.force[stop] = 0
+        vel[stop] = 0
+
+
+# rotate, by dt ticks of each rate
+def rotate(state, dt=1.0):
+    for mode, axis in enumerate(ROT_AXES):
+        _turn(state.orient, state.rpy[:, mode] * dt, axis)
+
+
+# applyThrust
+def apply_thrust(state, dt=1.0):
+    state.vel += dt * state.force
+
+
+# calc_fuel_loss, returns a mask of the ships that ran out and were damaged
+def burn_fuel(state, thrust, dt=1.0):
+    state.fuel -= np.where(thrust == THRUST_OPP, Spaceship.THRUST_OPP_LOSS * dt,
+                           np.where(thrust != 0, Spaceship.THRUST_LOSS * dt, 0))
+    empty = state.fuel <= 0
+    state.health -= empty
+    state.fuel[empty] = Spaceship.FUEL
+    return empty
+
+
+# Advance every ship dt ticks, in place, exactly like Spaceship.update.
+# Returns a mask of the ships that ran out of fuel this tick (and were damaged).
+def step(state, rot, thrust, dt=1.0):
+    if kernels.ENABLED:     # the same step fused into one compiled loop
+        n = len(state)
+        if np.shape(rot) != (n, 3) or np.shape(thrust) != (n,):
+            rot, thrust = np.broadcast_to(rot, (n, 3)), np.broadcast_to(thrust, (n,))
+        return kernels.ship_step(state.pos, state.vel, state.force, state.orient, state.rpy, state.fuel, state.health,
+                                 rot, thrust, float(dt), Spaceship.RACC, Spaceship.RMAX,
+                                 Spaceship.PACC, Spaceship.TOL, float(Spaceship.FUEL), Spaceship.THRUST_LOSS,
+                                 Spaceship.THRUST_OPP_LOSS)
+
+    apply_vel(state, dt)
+    adjust(state, rot, thrust, dt)
+    rotate(state, dt)
+    apply_thrust(state, dt)
+    return burn_fuel(state, thrust, dt)
@@ -0,0 +1,206 @@
+"""
+File: glpool.py
+Author: Jay Kmetz
+"""
+import weakref
+from collections import Counter
+
+from OpenGL.GL import *
+
+
+# GLOBALS
+LIST = 'list'
+TEXTURE = 'texture'
+BUFFER = 'buffer'
+KINDS = (LIST, TEXTURE, BUFFER)
+POOL_LIMIT = 64     # freed handles kept per kind for reuse, past that they are deleted
+
+
+# what a handle is recorded against: the owner weakly, so a dropped owner shows up, and the level it belongs to
+class Record:
+    __slots__ = ('owner', 'label', 'level')
+
+    def __init__(self, owner, level):
+        self.label = getattr(owner, 'name', None) or type(owner).__name__
+        try:
+            self.owner = weakref.ref(owner)
+        except TypeError:
+            self.owner = lambda: owner
+        self.level = level      # None for shared resources that outlive levels (mesh caches)
+
+    @property
+    def orphaned(self):
+        return self.owner() is None
+
+
+# Every display list, texture and buffer the game makes goes through here. Each handle is recorded against its
+# owner and the level it was made in, freed handles are emptied and handed out again instead of deleted, and
+# textures are shared by file. Anything level scoped still alive after the next level started, or whose owner
+# is gone, is reported as a leak.
+class GLPool:
+    def __init__(self, limit=POOL_LIMIT):
+        self.limit = limit
+        self.level = 0
+        self.live = {}      # (kind, handle) -> Record
+        self.free = {kind: [] for kind in KINDS}
+        self.made = Counter()       # kind -> handles generated
+        self.reused = Counter()     # kind -> handles handed out from the free lists
+        self.textures = {}          # path -> [handle, references]
+
+    # level scoped resources made from now on belong to level
+    def begin_level(self, level):
+        self.level = level
+
+    # A handle of kind for owner, from the free list if there is one. shared resources don't belong to a level.
+    def gen(self, kind, owner, shared=False):
+        if self.free[kind]:
+            handle = self.free[kind].pop()
+            self.reused[kind] += 1
+        else:
+            handle = self._generate(kind)
+            self.made[kind] += 1
+        self.live[kind, handle] = Record(owner, None if shared else self.level)
+        return handle
+
+    # give a handle back, its contents are dropped right away
+    def release(self, kind, handle):
+        if self.live.pop((kind, handle), None) is None:
+            return      # never made here, or released already
+        if len(self.free[kind]) < self.limit:
+            self._empty(kind, handle)
+            self.free[kind].append(handle)
+        else:
+            self._delete(kind, handle)
+
+    # Texture for the image at path, bound. Loaded with upload(path) into the bound texture the first time,
+    # shared after that.
+    def texture(self, path, owner, upload):
+        if path in self.textures:
+            entry = self.textures[path]
+            entry[1] += 1
+            glBindTexture(GL_TEXTURE_2D, entry[0])
+            return entry[0]
+        handle = self.gen(TEXTURE, owner, shared=True)
+        glBindTexture(GL_TEXTURE_2D, handle)
+        upload(path)
+        self.textures[path] = [handle, 1]
+        return handle
+
+    def release_texture(self, path):
+        entry = self.textures.get(path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.textures[path]
+            self.release(TEXTURE, entry[0])
+
+    # live handles by level (None for shared) and kind
+    def counts(self):
+        counts = {}
+        for (kind, handle), rec in self.live.items():
+            counts.setdefault(rec.level, Counter())[kind] += 1
+        return counts
+
+    # (kind, handle, owner label, level, why) for handles that should be gone: level scoped ones from before
+    # the current level and ones whose owner was dropped without releasing them
+    def leaks(self):
+        found = []
+        for (kind, handle), rec in self.live.items():
+            if rec.orphaned:
+                found.append((kind, handle, rec.label, rec.level, "owner dropped"))
+            elif rec.level is not None and rec.level < self.level:
+                found.append((kind, handle, rec.label, rec.level, f"outlived level {rec.level}"))
+        return found
+
+    def report(self):
+        lines = []
+        for level, kinds in sorted(self.counts().items(), key=lambda item: -1 if item[0] is None else item[0]):
+            what = ", ".join(f"{kinds[kind]} {kind}s" for kind in KINDS if kinds[kind])
+            lines.append(f"{'shared' if level is None else f'level {level}'}: {what}")
+        lines.append("made " + ", ".join(f"{self.made[kind]} {kind}s" for kind in KINDS) +
+                     "; reused " + ", ".join(f"{self.reused[kind]} {kind}s" for kind in KINDS) +
+                     f"; {len(self.textures)} textures shared by file")
+        for kind, handle, label, level, why in self.leaks():
+            lines.append(f"LEAK: {kind} {handle} of {label}, {why}")
+        return lines
+
+    @staticmethod
+    def _generate(kind):
+        if kind == LIST:
+            return glGenLists(1)
+        if kind == TEXTURE:
+            return int(glGenTextures(1))
+        return int(glGenBuffers(1))
+
+    # drop what a handle holds but keep the name
+    @staticmethod
+    def _empty(kind, handle):
+        if kind == LIST:
+            glNewList(handle, GL_COMPILE)
+            glEndList()
+        elif kind == TEXTURE:
+            glBindTexture(GL_TEXTURE_2D, handle)
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_RGB, 0, 0, 0, GL_RGB, GL_UNSIGNED_BYTE, None)
+            glBindTexture(GL_TEXTURE_2D, 0)
+        else:
+            glBindBuffer(GL_ARRAY_BUFFER, handle)
+            glBufferData(GL_ARRAY_BUFFER, 0, None, GL_STATIC_DRAW)
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    @staticmethod
+    def _delete(kind, handle):
+        if kind == LIST:
+            glDeleteLists(handle, 1)
+        elif kind == TEXTURE:
+            glDeleteTextures(1, [handle])
+        else:
+            glDeleteBuffers(1, [handle])
+
+
+# shared by everything that makes GL resources
+pool = GLPool()
+
+
+# Level after level of planets and asteroids built, drawn with and without shaders, and dropped the way
+# initialize_level does it, on an offscreen context. One planet is left behind on purpose to show up as a
+# leak: PYOPENGL_PLATFORM=egl python -m utils.glpool [levels]
+if __name__ == "__main__":
+    import random
+    import sys
+
+    from utils.util import offscreen_context
+    from utils import glpool    # the pool DisplayObj uses, not this __main__ copy
+    from pyobjs.Asteroid import Asteroid
+    from pyobjs.Planet import Planet
+    from utils.shaders import LightingProgram, SUN
+
+    levels = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    offscreen_context(64, 64)
+    program = LightingProgram.create()
+    tracked = glpool.pool
+    random.seed(0)
+    scene = []
+    for level in range(1, levels + 1):
+        if level == levels // 2:
+            scene[0].obj.deregister = lambda: None  # a planet that never gives its list back
+        for obj in scene:
+            obj.deregister()
+        tracked.begin_level(level)
+        scene = [Planet((0, 15, 0), radius=20)] + [Planet(None, radius=5) for i in range(level % 4)]
+        scene += [Asteroid(variant=(seed, 2)) for seed in range(level % 5)]
+        for obj in scene:       # display lists
+            obj.render()
+        if program:             # vertex buffers
+            program.begin([SUN])
+            for obj in scene:
+                obj.render()
+            program.end()
+
+        counts = tracked.counts()
+        live, shared = counts.get(level, Counter()), counts.get(None, Counter())
+        print(f"level {level:>2}: {sum(isinstance(o, Planet) for o in scene)} planets, "
+              f"lists {live[LIST]:>2}, buffers {live[BUFFER]:>2} | shared lists {shared[LIST]}, "
+              f"buffers {shared[BUFFER]}, textures {shared[TEXTURE]} | free lists {len(tracked.free[LIST])}, "
+              f"buffers {len(tracked.free[BUFFER])} | leaks {len(tracked.leaks())}")
+    print("\n".join(tracked.report()))
@@ -0,0 +1,334 @@
+"""
+File: governor.py
+Author: Jay Kmetz
+"""
+import time
+from collections import deque
+
+import numpy as np
+from OpenGL.GL import *
+
+from utils.glpool import pool, LIST
+
+
+# GLOBALS
+FRAME_TARGET_MS = 1000 / 60
+WINDOW = 30             # frames in the rolling average, a change waits for a full window of new frames
+DEGRADE_AT = 1.1        # step quality down once the average is this far over the target
+RESTORE_AT = .7         # and back up once it has stayed this far under it
+RESTORE_HOLD = 120      # frames the average has to stay under before stepping up, so it doesn't flip back and forth
+DECISIONS = 50          # quality changes kept for the log
+
+# Quality steps from best to cheapest, each one gives up a little more:
+# render scale, share of each planet's trees, asteroid icosphere subdivisions, HUD redrawn every n frames,
+# distance past which objects aren't drawn (None leaves it to the far plane).
+# Trees and asteroid detail are baked into meshes, they change with the next level.
+LEVELS = (
+    (1.0, 1.0, 2, 1, None),
+    (1.0, 1.0, 2, 3, None),
+    (1.0, 1.0, 2, 3, 350),
+    (.85, 1.0, 2, 3, 350),
+    (.85, .5, 2, 3, 350),
+    (.85, .5, 1, 6, 300),
+    (.7, .5, 1, 6, 250),
+    (.6, .25, 1, 10, 200),
+    (.5, 0.0, 0, 10, 150)
+)
+
+
+# One step of LEVELS
+class Quality:
+    __slots__ = ('scale', 'trees', 'detail', 'hud_every', 'cull')
+
+    def __init__(self, scale, trees, detail, hud_every, cull):
+        self.scale = scale
+        self.trees = trees
+        self.detail = detail
+        self.hud_every = hud_every
+        self.cull = cull
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# Where the scene is drawn: straight to the window at full scale, otherwise to a smaller framebuffer that is
+# stretched over the window before the HUD goes on top at full resolution.
+class RenderTarget:
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.size = (0, 0)      # of the framebuffer's buffers
+        self.fbo = None
+        self.buffers = None     # color and depth renderbuffers
+        self.bound = False
+        self.supported = bool(glGenFramebuffers) and bool(glBlitFramebuffer)
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+
+    def begin(self, scale):
+        if scale >= 1 or not self.supported:
+            glViewport(0, 0, self.width, self.height)
+            return
+        size = (max(1, int(self.width * scale)), max(1, int(self.height * scale)))
+        if size != self.size:
+            self._allocate(size)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, *size)
+        self.bound = True
+
+    def end(self):
+        if not self.bound:
+            return
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, 0)
+        glBlitFramebuffer(0, 0, *self.size, 0, 0, self.width, self.height, GL_COLOR_BUFFER_BIT, GL_LINEAR)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        glViewport(0, 0, self.width, self.height)
+        self.bound = False
+
+    def _allocate(self, size):
+        if self.fbo is None:
+            self.fbo = glGenFramebuffers(1)
+            self.buffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        for rb, fmt, attachment in zip(self.buffers, (GL_RGBA8, GL_DEPTH_COMPONENT24),
+                                       (GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT)):
+            glBindRenderbuffer(GL_RENDERBUFFER, rb)
+            glRenderbufferStorage(GL_RENDERBUFFER, fmt, *size)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, rb)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            self.supported = False  # draw at full scale from now on
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        self.size = size
+
+    def delete(self):
+        if self.fbo is not None:
+            glDeleteRenderbuffers(2, self.buffers)
+            glDeleteFramebuffers(1, [self.fbo])
+            self.fbo = self.buffers = None
+            self.size = (0, 0)
+
+
+# HUD drawn into a call list every n frames and replayed from it in between, so the text is only rendered
+# by pygame on the frames that refresh it
+class HudCache:
+    def __init__(self):
+        self.list = None
+        self.age = 0    # frames the call list has left
+
+    def draw(self, every, func, *args):
+        if every <= 1:
+            func(*args)
+            return
+        if self.list is None:
+            self.list = pool.gen(LIST, self, shared=True)
+        if self.age <= 0:
+            glNewList(self.list, GL_COMPILE_AND_EXECUTE)
+            func(*args)
+            glEndList()
+            self.age = every
+        else:
+            glCallList(self.list)
+        self.age -= 1
+
+    def invalidate(self):
+        self.age = 0
+
+
+# Watches a rolling average of frame times against a target and trades quality for speed a step at a time.
+# A step down needs a full window over DEGRADE_AT times the target, a step up RESTORE_HOLD frames in a row
+# under RESTORE_AT times it, and every step starts a new window. The scene goes through begin_scene/end_scene
+# for the render scale and the HUD through draw_hud.
+class Governor:
+    def __init__(self, width, height, target_ms=FRAME_TARGET_MS, levels=LEVELS):
+        self.target_ms = target_ms
+        self.target = RenderTarget(width, height)
+        if not self.target.supported:   # no framebuffer objects, the render scale stays at 1
+            levels = [(1.0,) + tuple(level[1:]) for level in levels]
+        self.levels = [Quality(*level) for level in levels]
+        self.level = 0
+        self.hud = HudCache()
+        self.times = deque(maxlen=WINDOW)
+        self.under = 0      # frames in a row the average has been under RESTORE_AT
+        self.frames = 0
+        self.last = None    # perf_counter at the end of the last frame
+        self.decisions = deque(maxlen=DECISIONS)    # (frame, old level, new level, average ms)
+        self._radii = (None, None)  # objects list and the bounding radii of its objects
+
+    @property
+    def quality(self):
+        return self.levels[self.level]
+
+    # Call once a frame is on screen. Returns whether the quality changed.
+    def frame_done(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.times.append(1000 * (now - self.last))
+        self.last = now
+        self.frames += 1
+        if len(self.times) < WINDOW:
+            return False
+
+        avg = self.average_ms()
+        if avg > self.target_ms * DEGRADE_AT:
+            self.under = 0
+            if self.level < len(self.levels) - 1:
+                return self._step(1, avg)
+        elif avg < self.target_ms * RESTORE_AT:
+            self.under += 1
+            if self.under >= RESTORE_HOLD and self.level > 0:
+                return self._step(-1, avg)
+        else:
+            self.under = 0
+        return False
+
+    def _step(self, by, avg):
+        self.decisions.append((self.frames, self.level, self.level + by, avg))
+        self.level += by
+        self.times.clear()
+        self.under = 0
+        self.hud.invalidate()
+        return True
+
+    # forget the frames around a stall that isn't the renderer's doing (a level loading)
+    def skip(self):
+        self.times.clear()
+        self.last = None
+        self.under = 0
+
+    def resize(self, width, height):
+        self.target.resize(width, height)
+        self.hud.invalidate()
+
+    def begin_scene(self):
+        self.target.begin(self.quality.scale)
+
+    def end_scene(self):
+        self.target.end()
+
+    def draw_hud(self, func, *args):
+        self.hud.draw(self.quality.hud_every, func, *args)
+
+    # Mask over objects of the ones to draw, for model matrices mats (column major) seen from eye.
+    # An object is culled once its bounding sphere is entirely past the cull distance.
+    def visible(self, objects, mats, eye):
+        cull = self.quality.cull
+        if cull is None:
+            return np.ones(len(objects), dtype=bool)
+        if self._radii[0] is not objects:   # the scene's object list is replaced when it changes
+            self._radii = (objects, np.array([o.obj.maxr * o.obj.scale for o in objects], dtype=float))
+        gap = mats[:, 3, :3] - np.asarray(eye, dtype=np.float32)
+        return np.sqrt(np.einsum('ij,ij->i', gap, gap)) - self._radii[1] <= cull
+
+    def average_ms(self):
+        return float(np.mean(self.times)) if self.times else 0.0
+
+    # current decisions, for logging
+    def state(self):
+        return dict(level=self.level, average_ms=self.average_ms(), target_ms=self.target_ms, **self.quality.as_dict())
+
+    def report(self):
+        q = self.quality
+        cull = "off" if q.cull is None else f"{q.cull}"
+        return (f"quality {self.level}/{len(self.levels) - 1}, {self.average_ms():.1f} of {self.target_ms:.1f} ms "
+                f"(scale {q.scale:.2f}, trees {q.trees:.0%}, detail {q.detail}, hud 1/{q.hud_every}, cull {cull})")
+
+    def log(self):
+        return [f"frame {frame}: {old} -> {new} at {avg:.1f} ms" for frame, old, new, avg in self.decisions]
+
+
+# Frame times as the asteroid count grows level after level, with every lever held at full quality and with
+# the governor, on an offscreen context: PYOPENGL_PLATFORM=egl python -m utils.governor [target ms]
+if __name__ == "__main__":
+    import random
+    import sys
+
+    import pygame
+    from OpenGL.GLU import gluPerspective, gluLookAt
+
+    from utils.util import offscreen_context
+    from pyobjs.Asteroid import Asteroid
+    from pyobjs.Planet import Planet
+
+    width, height = 1000, 600
+    target_ms = float(sys.argv[1]) if len(sys.argv) > 1 else FRAME_TARGET_MS
+    offscreen_context(width, height)
+    pygame.font.init()
+    font = pygame.font.Font(None, 22)
+
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+    glMatrixMode(GL_PROJECTION)
+    gluPerspective(45, width / height, 0.1, 500.0)
+    glMatrixMode(GL_MODELVIEW)
+
+    def hud(lines):
+        for i, line in enumerate(lines):
+            surf = font.render(line, True, (0, 255, 0), (0, 0, 0, 0))
+            glRasterPos2d(10, 20 + 20 * i)
+            glDrawPixels(surf.get_width(), surf.get_height(), GL_RGBA, GL_UNSIGNED_BYTE,
+                         pygame.image.tostring(surf, "RGBA", True))
+
+    # a planet and asteroids strewn ahead of the camera, built at the governor's level-time settings
+    def build(level, quality):
+        random.seed(level)
+        Planet.TREE_SHARE = quality.trees
+        objects = [Planet((0, 30, 0), radius=20, pos=(0, 0, -120))]
+        for i in range(60 * level):
+            pos = (random.uniform(-150, 150), random.uniform(-80, 80), -random.uniform(20, 450))
+            objects.append(Asteroid(pos, variant=(i % 6, quality.detail)))
+        mats = np.array([o.transform.matrix() for o in objects], dtype=np.float32)
+        return objects, mats
+
+    def run(governor, levels, frames):
+        rows = []
+        for level in range(1, levels + 1):
+            objects, mats = build(level, governor.quality)
+            governor.skip()
+            times = []
+            for n in range(frames):
+                t = time.perf_counter()
+                governor.begin_scene()
+                glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+                glLoadIdentity()
+                gluLookAt(0, 0, 0, 0, 0, -1, 0, 1, 0)
+                glLightfv(GL_LIGHT0, GL_POSITION, (-10, 10, -10, 0))
+                for obj, mat, show in zip(objects, mats, governor.visible(objects, mats, (0, 0, 0))):
+                    if show:
+                        obj.render(mat)
+                governor.end_scene()
+
+                glMatrixMode(GL_PROJECTION)
+                glPushMatrix()
+                glLoadIdentity()
+                glOrtho(0, width, height, 0, -1, 10)
+                glMatrixMode(GL_MODELVIEW)
+                glLoadIdentity()
+                glDisable(GL_LIGHTING)
+                governor.draw_hud(hud, [governor.report()] + [f"line {i}: {n}" for i in range(8)])
+                glEnable(GL_LIGHTING)
+                glMatrixMode(GL_PROJECTION)
+                glPopMatrix()
+                glMatrixMode(GL_MODELVIEW)
+
+                glFinish()  # what a flip waits for
+                times.append(1000 * (time.perf_counter() - t))
+                governor.frame_done()
+            last = np.array(times[frames // 2:])    # once it has settled
+            rows.append((level, len(objects) - 1, last.mean(), last.std(), governor.level))
+        return rows
+
+    levels = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    frames = 240
+    fixed = run(Governor(width, height, target_ms, LEVELS[:1]), levels, frames)
+    governor = Governor(width, height, target_ms)
+    governed = run(governor, levels, frames)
+    print(f"target {target_ms:.1f} ms, framebuffer scaling {'on' if governor.target.supported else 'off'}")
+    print(f"{'level':>5}{'asteroids':>10}{'full quality ms':>18}{'governed ms':>14}{'quality':>9}")
+    for (level, count, ms, sd, q), (_, _, gms, gsd, gq) in zip(fixed, governed):
+        print(f"{level:>5}{count:>10}{ms:>11.1f} +-{sd:<4.1f}{gms:>8.1f} +-{gsd:<4.1f}{gq:>6}")
+    print("\n".join(governor.log()))
@@ -0,0 +1,278 @@
+"""
+File: gravity.py
+Author: Jay Kmetz
+"""
+import time
+
+import numpy as np
+
+
+# GLOBALS
+G = 1e-4                # gravitational constant in game units
+PLANET_DENSITY = 1.0    # planet mass = density * radius^3
+ASTEROID_DENSITY = .5   # asteroid mass = density * colr^3
+SHIP_MASS = 1.0
+SOFTENING = .5          # keeps close encounters from blowing up
+
+MORTON_BITS = 21        # bits per axis, 3 * 21 fits in an int64
+BH_MIN_BODIES = 1200    # below this many bodies the exact sum is faster than building and walking a tree
+
+
+# mass of a body of the given radius and density
+def body_mass(radius, density=PLANET_DENSITY):
+    return density * radius ** 3
+
+
+# Acceleration on every pos from a handful of fixed attractors (planets), exact
+def accel_from(pos, src_pos, src_mass, eps=SOFTENING, g=G):
+    pos = np.atleast_2d(np.asarray(pos, dtype=float))
+    d = np.asarray(src_pos, dtype=float)[None, :, :] - pos[:, None, :]     # (N, S, 3)
+    r2 = np.einsum('nsk,nsk->ns', d, d) + eps * eps
+    w = g * np.asarray(src_mass, dtype=float)[None, :] / (r2 * np.sqrt(r2))
+    return np.einsum('ns,nsk->nk', w, d)
+
+
+# Exact O(N^2) mutual acceleration, the reference for the tree code.
+# Rows are done in chunks so memory stays at chunk * N.
+def exact_accel(pos, mass, eps=SOFTENING, g=G, chunk=1024):
+    pos = np.asarray(pos, dtype=float)
+    mass = np.asarray(mass, dtype=float)
+    acc = np.empty_like(pos)
+    for a in range(0, len(pos), chunk):
+        d = pos[None, :, :] - pos[a:a + chunk, None, :]
+        r2 = np.einsum('nsk,nsk->ns', d, d) + eps * eps
+        w = g * mass[None, :] / (r2 * np.sqrt(r2))
+        w[np.arange(len(w)), np.arange(a, a + len(w))] = 0     # no self force
+        acc[a:a + chunk] = np.einsum('ns,nsk->nk', w, d)
+    return acc
+
+
+# spread the low 21 bits of x so there are two zero bits between each
+def _spread_bits(x):
+    x = x & 0x1fffff
+    x = (x | x << 32) & 0x1f00000000ffff
+    x = (x | x << 16) & 0x1f0000ff0000ff
+    x = (x | x << 8) & 0x100f00f00f00f00f
+    x = (x | x << 4) & 0x10c30c30c30c30c3
+    x = (x | x << 2) & 0x1249249249249249
+    return x
+
+
+# 0, 1, ..., c-1 for every count c, laid end to end
+def _ragged_arange(counts):
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts, counts)
+
+
+# Octree approximation of the mutual pull. Walking costs about the same per pull at any N (the benchmark
+# below prints it), but the pulls per body are not log N over the sizes here: at theta .5 they go from
+# about 320 at 1000 bodies to about 1000 at 50000, most of the system still being close enough to open at
+# the small end. So the walk does not scale as O(N log N) until well past 50000 bodies, where pulls per
+# body grow about 10% per doubling. No level comes near BH_MIN_BODIES, so in the game apply_gravity
+# always takes the exact sum.
+class BarnesHut:
+    def __init__(self, theta=.5, leaf_size=8, eps=SOFTENING, g=G, chunk=4096):
+        self.theta = theta          # opening angle, 0 is exact, bigger is faster and rougher
+        self.leaf_size = leaf_size  # bodies summed directly once a cell holds this few
+        self.eps = eps
+        self.g = g
+        self.chunk = chunk          # bodies walked through the tree at once
+        self.pulls = 0              # pulls summed by the last accel
+
+    # Rebuild the octree from scratch. Bodies are sorted along a Morton curve so that every
+    # cell is a contiguous run of bodies, and each level is found by grouping on a shifted code.
+    def build(self, pos, mass):
+        pos = np.asarray(pos, dtype=float)
+        mass = np.asarray(mass, dtype=float)
+        n = len(pos)
+
+        lo = pos.min(axis=0)
+        size = float((pos.max(axis=0) - lo).max()) or 1.0
+        size *= 1 + 1e-9    # keep the far corner inside the last cell
+        cells = 1 << MORTON_BITS
+        grid = np.minimum(((pos - lo) / size * cells).astype(np.int64), cells - 1)
+        codes = _spread_bits(grid[:, 0]) | _spread_bits(grid[:, 1]) << 1 | _spread_bits(grid[:, 2]) << 2
+
+        self.order = np.argsort(codes, kind='stable')
+        codes = codes[self.order]
+        self.pos = pos[self.order]
+        self.mass = mass[self.order]
+
+        # prefix sums give any cell's mass and centre of mass in O(1)
+        cmass = np.concatenate(([0.0], np.cumsum(self.mass)))
+        cmpos = np.concatenate((np.zeros((1, 3)), np.cumsum(self.mass[:, None] * self.pos, axis=0)))
+
+        starts = [np.zeros(1, dtype=np.int64)]
+        counts = [np.array([n])]
+        levels = [np.zeros(1, dtype=np.int64)]
+        parents = [np.full(1, -1)]
+        node_of = np.zeros(n, dtype=np.int64)   # the deepest node each body has been placed in so far
+        split = np.full(n, n > self.leaf_size)  # bodies in nodes still too full to be leaves
+        nodes = 1
+        for level in range(1, MORTON_BITS + 1):
+            idx = np.flatnonzero(split)
+            if not len(idx):
+                break
+            # cells of this level inside the nodes being split, children of leaves are never made
+            key = codes[idx] >> 3 * (MORTON_BITS - level)
+            s = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+            c = np.diff(np.append(s, len(idx)))
+            starts.append(idx[s])
+            counts.append(c)
+            levels.append(np.full(len(s), level))
+            parents.append(node_of[idx[s]])
+            node_of[idx] = np.repeat(np.arange(nodes, nodes + len(s)), c)
+            split[idx] = np.repeat(c > self.leaf_size, c)
+            nodes += len(s)
+
+        self.start = np.concatenate(starts)
+        self.count = np.concatenate(counts)
+        self.size = size / 2.0 ** np.concatenate(levels)
+        parent = np.concatenate(parents)
+
+        # children of a node are contiguous because every level is sorted by start
+        self.child_num = np.bincount(parent[1:], minlength=nodes)
+        self.child_first = np.zeros(nodes, dtype=np.int64)
+        has = self.child_num > 0
+        self.child_first[has] = np.searchsorted(parent[1:], np.flatnonzero(has)) + 1
+
+        end = self.start + self.count
+        self.node_mass = cmass[end] - cmass[self.start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.com = (cmpos[end] - cmpos[self.start]) / self.node_mass[:, None]
+        self.com[self.node_mass == 0] = self.pos[self.start[self.node_mass == 0]]
+        return self
+
+    # Acceleration on every body in the order they were passed to build
+    def accel(self):
+        acc = np.empty_like(self.pos)
+        self.pulls = 0
+        for a in range(0, len(self.pos), self.chunk):
+            acc[a:a + self.chunk] = self._walk(np.arange(a, min(a + self.chunk, len(self.pos))))
+        out = np.empty_like(acc)
+        out[self.order] = acc
+        return out
+
+    # Walk the tree for a batch of bodies at once, keeping a frontier of (body, node) pairs
+    def _walk(self, bodies):
+        lo = bodies[0]
+        acc = np.zeros((len(bodies), 3))
+        eps2 = self.eps * self.eps
+        theta2 = self.theta * self.theta
+        b = bodies
+        nd = np.zeros(len(bodies), dtype=np.int64)     # everyone starts at the root
+        while len(b):
+            d = self.com[nd] - self.pos[b]
+            r2 = np.einsum('ij,ij->i', d, d) + eps2
+            inside = (b >= self.start[nd]) & (b < self.start[nd] + self.count[nd])
+            far = ~inside & (self.size[nd] ** 2 < theta2 * r2)
+            self._add(acc, b[far] - lo, d[far], self.node_mass[nd[far]], r2[far])
+
+            near = ~far
+            leaf = near & (self.child_num[nd] == 0)
+            # leaves that are too close get summed body by body
+            lb, ln = b[leaf], nd[leaf]
+            cnt = self.count[ln]
+            src = np.repeat(self.start[ln], cnt) + _ragged_arange(cnt)
+            dst = np.repeat(lb, cnt)
+            other = src != dst
+            src, dst = src[other], dst[other]
+            dd = self.pos[src] - self.pos[dst]
+            self._add(acc, dst - lo, dd, self.mass[src], np.einsum('ij,ij->i', dd, dd) + eps2)
+
+            # everything else opens into its children
+            split = near & ~leaf
+            ob, on = b[split], nd[split]
+            cn = self.child_num[on]
+            b = np.repeat(ob, cn)
+            nd = np.repeat(self.child_first[on], cn) + _ragged_arange(cn)
+        return acc
+
+    # Add the pulls of masses m at offsets d onto the bodies idx. The frontier keeps its bodies in order, so
+    # idx is sorted and every body's pulls are one run, summed in time proportional to the pulls and not to
+    # the whole batch.
+    def _add(self, acc, idx, d, m, r2):
+        if not len(idx):
+            return
+        self.pulls += len(idx)
+        pull = (self.g * m / (r2 * np.sqrt(r2)))[:, None] * d
+        runs = np.flatnonzero(np.concatenate(([True], idx[1:] != idx[:-1])))
+        acc[idx[runs]] += np.add.reduceat(pull, runs, axis=0)
+
+
+# Apply one step of gravity to the ship and asteroids. Everything is pulled towards the planets,
+# and towards each other too if mutual is on: through the Barnes-Hut tree once there are BH_MIN_BODIES
+# bodies, exactly with fewer or if solver is None.
+def apply_gravity(ship, asteroids, planets, dt=1.0, mutual=False, solver=None):
+    bodies = [ship] + list(asteroids)
+    pos = np.array([b.pos for b in bodies], dtype=float)
+    acc = accel_from(pos, [p.pos for p in planets], [body_mass(p.radius) for p in planets])
+
+    if mutual and len(bodies) > 1:
+        mass = np.array([SHIP_MASS] + [body_mass(a.colr, ASTEROID_DENSITY) for a in asteroids])
+        if solver is None or len(bodies) < BH_MIN_BODIES:
+            acc += exact_accel(pos, mass)
+        else:
+            acc += solver.build(pos, mass).accel()
+
+    for body, a in zip(bodies, acc * dt):
+        body.vel = (body.vel[0] + a[0], body.vel[1] + a[1], body.vel[2] + a[2])
+
+
+# Exactness at theta 0, where every cell is opened, then the crossover with the exact sum and the scaling
+# benchmark: python -m utils.gravity
+if __name__ == "__main__":
+    def rel_err(acc, ref):
+        return np.linalg.norm(acc - ref, axis=1) / np.linalg.norm(ref, axis=1)
+
+    worst = 0.0
+    for seed in range(40):
+        for n in (9, 50, 100, 300, 1000):
+            rng = np.random.default_rng(seed)
+            for pos in (rng.normal(scale=100, size=(n, 3)), rng.uniform(-100, 100, size=(n, 3))):
+                mass = rng.uniform(.5, 2, size=n)
+                worst = max(worst, rel_err(BarnesHut(theta=0).build(pos, mass).accel(), exact_accel(pos, mass)).max())
+    print(f"theta 0 against the exact sum, 40 seeds x 5 sizes x 2 layouts: max rel err {worst:.1e}")
+    assert worst < 1e-9, "the tree at theta 0 should match the exact sum"
+
+    def best_ms(func, reps):
+        best = float('inf')
+        for i in range(reps):
+            t = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t)
+        return 1000 * best
+
+    rng = np.random.default_rng(0)
+    bh = BarnesHut(theta=.5)
+    print(f"\n{'N':>7}{'tree (ms)':>12}{'exact (ms)':>12}   (BH_MIN_BODIES = {BH_MIN_BODIES})")
+    for n in (30, 100, 300, 1000, 1500, 3000):
+        pos = rng.normal(scale=100, size=(n, 3))
+        mass = rng.uniform(.5, 2, size=n)
+        reps = 20 if n < 1000 else 5
+        print(f"{n:>7}{best_ms(lambda: bh.build(pos, mass).accel(), reps):>12.2f}"
+              f"{best_ms(lambda: exact_accel(pos, mass), reps):>12.2f}")
+
+    print()
+    print(f"{'N':>7}{'build (ms)':>12}{'walk (ms)':>12}{'exact (ms)':>12}{'rel err':>10}{'t/(NlogN) ns':>14}"
+          f"{'pulls/body':>12}{'ns/pull':>9}")
+    for n in (1000, 2000, 5000, 10000, 20000, 50000):
+        pos = rng.normal(scale=100, size=(n, 3))
+        mass = rng.uniform(.5, 2, size=n)
+
+        t0 = time.perf_counter()
+        bh.build(pos, mass)
+        t1 = time.perf_counter()
+        acc = bh.accel()
+        t2 = time.perf_counter()
+
+        exact_ms, err = float('nan'), float('nan')
+        if n <= 10000:
+            t3 = time.perf_counter()
+            ref = exact_accel(pos, mass)
+            exact_ms = 1000 * (time.perf_counter() - t3)
+            err = np.median(np.linalg.norm(acc - ref, axis=1) / np.linalg.norm(ref, axis=1))
+        per = (t2 - t0) / (n * np.log2(n)) * 1e9
+        print(f"{n:>7}{1000 * (t1 - t0):>12.1f}{1000 * (t2 - t1):>12.1f}{exact_ms:>12.1f}{err:>10.2e}{per:>14.1f}"
+              f"{bh.pulls / n:>12.0f}{(t2 - t1) / bh.pulls * 1e9:>9.1f}")
+    print("the walk costs about the same per pull at every N, it is the pulls per body that grow faster than log N")
@@ -0,0 +1,363 @@
+"""
+File: kernels.py
+Author: Jay Kmetz
+"""
+import importlib.util
+import os
+import threading
+
+import numpy as np
+
+
+# GLOBALS
+# Compiled kernels are used when Numba is installed, NUMBA_DISABLE_JIT=1 turns them off again. Compiled code
+# is cached next to this file in __pycache__, so only the first run after a change pays for compiling.
+# Numba itself takes a few hundred ms to import, so it is only imported when a kernel is first called.
+ENABLED = importlib.util.find_spec("numba") is not None and os.environ.get("NUMBA_DISABLE_JIT", "0") in ("", "0")
+
+_compile_lock = threading.Lock()    # the sim thread and the main thread may both make the first call
+
+
+# A kernel that compiles itself on its first call
+class _Kernel:
+    def __init__(self, func):
+        self.func = func
+        self.compiled = None
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args):
+        if self.compiled is None:
+            with _compile_lock:
+                if self.compiled is None:
+                    self.compiled = self._compile()
+        return self.compiled(*args)
+
+    # An installed Numba can still fail to import, against a NumPy it doesn't support for one. The kernels
+    # are turned off then, and this call runs the plain loop.
+    def _compile(self):
+        global ENABLED
+        try:
+            import numba
+        except ImportError as e:
+            print(f"Numba did not import ({e}), using the reference implementations")
+            ENABLED = False
+            return self.func
+        return numba.njit(cache=True, nogil=True)(self.func)
+
+
+# Plain loops over arrays, compiled when Numba is around. Constants are passed in rather than read from
+# Spaceship and friends, the cache would keep whatever values they had when the kernel was compiled.
+# nogil lets the sim thread step while the main thread draws.
+def jit(func):
+    return _Kernel(func) if ENABLED else func
+
+
+# Spaceship.update for every row in place, the fused form of flight.step with the same arithmetic in the same
+# order. rot (N, 3) and thrust (N,) are flight controls. Returns a mask of the rows that ran out of fuel.
+@jit
+def ship_step(pos, vel, force, orient, rpy, fuel, health, rot, thrust, dt,
+              racc, rmax, pacc, tol, fuel_max, loss, opp_loss):
+    n = len(pos)
+    empty = np.zeros(n, dtype=np.bool_)
+    racc = racc * dt
+    for i in range(n):
+        # applyVel
+        for k in range(3):
+            pos[i, k] = dt * vel[i, k] + pos[i, k]
+
+        # adjust, rotational acceleration
+        for m in range(3):
+            r = rpy[i, m]
+            c = rot[i, m]
+            if c == 1:
+                rpy[i, m] = min(r + racc, rmax)
+            elif c == -1:
+                rpy[i, m] = max(r - racc, -rmax)
+            elif c == 2:
+                bled = r - np.sign(r) * racc
+                rpy[i, m] = 0.0 if abs(bled) <= racc else bled
+
+        # adjust, positional acceleration along the heading, flight.headings
+        w, x, y, z = orient[i, 0], orient[i, 1], orient[i, 2], orient[i, 3]
+        t = thrust[i]
+        push = np.sign(t) * pacc
+        force[i, 0] = push * (-x * -x + w * w + z * -z - -y * -y)
+        force[i, 1] = push * (-x * -y + z * w + -y * -x - w * -z)
+        force[i, 2] = push * (-x * -z + -y * w + w * -y - z * -x)
+        if t == 2:
+            speed = np.sqrt(vel[i, 0] * vel[i, 0] + vel[i, 1] * vel[i, 1] + vel[i, 2] * vel[i, 2])
+            for k in range(3):
+                if speed <= tol:
+                    force[i, k] = 0.0
+                    vel[i, k] = 0.0
+                else:
+                    force[i, k] = pacc * (-vel[i, k] / speed)
+
+        # rotate, roll about x, pitch about z, yaw about y, flight._turn
+        for m in range(3):
+            c = np.cos(rpy[i, m] * dt / 2)
+            s = np.sin(rpy[i, m] * dt / 2)
+            w, x, y, z = orient[i, 0], orient[i, 1], orient[i, 2], orient[i, 3]
+            if m == 0:
+                orient[i, 0] = w * c - x * s
+                orient[i, 1] = w * s + x * c
+                orient[i, 2] = y * c + z * s
+                orient[i, 3] = z * c - y * s
+            elif m == 1:
+                orient[i, 0] = w * c - z * s
+                orient[i, 1] = x * c + y * s
+                orient[i, 2] = y * c - x * s
+                orient[i, 3] = w * s + z * c
+            else:
+                orient[i, 0] = w * c - y * s
+                orient[i, 1] = x * c - z * s
+                orient[i, 2] = w * s + y * c
+                orient[i, 3] = z * c + x * s
+
+        # applyThrust
+        for k in range(3):
+            vel[i, k] += dt * force[i, k]
+
+        # calc_fuel_loss
+        if t == 2:
+            fuel[i] -= opp_loss * dt
+        elif t != 0:
+            fuel[i] -= loss * dt
+        if fuel[i] <= 0:
+            empty[i] = True
+            health[i] -= 1
+            fuel[i] = fuel_max
+    return empty
+
+
+# util.sweep_spheres for rows of p0, d0, ps, ds and rs, one pass and no temporaries
+@jit
+def sweep_spheres(p0, d0, r0, ps, ds, rs):
+    n = len(ps)
+    toi = np.full(n, np.inf)
+    for i in range(n):
+        rel0, rel1, rel2 = p0[i, 0] - ps[i, 0], p0[i, 1] - ps[i, 1], p0[i, 2] - ps[i, 2]
+        mov0, mov1, mov2 = d0[i, 0] - ds[i, 0], d0[i, 1] - ds[i, 1], d0[i, 2] - ds[i, 2]
+        rsum = r0 + rs[i]
+        a = mov0 * mov0 + mov1 * mov1 + mov2 * mov2
+        b = 2 * (rel0 * mov0 + rel1 * mov1 + rel2 * mov2)
+        c = rel0 * rel0 + rel1 * rel1 + rel2 * rel2 - rsum * rsum
+        if c <= 0:
+            toi[i] = 0.0    # already overlapping at the start of the step
+            continue
+        disc = b * b - 4 * a * c
+        if a > 0 and disc >= 0:
+            t = (-b - np.sqrt(disc)) / (2 * a)
+            if 0 <= t <= 1:
+                toi[i] = t
+    return toi
+
+
+# Rows of pos within reach of any obstacle at tick t, obstacles moving from opos by ovel a tick, rad2 the
+# squared contact radii. The autopilot's obstacle test without the (N, M, 3) array of differences.
+@jit
+def obstacle_hits(pos, opos, ovel, t, rad2):
+    n, m = len(pos), len(opos)
+    hit = np.zeros(n, dtype=np.bool_)
+    for j in range(m):
+        ox = opos[j, 0] + t * ovel[j, 0]
+        oy = opos[j, 1] + t * ovel[j, 1]
+        oz = opos[j, 2] + t * ovel[j, 2]
+        for i in range(n):
+            if not hit[i]:
+                dx, dy, dz = pos[i, 0] - ox, pos[i, 1] - oy, pos[i, 2] - oz
+                hit[i] = dx * dx + dy * dy + dz * dz <= rad2[j]
+    return hit
+
+
+# Faces whose corners all lie on the landing side of the plane through point with normal nvec, for a mesh
+# scaled by scale. Planet.choose_landing_spot without marking every corner of every face.
+@jit
+def landing_faces(verts, scale, nvec, d, face_verts, face_offsets):
+    marked = np.empty(len(verts), dtype=np.bool_)
+    for v in range(len(verts)):
+        marked[v] = (scale * verts[v, 0]) * nvec[0] + (scale * verts[v, 1]) * nvec[1] + (scale * verts[v, 2]) * nvec[2] >= d
+    faces = len(face_offsets) - 1
+    landable = np.ones(faces, dtype=np.bool_)
+    for f in range(faces):
+        for k in range(face_offsets[f], face_offsets[f + 1]):
+            if not marked[face_verts[k]]:
+                landable[f] = False
+                break
+    return landable
+
+
+# Every kernel checked against the code it stands in for, through the real callers with kernels.ENABLED
+# switched off and on, then how long each caller takes both ways: python -m utils.kernels
+if __name__ == "__main__":
+    import time
+
+    import numba
+
+    from pyobjs.ColObj import ColObj
+    from pyobjs.Planet import Planet
+    from pyobjs.Spaceship import Spaceship
+    from utils import autopilot, flight, util, quat
+    from utils import kernels   # the module the callers check, not this __main__ copy
+    from utils.meshgen import sphere_obj
+
+    if not ENABLED:
+        print("Numba is not installed (or NUMBA_DISABLE_JIT is set), the reference implementations are in use")
+        raise SystemExit
+
+    rng = np.random.default_rng(0)
+    TOL = 1e-9
+
+    def best_us(func, reps=200):
+        best = float('inf')
+        for i in range(reps):
+            t = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t)
+        return 1e6 * best
+
+    # func run with the kernels on or off
+    def jitted(func, mode):
+        def run():
+            enabled, kernels.ENABLED = kernels.ENABLED, mode
+            try:
+                return func()
+            finally:
+                kernels.ENABLED = enabled
+        return run
+
+    def check(name, diff, tol=TOL):
+        print(f"{name:<34} max diff {diff:.2e}")
+        assert diff <= tol, f"{name} differs by {diff}"
+
+    def report(name, func):
+        ref_us, jit_us = best_us(jitted(func, False)), best_us(jitted(func, True))
+        print(f"{name:<22} reference {ref_us:9.1f} us   jit {jit_us:8.1f} us   x{ref_us / jit_us:.1f}")
+
+    # just the flight model, no meshes or GL
+    def bare_ship(vel, orient, fuel):
+        ship = Spaceship.__new__(Spaceship)
+        ColObj.__init__(ship, (0, 0, 0), True)
+        ship.orient, ship.rpy, ship.vel, ship.force = tuple(orient), [0, 0, 0], tuple(vel), (0, 0, 0)
+        ship.actions = [Spaceship.STEADY] * 3
+        ship.thrusting = 0
+        ship.health, ship.fuel = Spaceship.HEALTH, fuel
+        ship.lose_cond_func = None
+        return ship
+
+    def state_diff(a, b):
+        return max(np.abs(getattr(a, name) - getattr(b, name)).max()
+                   for name in ("pos", "vel", "force", "orient", "rpy", "fuel", "health"))
+
+    # first calls compile, or load from the cache
+    planet_obj = sphere_obj("ico", 3, "Material.001")
+    t = time.perf_counter()
+    flight.step(flight.FlightState(4), *flight.bits_to_controls(np.zeros(4, dtype=np.int64)))
+    util.sweep_spheres(np.zeros(3), np.zeros(3), 1.0, np.zeros((1, 3)), np.zeros((1, 3)), np.ones(1))
+    kernels.obstacle_hits(np.zeros((1, 3)), np.zeros((1, 3)), np.zeros((1, 3)), 1.0, np.ones(1))
+    kernels.landing_faces(planet_obj.verts, 20.0, np.ones(3), 1.0, planet_obj.face_verts, planet_obj.face_offsets)
+    print(f"warm up (compile or cache load): {1000 * (time.perf_counter() - t):.0f} ms\n")
+
+    # flight.step both ways over 2000 ticks of random held controls, and both against Spaceship.update, at one
+    # tick a step and at a fraction of one
+    n, ticks = 64, 2000
+    vel, fuel = rng.normal(scale=.2, size=(n, 3)), rng.uniform(1, 100, n)
+    orient = rng.normal(size=(n, 4))
+    orient /= np.linalg.norm(orient, axis=1, keepdims=True)
+    held = rng.integers(0, 1 << 12, (ticks // 20, n))
+    bits = np.repeat(held, 20, axis=0)
+    for dt in (1.0, .37):
+        states = {mode: flight.FlightState(n) for mode in (False, True)}
+        for state in states.values():
+            state.vel[:] = vel
+            state.orient[:] = orient
+            state.fuel[:] = fuel
+        ships = [bare_ship(*start) for start in zip(vel.tolist(), orient.tolist(), fuel.tolist())]
+        for b in bits:
+            rot, thrust = flight.bits_to_controls(b)
+            empty = [jitted(lambda: flight.step(state, rot, thrust, dt), mode)() for mode, state in states.items()]
+            assert (empty[0] == empty[1]).all()
+            for ship, bit in zip(ships, b.tolist()):
+                ship.apply_input(bit)
+                ship.update(dt)
+        expected = flight.FlightState(n)
+        for i, ship in enumerate(ships):
+            for name in ("pos", "vel", "force", "orient", "rpy", "fuel", "health"):
+                getattr(expected, name)[i] = getattr(ship, name)
+        check(f"flight.step dt {dt}, kernels against numpy", state_diff(states[True], states[False]))
+        for mode, state in states.items():
+            check(f"flight.step dt {dt}, {'kernels' if mode else 'numpy'} against Spaceship", state_diff(state, expected))
+
+    # swept spheres, one pair as ColObj.time_of_impact asks, an asteroid field as times_of_impact does and
+    # a row of ship segments each against its own sphere as the trajectory forecast does
+    sweeps = []
+    for m, rows in ((1, False), (200, False), (200, True)):
+        ps, ds, rs = rng.uniform(-10, 10, (m, 3)), rng.normal(size=(m, 3)), rng.uniform(1, 4, m)
+        p0, d0 = rng.uniform(-10, 10, (m, 3) if rows else 3), rng.normal(size=(m, 3) if rows else 3) * 5
+        sweep = (lambda p0=p0, d0=d0, ps=ps, ds=ds, rs=rs: util.sweep_spheres(p0, d0, 2.0, ps, ds, rs))
+        ref, fast = jitted(sweep, False)(), jitted(sweep, True)()
+        assert (np.isinf(ref) == np.isinf(fast)).all()
+        hit = np.isfinite(ref)
+        assert m == 1 or hit.any()
+        check(f"util.sweep_spheres {m}{' rows' if rows else ''}", np.abs(ref[hit] - fast[hit]).max(initial=0))
+        sweeps.append((f"sweep_spheres {m}{' rows' if rows else ''}", sweep))
+
+    # autopilot obstacle costs, 1024 rollouts against 40 asteroids, some of the rollouts already over
+    state = flight.FlightState(1024)
+    state.pos[:] = rng.uniform(-50, 50, (1024, 3))
+    obs = (rng.uniform(-50, 50, (40, 3)), rng.normal(scale=.05, size=(40, 3)), rng.uniform(4, 30, 40) ** 2)
+    alive = rng.random(1024) < .8
+
+    def obstacle_cost():
+        cost = np.zeros(1024)
+        autopilot._obstacle_cost(state, obs, 30, alive, cost)
+        return cost
+
+    ref, fast = jitted(obstacle_cost, False)(), jitted(obstacle_cost, True)()
+    assert ref.any()
+    check("autopilot._obstacle_cost", np.abs(ref - fast).max())
+
+    # landing spot faces of ico planets
+    planet = Planet.__new__(Planet)
+    planet.obj, planet.radius = planet_obj, 20
+
+    def landing_spot():
+        planet.obj.face_mats[:] = 0
+        planet.choose_landing_spot()
+        return planet.obj.face_mats.copy()
+
+    diff = 0
+    for i in range(20):
+        lp = rng.normal(size=3)
+        planet.landingplanept = tuple(lp * planet.radius * rng.uniform(.3, .9) / np.linalg.norm(lp))
+        ref, fast = jitted(landing_spot, False)(), jitted(landing_spot, True)()
+        assert (ref != 0).any()
+        diff = max(diff, int((ref != fast).sum()))
+    check("Planet.choose_landing_spot", diff, 0)
+
+    # timings
+    print()
+    for m in (1, 1024):
+        one = flight.FlightState(m)
+        rot, thrust = flight.bits_to_controls(bits[0, :m] if m <= n else rng.integers(0, 1 << 12, m))
+        report(f"flight.step {m}", lambda: flight.step(one, rot, thrust))
+    ship = ships[0]
+    print(f"{'Spaceship.update':<22} {best_us(ship.update):>19.1f} us")
+    for name, sweep in sweeps:
+        report(name, sweep)
+    report("obstacle cost", obstacle_cost)
+    report("landing spot", landing_spot)
+
+    # The scalar helpers stay plain Python. On a single tuple a compiled call saves a microsecond at best, and
+    # they are only called a handful of times a tick.
+    q1, q2 = (0.5, 0.5, 0.5, 0.5), quat.axisangle_to_q((0, 1, 0), .3)
+    jq_mult = numba.njit(quat.q_mult)
+    jq_mult(q1, q2)
+    print(f"{'quat.q_mult':<22} reference {best_us(lambda: quat.q_mult(q1, q2), 2000):9.1f} us   "
+          f"jit {best_us(lambda: jq_mult(q1, q2), 2000):8.1f} us")
+    jdist = numba.njit(lambda p1, p2: np.sqrt((p2[0] - p1[0]) ** 2 + (p2[1] - p1[1]) ** 2 + (p2[2] - p1[2]) ** 2))
+    a, b = (1.0, 2.0, 3.0), (4.0, -2.0, 0.5)
+    jdist(a, b)
+    print(f"{'util.dist':<22} reference {best_us(lambda: util.dist(a, b), 2000):9.1f} us   "
+          f"jit {best_us(lambda: jdist(a, b), 2000):8.1f} us")
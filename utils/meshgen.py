@@ -0,0 +1,192 @@
+"""
+File: meshgen.py
+Author: Jay Kmetz
+"""
+import os
+import time
+
+import numpy as np
+
+from utils.DisplayObj import DisplayObj
+
+
+# GLOBALS
+CACHE_DIR = "./.cache/meshes"   # generated meshes are kept here between runs
+MESHGEN_VERSION = 1             # bump when generation changes so stale cache files are ignored
+
+ASTEROID_RADIUS = 10.5          # about the size of wfobjs/asteroid.obj
+ASTEROID_MTL = "./wfobjs/asteroid.mtl"
+
+# unit icosahedron, counter clockwise faces seen from outside
+_T = (1 + 5 ** .5) / 2
+ICO_VERTS = np.array([
+    (-1, _T, 0), (1, _T, 0), (-1, -_T, 0), (1, -_T, 0),
+    (0, -1, _T), (0, 1, _T), (0, -1, -_T), (0, 1, -_T),
+    (_T, 0, -1), (_T, 0, 1), (-_T, 0, -1), (-_T, 0, 1)
+]) / np.sqrt(1 + _T * _T)
+ICO_FACES = np.array([
+    (0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+    (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+    (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+    (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)
+])
+
+
+# Unit icosphere: every subdivision splits each triangle into four and pushes the new points out to the sphere.
+# Returns float64 verts (V, 3) and int faces (F, 3), F = 20 * 4^subdiv
+def icosphere(subdiv):
+    verts, faces = ICO_VERTS, ICO_FACES
+    for i in range(subdiv):
+        edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        uniq, inv = np.unique(edges, axis=0, return_inverse=True)  # shared edges get one midpoint
+        mids = verts[uniq].sum(axis=1)
+        mids /= np.linalg.norm(mids, axis=1)[:, None]
+        ab, bc, ca = (inv.reshape(-1, 3) + len(verts)).T
+        a, b, c = faces.T
+        faces = np.concatenate((
+            np.stack((a, ab, ca), axis=1),
+            np.stack((b, bc, ab), axis=1),
+            np.stack((c, ca, bc), axis=1),
+            np.stack((ab, bc, ca), axis=1)
+        ))
+        verts = np.concatenate((verts, mids))
+    return verts, faces
+
+
+# Unit UV sphere with rings bands of latitude and segments of longitude, triangles only
+def uv_sphere(rings, segments):
+    theta = np.linspace(0, np.pi, rings + 1)[1:-1, None]        # angle down from the top of each ring, no poles
+    phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)[None, :]
+    ring = np.stack(np.broadcast_arrays(np.sin(theta) * np.cos(phi), np.cos(theta), np.sin(theta) * np.sin(phi)), axis=2)
+    verts = np.concatenate(([(0, 1, 0)], ring.reshape(-1, 3), [(0, -1, 0)]))
+
+    seg = np.arange(segments)
+    nxt = (seg + 1) % segments
+    top = 1 + np.arange(rings - 2)[:, None] * segments     # first vertex of each ring but the last
+    a, b = top + seg, top + nxt                             # this ring
+    c, d = a + segments, b + segments                       # next ring down
+    last = 1 + (rings - 2) * segments
+    faces = np.concatenate((
+        np.stack((np.zeros(segments, dtype=int), 1 + nxt, 1 + seg), axis=1),
+        np.stack((a, b, d), axis=2).reshape(-1, 3),
+        np.stack((a, d, c), axis=2).reshape(-1, 3),
+        np.stack((np.full(segments, len(verts) - 1), last + seg, last + nxt), axis=1)
+    ))
+    return verts, faces
+
+
+# one outward normal per triangle
+def flat_normals(verts, faces):
+    n = np.cross(verts[faces[:, 1]] - verts[faces[:, 0]], verts[faces[:, 2]] - verts[faces[:, 0]])
+    return n / np.linalg.norm(n, axis=1)[:, None]
+
+
+# longitude/latitude texture coordinates for points on a sphere
+def spherical_uvs(verts):
+    unit = verts / np.linalg.norm(verts, axis=1)[:, None]
+    u = .5 + np.arctan2(unit[:, 2], unit[:, 0]) / (2 * np.pi)
+    v = .5 + np.arcsin(np.clip(unit[:, 1], -1, 1)) / np.pi
+    return np.stack((u, v), axis=1)
+
+
+# DisplayObj from a triangle mesh with flat shading and a single material
+def triangles_to_obj(verts, faces, uvs=None, mat_name=None):
+    obj = DisplayObj()
+    nfaces = len(faces)
+    obj.set_arrays(
+        verts, flat_normals(verts, faces),
+        faces.ravel(), np.arange(0, 3 * nfaces + 1, 3), np.arange(nfaces),
+        uvs=uvs, face_uvs=faces.ravel() if uvs is not None else None,
+        face_mats=np.zeros(nfaces) if mat_name else None, mat_names=[mat_name] if mat_name else None
+    )
+    return obj
+
+
+# Unit sphere DisplayObj with one material. "ico" detail is icosphere subdivisions, "uv" detail is rings.
+# The geometry is built once per (kind, detail) and shared, only the per-face materials are per object
+# so faces can be recolored (landing zones).
+_sphere_cache = {}
+
+
+def sphere_obj(kind="ico", detail=3, mat_name=None):
+    if (kind, detail) not in _sphere_cache:
+        verts, faces = icosphere(detail) if kind == "ico" else uv_sphere(detail, 2 * detail)
+        _sphere_cache[kind, detail] = triangles_to_obj(verts, faces)
+    shared = _sphere_cache[kind, detail]
+
+    obj = DisplayObj()
+    obj.set_arrays(
+        shared.verts, shared.norms, shared.face_verts, shared.face_offsets, shared.face_norms,
+        face_mats=np.zeros(shared.num_faces) if mat_name else None, mat_names=[mat_name] if mat_name else None
+    )
+    return obj
+
+
+# Seeded lumpy rock: an icosphere pushed in and out by a sum of random waves, dented by a few craters
+# and stretched along random axes.
+def asteroid_shape(seed, detail):
+    rng = np.random.default_rng(seed)
+    verts, faces = icosphere(detail)
+
+    # low frequency lumps
+    nwaves = 12
+    dirs = rng.normal(size=(nwaves, 3))
+    dirs /= np.linalg.norm(dirs, axis=1)[:, None]
+    freqs = rng.uniform(1.5, 5, nwaves)
+    phases = rng.uniform(0, 2 * np.pi, nwaves)
+    amps = rng.uniform(.5, 1, nwaves) / freqs
+    lumps = np.cos((verts @ dirs.T) * freqs + phases) @ amps
+    r = 1 + .35 * lumps / np.abs(lumps).max()
+
+    # craters, a smooth bowl within each crater's angular radius
+    ncraters = rng.integers(2, 6)
+    centers = rng.normal(size=(ncraters, 3))
+    centers /= np.linalg.norm(centers, axis=1)[:, None]
+    sizes = rng.uniform(.25, .6, ncraters)
+    ang = np.arccos(np.clip(verts @ centers.T, -1, 1)) / sizes     # < 1 inside the crater
+    r -= (.12 * sizes * np.clip(1 - ang * ang, 0, None)).sum(axis=1)
+
+    stretch = rng.uniform(.75, 1.25, 3)
+    return verts * r[:, None] * stretch * ASTEROID_RADIUS, faces
+
+
+def _cache_fname(kind, seed, detail):
+    return os.path.join(CACHE_DIR, f"{kind}_v{MESHGEN_VERSION}_s{seed}_d{detail}.npz")
+
+
+# Asteroid variant as a DisplayObj, generated once per (seed, detail) and then read back from disk
+def asteroid_variant(seed, detail=2):
+    obj = DisplayObj()
+    fname = _cache_fname("asteroid", seed, detail)
+    if os.path.exists(fname):
+        with np.load(fname) as data:
+            obj.set_arrays(**data)
+    else:
+        verts, faces = asteroid_shape(seed, detail)
+        obj = triangles_to_obj(verts, faces, spherical_uvs(verts), "asteroid.001")
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.savez(fname, **obj.arrays())
+
+    # textured with the same material as the stock asteroid
+    obj.curdir = os.path.dirname(os.path.abspath(ASTEROID_MTL))
+    obj.mats = obj.loadMats(ASTEROID_MTL)
+    obj.name = f"asteroid_{seed}"
+    return obj
+
+
+# Load time comparison: python -m utils.meshgen
+if __name__ == "__main__":
+    def best_ms(func, reps=5):
+        best = float('inf')
+        for i in range(reps):
+            t = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - t)
+        return 1000 * best
+
+    print(f"asteroid.obj import: {best_ms(lambda: DisplayObj().objFileImport('./wfobjs/asteroid')):.2f} ms")
+    for detail in (1, 2, 3, 4):
+        gen = best_ms(lambda: triangles_to_obj(*asteroid_shape(0, detail)))
+        asteroid_variant(0, detail)     # make sure it is cached
+        cached = best_ms(lambda: asteroid_variant(0, detail))
+        print(f"detail {detail} ({20 * 4 ** detail:>5} faces): generate {gen:7.2f} ms, cached {cached:6.2f} ms")
@@ -0,0 +1,495 @@
+"""
+File: net.py
+Author: Jay Kmetz
+"""
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from utils.flight import *
+
+
+# GLOBALS
+HOST = "127.0.0.1"
+PORT = 47470
+TICK_RATE = 60
+SNAPSHOT_EVERY = 3      # ticks between snapshots
+INPUT_REDUNDANCY = 8    # every input packet repeats the latest ticks, a lost packet is covered by the next one
+HISTORY = 256           # ticks of inputs, predicted states and snapshots kept for baselines and replays
+STALL_MS = 250          # the server stops waiting for a late player and repeats their last input
+JOIN_RETRY = .1         # seconds between join attempts
+DESYNC_TOL = 1e-3       # how far a predicted ship may be from the server's before it is corrected
+MAX_PACKET = 1400
+NO_BASE = 0xFFFFFFFF
+NO_PLAYER = 0xFF
+START = (0.0, 0.0, 0.0)     # where every ship starts a level, and goes back to after a crash
+
+# race events, carried on the input bitsets above the action bits
+EVENT_HIT = 1 << 28     # hit an asteroid, costs health
+EVENT_CRASH = 1 << 29   # crashed into a planet, costs health and goes back to the start
+EVENT_LANDED = 1 << 30  # landed on the target, wins the level
+EVENTS = EVENT_HIT | EVENT_CRASH | EVENT_LANDED
+
+# message types
+JOIN = 1
+WELCOME = 2
+INPUT = 3
+SNAPSHOT = 4
+
+JOIN_MSG = struct.Struct('<B')
+WELCOME_MSG = struct.Struct('<BBBQ')        # type, player (NO_PLAYER if full), players, level seed
+INPUT_MSG = struct.Struct('<BBIIB')         # type, player, last tick, newest snapshot held, ticks of bits that follow
+SNAPSHOT_MSG = struct.Struct('<BIIHBB')     # type, tick, baseline tick, level, last winner, ships that follow
+SHIP_ENTRY = struct.Struct('<BB')           # ship, mask of the fields that follow
+BITS = np.dtype('<u4')
+
+# ship fields of a snapshot in wire order: (name, dtype, width). A delta carries only the fields that changed.
+FIELDS = (
+    ('pos', np.dtype('<f4'), 3),
+    ('vel', np.dtype('<f4'), 3),
+    ('orient', np.dtype('<f4'), 4),
+    ('rpy', np.dtype('<f4'), 3),        # spin rates, a ship can't be replayed forwards from a snapshot without them
+    ('health', np.dtype('<i2'), 1),
+    ('fuel', np.dtype('<f4'), 1)
+)
+
+
+# Race rules after a tick's step, the same on the server and in client replays. Hits cost health, a crash
+# also sends the ship back to the start, and a ship out of health starts over with full health.
+# Returns the mask of ships that landed.
+def apply_events(state, bits):
+    bits = np.asarray(bits, dtype=np.int64)
+    state.health -= (bits & (EVENT_HIT | EVENT_CRASH) != 0)
+    dead = state.health <= 0
+    restart = (bits & EVENT_CRASH != 0) | dead
+    state.pos[restart] = START
+    state.vel[restart] = 0
+    state.force[restart] = 0
+    state.rpy[restart] = 0
+    state.health[dead] = Spaceship.HEALTH
+    return bits & EVENT_LANDED != 0
+
+
+# snapshot fields of every ship in a flight state, as they go on the wire
+def capture(state):
+    return {name: np.asarray(getattr(state, name)).astype(dtype).reshape(len(state), width)
+            for name, dtype, width in FIELDS}
+
+
+# flight state of ship i in a snapshot
+def restore(ships, i):
+    state = FlightState(1)
+    for name, dtype, width in FIELDS:
+        getattr(state, name)[:] = ships[name][i].reshape(getattr(state, name).shape)
+    return state
+
+
+# Snapshot message of every ship. Against a baseline only the fields that differ from it are written, and
+# ships with nothing new are left out altogether.
+def encode_snapshot(tick, level, winner, ships, base_tick=NO_BASE, base=None):
+    parts = []
+    count = 0
+    for i in range(len(ships['pos'])):
+        mask = 0
+        fields = []
+        for f, (name, dtype, width) in enumerate(FIELDS):
+            row = ships[name][i]
+            if base is None or row.tobytes() != base[name][i].tobytes():
+                mask |= 1 << f
+                fields.append(row.tobytes())
+        if mask:
+            parts.append(SHIP_ENTRY.pack(i, mask))
+            parts.extend(fields)
+            count += 1
+    return SNAPSHOT_MSG.pack(SNAPSHOT, tick, base_tick, level, winner, count) + b''.join(parts)
+
+
+# (tick, level, winner, ships) from a snapshot message, None if its baseline isn't in baselines
+def decode_snapshot(data, players, baselines):
+    kind, tick, base_tick, level, winner, count = SNAPSHOT_MSG.unpack_from(data)
+    if base_tick == NO_BASE:
+        ships = {name: np.zeros((players, width), dtype) for name, dtype, width in FIELDS}
+    elif base_tick in baselines:
+        ships = {name: rows.copy() for name, rows in baselines[base_tick].items()}
+    else:
+        return None
+    at = SNAPSHOT_MSG.size
+    for n in range(count):
+        i, mask = SHIP_ENTRY.unpack_from(data, at)
+        at += SHIP_ENTRY.size
+        for f, (name, dtype, width) in enumerate(FIELDS):
+            if mask & 1 << f:
+                ships[name][i] = np.frombuffer(data, dtype, width, at)
+                at += dtype.itemsize * width
+    return tick, level, winner, ships
+
+
+# Authoritative race over UDP. Players send the input bits of every tick, the server steps every ship in
+# lockstep once it has all of a tick's inputs (or has waited STALL_MS for a late player) and sends each player
+# snapshots delta-compressed against the newest snapshot that player says it has.
+class Server:
+    def __init__(self, players=2, seed=None, host=HOST, port=PORT, dt=1.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = self.sock.getsockname()
+        self.players = players
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.dt = dt
+
+        self.addrs = []     # player -> address
+        self.inputs = [{} for p in range(players)]     # player -> {tick: bits} not simulated yet
+        self.held = np.zeros(players, dtype=np.int64)   # last action bits of every player
+        self.acks = [NO_BASE] * players     # newest snapshot each player has
+        self.state = FlightState(players)
+        self.tick = 0
+        self.level = 1
+        self.winner = NO_PLAYER
+        self.started = False
+        self.history = {}   # tick -> snapshot fields, the baselines deltas are made against
+        self.waiting_since = None
+
+        self.bytes_in = np.zeros(players, dtype=np.int64)
+        self.bytes_out = np.zeros(players, dtype=np.int64)
+        self.full_bytes = self.delta_bytes = self.deltas = 0
+        self.stalls = 0
+        self.started_at = None
+        self._thread = None
+        self._running = False
+
+    # serve from a background thread
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self.serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self.sock.close()
+
+    def serve(self):
+        while self._running:
+            self.poll(.005)
+
+    # take whatever has arrived, waiting at most timeout seconds for it, then step every tick that is ready
+    def poll(self, timeout=0.0):
+        if select.select([self.sock], [], [], timeout)[0]:
+            while True:
+                try:
+                    data, addr = self.sock.recvfrom(MAX_PACKET)
+                except (BlockingIOError, ConnectionResetError):
+                    break
+                self._receive(data, addr)
+        while self.started and self._advance():
+            pass
+
+    def _receive(self, data, addr):
+        kind = data[0]
+        if kind == JOIN:
+            if addr in self.addrs:      # a welcome got lost
+                player = self.addrs.index(addr)
+            elif len(self.addrs) < self.players:
+                player = len(self.addrs)
+                self.addrs.append(addr)
+            else:
+                player = NO_PLAYER
+            self.sock.sendto(WELCOME_MSG.pack(WELCOME, player, self.players, self.seed), addr)
+            if not self.started and len(self.addrs) == self.players:
+                self.started = True
+                self.started_at = time.perf_counter()
+                self._broadcast()   # everyone starts from the tick 0 snapshot
+        elif kind == INPUT and len(data) >= INPUT_MSG.size:
+            kind, player, last, ack, n = INPUT_MSG.unpack_from(data)
+            if player >= len(self.addrs) or self.addrs[player] != addr:
+                return
+            self.bytes_in[player] += len(data)
+            if ack != NO_BASE and (self.acks[player] == NO_BASE or ack > self.acks[player]):
+                self.acks[player] = ack
+            bits = np.frombuffer(data, BITS, n, INPUT_MSG.size)
+            for tick, b in zip(range(last - n + 1, last + 1), bits):
+                if self.tick < tick <= self.tick + HISTORY:
+                    self.inputs[player][tick] = int(b)
+
+    # step the next tick if every player's input for it is in or the wait for it is over
+    def _advance(self):
+        tick = self.tick + 1
+        if any(tick not in inputs for inputs in self.inputs):
+            now = time.perf_counter()
+            if self.waiting_since is None:
+                self.waiting_since = now
+            if now - self.waiting_since < STALL_MS / 1000:
+                return False
+            self.stalls += 1
+        self.waiting_since = None
+
+        # a player who is late flies on with their last actions, without repeating their events
+        bits = np.array([inputs.pop(tick, held) for inputs, held in zip(self.inputs, self.held)], dtype=np.int64)
+        self.held[:] = bits & ~EVENTS
+        rot, thrust = bits_to_controls(bits)
+        step(self.state, rot, thrust, self.dt)
+        landed = apply_events(self.state, bits)
+        self.tick = tick
+
+        if landed.any():    # first to land wins, everyone goes on to the next level from the start
+            self.winner = int(np.flatnonzero(landed)[0])
+            self.level += 1
+            self.state = FlightState(self.players)
+            self._broadcast()
+        elif tick % SNAPSHOT_EVERY == 0:
+            self._broadcast()
+        return True
+
+    def _broadcast(self):
+        ships = capture(self.state)
+        self.history[self.tick] = ships
+        for old in [t for t in self.history if t < self.tick - HISTORY]:
+            del self.history[old]
+        for player, addr in enumerate(self.addrs):
+            base = self.history.get(self.acks[player])
+            if base is None:
+                msg = encode_snapshot(self.tick, self.level, self.winner, ships)
+                self.full_bytes = len(msg)
+            else:
+                msg = encode_snapshot(self.tick, self.level, self.winner, ships, self.acks[player], base)
+                self.delta_bytes += len(msg)
+                self.deltas += 1
+            self.sock.sendto(msg, addr)
+            self.bytes_out[player] += len(msg)
+
+    # per player traffic in kbit/s, ticks per second, average snapshot sizes
+    def stats(self):
+        elapsed = max(time.perf_counter() - (self.started_at or time.perf_counter()), 1e-9)
+        return {
+            'kbps_in': self.bytes_in * 8 / 1000 / elapsed,
+            'kbps_out': self.bytes_out * 8 / 1000 / elapsed,
+            'tick_rate': self.tick / elapsed,
+            'full_bytes': self.full_bytes,
+            'delta_bytes': self.delta_bytes / max(self.deltas, 1),
+            'stalls': self.stalls
+        }
+
+
+# One player's end of the race. Sends this player's input bits every tick and keeps the newest snapshot of
+# every ship. The player's own ship is predicted locally with the same flight model the server runs, so it
+# only needs correcting when the server saw something different (a late input, a new level).
+# Never blocks after joining, poll() just drains the socket.
+class Client:
+    def __init__(self, host=HOST, port=PORT, timeout=5.0, dt=1.0, loss=0.0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.server = (host, port)
+        self.dt = dt
+        self.rate = TICK_RATE
+        self.loss = loss    # fraction of outgoing packets dropped on purpose, loopback never loses any
+        self.rng = random.Random(0)
+        self.player, self.players, self.seed = self._join(timeout)
+
+        self.tick = 0       # last tick sent
+        self.first = 1      # first tick sent, nothing before it can be repeated
+        self.inputs = np.zeros(HISTORY, dtype=np.int64)
+        self.sent_at = np.zeros(HISTORY)
+        self.predicted = FlightState(HISTORY)   # own ship after each tick, by tick % HISTORY
+        self.predicted_tick = np.full(HISTORY, -1)
+
+        self.snapshots = {}     # tick -> snapshot fields, baselines for the server's deltas
+        self.snapshot = None    # newest (tick, level, winner, ships)
+        self.level = 0
+        self.winner = NO_PLAYER
+        self.ack = NO_BASE
+        self.checked = -1       # newest snapshot tick the prediction was checked against
+        self.checked_level = 0
+
+        self.latency = deque(maxlen=4 * TICK_RATE)  # seconds from sending a tick to a snapshot that covers it
+        self.corrections = 0
+        self.bytes_in = self.bytes_out = 0
+        self.started_at = time.perf_counter()
+
+    def _join(self, timeout):
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            self.sock.sendto(JOIN_MSG.pack(JOIN), self.server)
+            if select.select([self.sock], [], [], JOIN_RETRY)[0]:
+                try:
+                    data = self.sock.recv(MAX_PACKET)
+                except ConnectionResetError:    # nobody listening yet
+                    continue
+                if data[0] == WELCOME:
+                    kind, player, players, seed = WELCOME_MSG.unpack(data)
+                    if player == NO_PLAYER:
+                        raise ConnectionError(f"race at {self.server} is full")
+                    return player, players, seed
+        raise ConnectionError(f"no race at {self.server}")
+
+    def close(self):
+        self.sock.close()
+
+    # the first snapshot arrives once every player has joined
+    @property
+    def started(self):
+        return self.snapshot is not None
+
+    # Input bits for the next tick and the own ship's flight state after it
+    def send(self, bits, state):
+        self.tick += 1
+        k = self.tick % HISTORY
+        self.inputs[k] = bits
+        self.sent_at[k] = time.perf_counter()
+        self._predict(self.tick, state)
+
+        n = min(INPUT_REDUNDANCY, self.tick - self.first + 1)
+        ticks = np.arange(self.tick - n + 1, self.tick + 1) % HISTORY
+        msg = INPUT_MSG.pack(INPUT, self.player, self.tick, self.ack, n) + self.inputs[ticks].astype(BITS).tobytes()
+        if self.rng.random() >= self.loss:
+            self.sock.sendto(msg, self.server)
+        self.bytes_out += len(msg)
+
+    def _predict(self, tick, state):
+        k = tick % HISTORY
+        for name in ('pos', 'vel', 'force', 'orient', 'rpy', 'fuel', 'health'):
+            getattr(self.predicted, name)[k] = getattr(state, name)[0]
+        self.predicted_tick[k] = tick
+
+    # take every snapshot that has arrived, True if there was a new one
+    def poll(self):
+        fresh = False
+        while True:
+            try:
+                data = self.sock.recv(MAX_PACKET)
+            except (BlockingIOError, ConnectionResetError):
+                break
+            self.bytes_in += len(data)
+            if data[0] != SNAPSHOT:
+                continue
+            snap = decode_snapshot(data, self.players, self.snapshots)
+            if snap is None or (self.snapshot and snap[0] <= self.snapshot[0]):
+                continue
+            self._received(snap)
+            fresh = True
+        return fresh
+
+    def _received(self, snap):
+        tick, level, winner, ships = snap
+        now = time.perf_counter()
+        if self.snapshot is None:   # the race starts after this tick
+            self.tick = tick
+            self.first = tick + 1
+        else:
+            for t in range(max(self.snapshot[0] + 1, tick - HISTORY + 1, self.first), min(tick, self.tick) + 1):
+                self.latency.append(now - self.sent_at[t % HISTORY])
+        self.snapshot = snap
+        self.snapshots[tick] = ships
+        for old in [t for t in self.snapshots if t < tick - HISTORY]:
+            del self.snapshots[old]
+        self.ack = tick
+        self.level = level
+        self.winner = winner
+
+    # Own ship as the server has it in the newest snapshot, replayed through this player's inputs since.
+    # None while the prediction agrees with the server.
+    def reconcile(self):
+        if self.snapshot is None or self.snapshot[0] <= self.checked:
+            return None
+        tick, level, winner, ships = self.snapshot
+        self.checked = tick
+        if tick > self.tick:    # the server went on without us, skip ahead
+            self.tick = tick
+        k = tick % HISTORY
+        new_level = level != self.checked_level
+        self.checked_level = level
+        if not new_level and self.predicted_tick[k] == tick:
+            if all(np.allclose(ships[name][self.player], getattr(self.predicted, name)[k], rtol=0, atol=DESYNC_TOL)
+                   for name, dtype, width in FIELDS):
+                return None
+
+        state = restore(ships, self.player)
+        for t in range(tick + 1, self.tick + 1):
+            bits = self.inputs[t % HISTORY:t % HISTORY + 1]
+            rot, thrust = bits_to_controls(bits)
+            step(state, rot, thrust, self.dt)
+            apply_events(state, bits)
+            self._predict(t, state)
+        self.corrections += 1
+        return state
+
+    # (player, position, orientation) of every other ship, carried forwards from the snapshot to now
+    def rivals(self):
+        if self.snapshot is None:
+            return []
+        tick, level, winner, ships = self.snapshot
+        ahead = max(self.tick - tick, 0) * self.dt
+        return [(p, ships['pos'][p] + ahead * ships['vel'][p], ships['orient'][p])
+                for p in range(self.players) if p != self.player]
+
+    # traffic in kbit/s and tick latency in ms
+    def stats(self):
+        elapsed = max(time.perf_counter() - self.started_at, 1e-9)
+        latency = 1000 * np.array(self.latency) if self.latency else np.zeros(1)
+        return {
+            'kbps_in': self.bytes_in * 8 / 1000 / elapsed,
+            'kbps_out': self.bytes_out * 8 / 1000 / elapsed,
+            'latency_ms': latency.mean(),
+            'latency_p95_ms': np.percentile(latency, 95),
+            'corrections': self.corrections
+        }
+
+    def report(self):
+        s = self.stats()
+        return (f"up {s['kbps_out']:.1f} / down {s['kbps_in']:.1f} kbit/s, "
+                f"tick latency {s['latency_ms']:.1f} ms (p95 {s['latency_p95_ms']:.1f}), {s['corrections']} corrections")
+
+
+# Two scripted players racing over loopback, one of them losing a tenth of its packets: python -m utils.net
+if __name__ == "__main__":
+    import sys
+
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    server = Server(players=2, seed=7, port=0).start()
+    clients = [Client(port=server.address[1]), Client(port=server.address[1], loss=.1)]
+    while not all(c.poll() or c.started for c in clients):
+        time.sleep(.001)
+
+    rng = np.random.default_rng(0)
+    ships = [FlightState(1) for c in clients]
+    held = [0, 0]
+    start = time.perf_counter()
+    for n in range(ticks):
+        for p, (client, ship) in enumerate(zip(clients, ships)):
+            if rng.random() < .05:      # pilots hold their keys for a while
+                held[p] = int(controls_to_bits(rng.integers(-1, 3, size=(1, 3)), rng.integers(-1, 3, size=1))[0])
+            bits = held[p]
+            if p == 0 and n == ticks // 3:
+                bits |= EVENT_CRASH
+            if p == 1 and n == 2 * ticks // 3:
+                bits |= EVENT_LANDED
+            rot, thrust = bits_to_controls(np.array([bits]))
+            step(ship, rot, thrust)
+            apply_events(ship, [bits])
+            client.send(bits, ship)
+            client.poll()
+            corrected = client.reconcile()
+            if corrected is not None:
+                ships[p] = corrected
+        time.sleep(max(0.0, start + (n + 1) / TICK_RATE - time.perf_counter()))
+
+    time.sleep(STALL_MS / 1000 / 5)     # long enough for the server to take the last ticks, not to stall on them
+    server.stop()
+
+    stats = server.stats()
+    print(f"{ticks} ticks, server at tick {server.tick}, level {server.level}, winner player {server.winner}, "
+          f"{stats['tick_rate']:.1f} ticks/s, {stats['stalls']} stalls")
+    print(f"snapshot: {stats['full_bytes']} bytes full, {stats['delta_bytes']:.1f} bytes average delta")
+    for p, (client, ship) in enumerate(zip(clients, ships)):
+        s = client.stats()
+        print(f"player {p}: server sent {stats['kbps_out'][p]:.1f} kbit/s, received {stats['kbps_in'][p]:.1f} kbit/s")
+        print(f"  {client.report()}")
+        drift = np.abs(ship.pos[0] - server.state.pos[p]).max() if client.tick == server.tick else float('nan')
+        print(f"  prediction vs server at tick {server.tick}: {drift:.3g}")
@@ -0,0 +1,161 @@
+"""
+File: particles.py
+Author: Jay Kmetz
+"""
+import time
+
+import numpy as np
+from OpenGL.GL import *
+
+
+# GLOBALS
+CAPACITY = 100_000      # particles alive at once, the oldest are overwritten past this
+DAMPING = .98           # velocity kept per tick
+POINT_SIZE = 6.0
+ATTENUATION = (1.0, 0.0, 0.0005)    # point size falls off with distance squared
+
+# exhaust colors by Spaceship.thrusting, the same hues setThrusterColor gives the thruster
+THRUST_COLORS = {
+    1: (0.160080, 0.640000, 0.632630, 0.9),     # forwards
+    -1: (0.800000, 0.002302, 0.001986, 0.9),    # backwards
+    2: (0.007062, 0.800000, 0.000000, 0.9)      # stabilize
+}
+EXHAUST_RATE = 40       # particles per tick while thrusting
+EXHAUST_SPEED = .6
+EXHAUST_SPREAD = .08
+EXHAUST_LIFE = 40       # ticks
+
+IMPACT_COLOR = (1.0, 0.55, 0.15, 1.0)
+IMPACT_SPREAD = .35
+IMPACT_LIFE = 90
+
+
+# Fixed pool of particles in a ring buffer of arrays. Emitting writes over the oldest slots, every live
+# particle moves in one vectorized step into preallocated arrays, and the pool draws as one batch of points.
+class ParticleSystem:
+    def __init__(self, capacity=CAPACITY, seed=None):
+        self.capacity = capacity
+        self.pos = np.zeros((capacity, 3), dtype=np.float32)
+        self.vel = np.zeros((capacity, 3), dtype=np.float32)
+        self.age = np.zeros(capacity, dtype=np.float32)
+        self.life = np.ones(capacity, dtype=np.float32)
+        self.alpha = np.zeros(capacity, dtype=np.float32)          # starting alpha
+        self.colors = np.zeros((capacity, 4), dtype=np.float32)    # color as drawn, alpha fades with age
+        self._step = np.zeros((capacity, 3), dtype=np.float32)     # scratch for the update
+        self._fade = np.zeros(capacity, dtype=np.float32)
+        self.head = 0       # next slot to write
+        self.count = 0      # slots written so far, the pool is full once this reaches capacity
+        self.rng = np.random.default_rng(seed)
+
+    # slot ranges for the next n particles, at most two when the ring wraps
+    def _ranges(self, n):
+        end = self.head + n
+        if end <= self.capacity:
+            return ((self.head, end),)
+        return (self.head, self.capacity), (0, end - self.capacity)
+
+    # n particles at pos moving at vel plus a normal spread, living life ticks (give or take half)
+    def emit(self, n, pos, vel, spread, life, color):
+        n = min(int(n), self.capacity)
+        for a, b in self._ranges(n):
+            self.pos[a:b] = pos
+            self.rng.standard_normal(dtype=np.float32, out=self.vel[a:b])
+            self.vel[a:b] *= spread
+            self.vel[a:b] += vel
+            self.age[a:b] = 0
+            self.rng.random(dtype=np.float32, out=self.life[a:b])
+            self.life[a:b] *= life
+            self.life[a:b] += .5 * life
+            self.colors[a:b] = color
+            self.alpha[a:b] = color[3]
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    # move and age every particle, nothing is allocated
+    def update(self, dt=1.0):
+        n = self.count
+        pos, vel = self.pos[:n], self.vel[:n]
+        np.multiply(vel, dt, out=self._step[:n])
+        pos += self._step[:n]
+        vel *= DAMPING ** dt
+        age, fade = self.age[:n], self._fade[:n]
+        age += dt
+        # alpha = starting alpha * (1 - age / life), 0 once dead
+        np.divide(age, self.life[:n], out=fade)
+        np.subtract(1, fade, out=fade)
+        np.maximum(fade, 0, out=fade)
+        np.multiply(self.alpha[:n], fade, out=self.colors[:n, 3])
+
+    # one draw for the whole pool, dead particles have faded to nothing
+    def draw(self):
+        if not self.count:
+            return
+        glPushAttrib(GL_ENABLE_BIT | GL_POINT_BIT | GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE)   # additive, order doesn't matter
+        glDepthMask(GL_FALSE)               # particles don't hide each other
+        glEnable(GL_POINT_SMOOTH)
+        glPointSize(POINT_SIZE)
+        glPointParameterfv(GL_POINT_DISTANCE_ATTENUATION, ATTENUATION)
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, self.pos)
+        glColorPointer(4, GL_FLOAT, 0, self.colors)
+        glDrawArrays(GL_POINTS, 0, self.count)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glPopAttrib()
+
+
+# Exhaust for this tick from the nozzle the ship is firing: forward thrust blows out the back, backward
+# thrust out the front, and stabilizing blows along the ship's velocity to slow it down.
+def emit_thruster(system, ship, rate=EXHAUST_RATE):
+    if ship.thrusting not in THRUST_COLORS:
+        return
+    if ship.thrusting == 2:
+        speed = np.linalg.norm(ship.vel)
+        if speed == 0:
+            return
+        out = np.asarray(ship.vel) / speed
+    else:
+        out = -ship.thrusting * np.asarray(ship.getHeading())
+    nozzle = np.asarray(ship.pos) + .9 * ship.colr * out
+    system.emit(rate, nozzle, np.asarray(ship.vel) + EXHAUST_SPEED * out, EXHAUST_SPREAD, EXHAUST_LIFE,
+                THRUST_COLORS[ship.thrusting])
+
+
+# Debris burst where something hit, size scales the particle count
+def emit_impact(system, point, vel=(0, 0, 0), size=1.0, color=IMPACT_COLOR):
+    system.emit(1500 * size, point, vel, IMPACT_SPREAD * size ** .5, IMPACT_LIFE, color)
+
+
+# Update cost and allocations with a full pool: python -m utils.particles
+if __name__ == "__main__":
+    import tracemalloc
+
+    system = ParticleSystem(seed=0)
+    for i in range(CAPACITY // 1500 + 1):
+        emit_impact(system, (i, 0, 0), size=1.0)
+    print(f"live particles: {system.count}")
+
+    system.update()     # first call sets up numpy's ufunc machinery
+    frames = 300
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    t = time.perf_counter()
+    for i in range(frames):
+        system.update()
+    ms = 1000 * (time.perf_counter() - t) / frames
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"update: {ms:.3f} ms/frame, {ms * 1e6 / system.count:.1f} ns/particle")
+    print(f"allocated during updates: peak {peak - base} bytes, kept {current - base} bytes "
+          f"(pool is {system.pos.nbytes * 3 + system.colors.nbytes + system.age.nbytes * 4} bytes)")
+
+    t = time.perf_counter()
+    for i in range(frames):
+        system.emit(EXHAUST_RATE, (0, 0, 0), (1, 0, 0), EXHAUST_SPREAD, EXHAUST_LIFE, THRUST_COLORS[1])
+    print(f"exhaust emit: {1e6 * (time.perf_counter() - t) / frames:.1f} us/tick")
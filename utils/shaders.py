@@ -0,0 +1,378 @@
+"""
+File: shaders.py
+Author: Jay Kmetz
+"""
+import ctypes
+import time
+
+import numpy as np
+from OpenGL.GL import *
+from OpenGL.GL.shaders import compileProgram, compileShader
+
+from utils.DisplayObj import DisplayObj, Material
+from utils.glpool import pool, BUFFER
+from utils.quat import qv_mult
+from utils.util import add_vecs
+
+
+# GLOBALS
+MAX_LIGHTS = 8
+MAX_MATERIALS = 8       # materials per mesh, the most any wfobjs mesh has is 6
+SHININESS = 24.0
+AMBIENT = (1.0, 197/255, 143/255)   # same gentle orange glow as init_lighting
+
+# vertex layout: position, normal, uv, material slot
+VERTEX = np.dtype([('pos', '<f4', 3), ('norm', '<f4', 3), ('uv', '<f4', 2), ('mat', '<f4')])
+
+VERTEX_SHADER = f"""
+#version 120
+uniform vec3 mat_ambient[{MAX_MATERIALS}];
+uniform vec3 mat_diffuse[{MAX_MATERIALS}];
+uniform vec3 mat_specular[{MAX_MATERIALS}];
+uniform vec3 mat_emission[{MAX_MATERIALS}];
+attribute float material;
+varying vec3 v_pos;
+varying vec3 v_normal;
+varying vec2 v_uv;
+varying vec3 v_ambient;
+varying vec3 v_diffuse;
+varying vec3 v_specular;
+varying vec3 v_emission;
+
+void main() {{
+    vec4 eye = gl_ModelViewMatrix * gl_Vertex;
+    int m = int(material + .5);
+    v_pos = eye.xyz;
+    v_normal = gl_NormalMatrix * gl_Normal;
+    v_uv = gl_MultiTexCoord0.xy;
+    v_ambient = mat_ambient[m];
+    v_diffuse = mat_diffuse[m];
+    v_specular = mat_specular[m];
+    v_emission = mat_emission[m];
+    gl_Position = gl_ProjectionMatrix * eye;
+}}
+"""
+
+FRAGMENT_SHADER = f"""
+#version 120
+uniform int light_count;
+uniform vec4 light_pos[{MAX_LIGHTS}];       // eye space, w is 0 for directional lights
+uniform vec3 light_diffuse[{MAX_LIGHTS}];
+uniform vec3 light_specular[{MAX_LIGHTS}];
+uniform vec4 light_spot[{MAX_LIGHTS}];      // eye space direction and cosine of the cutoff, -1 for none
+uniform vec3 ambient;
+uniform float shininess;
+uniform bool textured;
+uniform sampler2D tex;
+varying vec3 v_pos;
+varying vec3 v_normal;
+varying vec2 v_uv;
+varying vec3 v_ambient;
+varying vec3 v_diffuse;
+varying vec3 v_specular;
+varying vec3 v_emission;
+
+void main() {{
+    vec3 n = normalize(v_normal);
+    vec3 to_eye = normalize(-v_pos);
+    vec3 diffuse = textured ? texture2D(tex, v_uv).rgb : v_diffuse;
+    vec3 color = v_emission + ambient * (textured ? diffuse : v_ambient);
+    for (int i = 0; i < {MAX_LIGHTS}; i++) {{
+        if (i >= light_count)
+            break;
+        vec3 l = light_pos[i].w == 0.0 ? normalize(light_pos[i].xyz) : normalize(light_pos[i].xyz - v_pos);
+        float lit = max(dot(n, l), 0.0);
+        if (light_spot[i].w > -1.0)     // soft edged cone
+            lit *= smoothstep(light_spot[i].w, light_spot[i].w + .05, dot(-l, normalize(light_spot[i].xyz)));
+        if (lit > 0.0) {{
+            float spec = pow(max(dot(n, normalize(l + to_eye)), 0.0), shininess);
+            color += lit * light_diffuse[i] * diffuse + spec * light_specular[i] * v_specular;
+        }}
+    }}
+    gl_FragColor = vec4(color, 1.0);
+}}
+"""
+
+
+# A light in world space. w of 0 in pos makes it directional. Spotlights shine along spot within cutoff degrees.
+class Light:
+    def __init__(self, pos, diffuse=(1, 1, 1), specular=(1, 1, 1), spot=None, cutoff=180):
+        self.pos = tuple(pos) if len(pos) == 4 else (*pos, 1.0)
+        self.diffuse = diffuse
+        self.specular = specular
+        self.spot = spot
+        self.cutoff = cutoff
+
+
+SUN = Light((-10, 10, -10, 0), diffuse=(1, 1, 0), specular=(.5, .5, .5))   # LIGHT0 in init_lighting
+SPOT_OFFSET = (4.5, -0.5, 0)    # where the ship's spotlight sits, in ship space
+SPOT_CUTOFF = 60
+
+
+# The spotlight render_lights has in testing, from anything with pos and orient
+def ship_spotlight(ship):
+    pos = add_vecs(ship.pos, qv_mult(ship.orient, SPOT_OFFSET))
+    return Light(pos, spot=qv_mult(ship.orient, (1, 1, 0)), cutoff=SPOT_CUTOFF)
+
+
+# One mesh in a vertex buffer: every material's triangles back to back, tagged with their material slot.
+# The object's parts (planet trees) are baked in where they sit, so the whole thing is one draw.
+class ShadedMesh:
+    def __init__(self, obj):
+        pieces = [(obj, mat, pos, norm, uv) for mat, pos, norm, uv in obj._draw_batches()]
+        for part, matrix in obj.parts:
+            rot = matrix[:3, :3]
+            for mat, pos, norm, uv in part._draw_batches():
+                pieces.append((part, mat, part.scale * pos @ rot.T + matrix[:3, 3], norm @ rot.T, uv))
+
+        self.count = sum(len(piece[2]) for piece in pieces)
+        data = np.zeros(self.count, VERTEX)
+        slots = {}
+        start = 0
+        for owner, mat, pos, norm, uv in pieces:
+            end = start + len(pos)
+            data['pos'][start:end] = pos
+            data['norm'][start:end] = norm
+            if uv is not None:
+                data['uv'][start:end] = uv
+            data['mat'][start:end] = slots.setdefault((id(owner), mat), len(slots))
+            start = end
+        owners = {id(o): o for o, *rest in pieces}
+        self.materials = [(owners[key], mat) for key, mat in slots]    # (object, index into its mat_names, -1 for none)
+        if len(self.materials) > MAX_MATERIALS:
+            raise ValueError(f"{obj.name} has {len(self.materials)} materials, shaders take {MAX_MATERIALS}")
+
+        self.vbo = pool.gen(BUFFER, obj, shared=obj.cached)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    # ambient, diffuse, specular and emission of every slot as it is now, (4, slots, 3)
+    def pack_materials(self):
+        packed = np.zeros((4, len(self.materials), 3), dtype=np.float32)
+        for slot, (obj, mat) in enumerate(self.materials):
+            m = obj.mats.get(obj.mat_names[mat], Material()) if mat >= 0 else Material()
+            packed[:, slot] = m.amb[:3], m.diff[:3], m.spec[:3], m.emm[:3]
+        return packed
+
+    def delete(self):
+        pool.release(BUFFER, self.vbo)
+
+
+# Per-pixel lighting for DisplayObj meshes. Between begin() and end() every drawObj goes through here instead
+# of its display list: one draw per mesh from a vertex buffer, materials as uniform arrays indexed by a vertex
+# attribute, and the buffer, materials and texture only set again when they differ from the last draw.
+class LightingProgram:
+    def __init__(self):
+        self.program = compileProgram(
+            compileShader(VERTEX_SHADER, GL_VERTEX_SHADER),
+            compileShader(FRAGMENT_SHADER, GL_FRAGMENT_SHADER)
+        )
+        self.uniforms = {name: glGetUniformLocation(self.program, name) for name in (
+            'mat_ambient', 'mat_diffuse', 'mat_specular', 'mat_emission', 'light_count', 'light_pos',
+            'light_diffuse', 'light_specular', 'light_spot', 'ambient', 'shininess', 'textured', 'tex')}
+        self.material_attr = glGetAttribLocation(self.program, 'material')
+        self.state_changes = 0  # buffer binds, uniform uploads and texture binds since the last begin
+        self.draws = 0
+        self._bound = None      # mesh whose buffer is bound
+        self._materials = None  # material uniforms as last uploaded
+        self._texture = None
+
+    # None, with the reason printed, if the driver can't run the shaders
+    @staticmethod
+    def create():
+        try:
+            return LightingProgram()
+        except Exception as e:     # no GLSL 1.20, compile errors, missing entry points
+            print(f"GLSL lighting unavailable, using fixed-function lighting: {str(e).splitlines()[0]}")
+            return None
+
+    # Bind the program with these lights. Positions go to eye space through the current modelview matrix,
+    # the same thing glLightfv does, so call this with the camera loaded.
+    def begin(self, lights, ambient=AMBIENT):
+        view = glGetFloatv(GL_MODELVIEW_MATRIX).T
+        lights = lights[:MAX_LIGHTS]
+        pos = np.zeros((MAX_LIGHTS, 4), dtype=np.float32)
+        spot = np.zeros((MAX_LIGHTS, 4), dtype=np.float32)
+        diffuse = np.zeros((MAX_LIGHTS, 3), dtype=np.float32)
+        specular = np.zeros((MAX_LIGHTS, 3), dtype=np.float32)
+        for i, light in enumerate(lights):
+            pos[i] = view @ light.pos
+            diffuse[i] = light.diffuse
+            specular[i] = light.specular
+            spot[i, 3] = -1
+            if light.spot is not None:
+                spot[i, :3] = view[:3, :3] @ light.spot
+                spot[i, 3] = np.cos(np.radians(light.cutoff))
+
+        glUseProgram(self.program)
+        u = self.uniforms
+        glUniform1i(u['light_count'], len(lights))
+        glUniform4fv(u['light_pos'], MAX_LIGHTS, pos)
+        glUniform3fv(u['light_diffuse'], MAX_LIGHTS, diffuse)
+        glUniform3fv(u['light_specular'], MAX_LIGHTS, specular)
+        glUniform4fv(u['light_spot'], MAX_LIGHTS, spot)
+        glUniform3f(u['ambient'], *ambient)
+        glUniform1f(u['shininess'], SHININESS)
+        glUniform1i(u['tex'], 0)
+        glUniform1i(u['textured'], 0)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableVertexAttribArray(self.material_attr)
+        self.state_changes = 12
+        self.draws = 0
+        self._bound = self._materials = self._texture = None
+        DisplayObj.program = self
+
+    def end(self):
+        DisplayObj.program = None
+        glDisableVertexAttribArray(self.material_attr)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_NORMAL_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glUseProgram(0)
+
+    # DisplayObj.drawObj while the program is bound
+    def draw(self, obj):
+        if obj.usetex and obj.texindex == -1:
+            obj.register_texture(obj.texfile)
+        if obj.mesh is None:
+            obj.mesh = ShadedMesh(obj)
+        mesh = obj.mesh
+        if obj.scale != 1.0:
+            glScalef(obj.scale, obj.scale, obj.scale)
+
+        if mesh is not self._bound:
+            stride = VERTEX.itemsize
+            glBindBuffer(GL_ARRAY_BUFFER, mesh.vbo)
+            glVertexPointer(3, GL_FLOAT, stride, ctypes.c_void_p(VERTEX.fields['pos'][1]))
+            glNormalPointer(GL_FLOAT, stride, ctypes.c_void_p(VERTEX.fields['norm'][1]))
+            glTexCoordPointer(2, GL_FLOAT, stride, ctypes.c_void_p(VERTEX.fields['uv'][1]))
+            glVertexAttribPointer(self.material_attr, 1, GL_FLOAT, GL_FALSE, stride,
+                                  ctypes.c_void_p(VERTEX.fields['mat'][1]))
+            self._bound = mesh
+            self.state_changes += 5
+
+        packed = mesh.pack_materials()
+        if self._materials is None or not np.array_equal(packed, self._materials):
+            u = self.uniforms
+            n = len(mesh.materials)
+            glUniform3fv(u['mat_ambient'], n, packed[0])
+            glUniform3fv(u['mat_diffuse'], n, packed[1])
+            glUniform3fv(u['mat_specular'], n, packed[2])
+            glUniform3fv(u['mat_emission'], n, packed[3])
+            self._materials = packed
+            self.state_changes += 4
+
+        texture = obj.texindex if obj.usetex else None
+        if texture != self._texture:
+            if texture is not None:
+                glBindTexture(GL_TEXTURE_2D, texture)
+            glUniform1i(self.uniforms['textured'], texture is not None)
+            self._texture = texture
+            self.state_changes += 1 + (texture is not None)
+
+        glDrawArrays(GL_TRIANGLES, 0, mesh.count)
+        self.draws += 1
+
+
+# GL calls a display list made by DisplayObj.register replays: client state on and off, the scale, and per
+# material its four glMaterialfv calls, the pointers and the draw. Textured lists also set up the texture.
+def fixed_function_calls(obj):
+    calls = 6
+    for mat, pos, norm, uv in obj._draw_batches():
+        calls += (0 if obj.usetex else 4) + 3 + (3 if uv is not None else 0)
+    if obj.usetex:
+        calls += 6
+    return calls
+
+
+# Frame time and GL state changes of both lighting paths on a late level's worth of objects.
+# Headless under Mesa's software rasterizer: PYOPENGL_PLATFORM=egl python -m utils.shaders
+if __name__ == "__main__":
+    import os
+    import random
+    import sys
+
+    from pyobjs.Asteroid import Asteroid
+    from pyobjs.Planet import Planet
+    from pyobjs.Spaceship import Spaceship
+    from utils.util import offscreen_context
+
+    width, height = 500, 300
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if os.environ.get("PYOPENGL_PLATFORM") == "egl":
+        offscreen_context(width, height)
+    else:
+        import pygame
+        pygame.init()
+        pygame.display.set_mode((width, height), pygame.DOUBLEBUF | pygame.OPENGL | pygame.HIDDEN)
+    print(f"{glGetString(GL_RENDERER).decode()}, OpenGL {glGetString(GL_VERSION).decode()}")
+
+    random.seed(1)
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+    glLightModelfv(GL_LIGHT_MODEL_AMBIENT, (*AMBIENT, .8))
+    glLightfv(GL_LIGHT0, GL_DIFFUSE, (*SUN.diffuse, .5))
+    glLightfv(GL_LIGHT0, GL_SPECULAR, (*SUN.specular, 0))
+    glMatrixMode(GL_PROJECTION)
+    glLoadIdentity()
+    glFrustum(-.05, .05, -.03, .03, .1, 500)
+    glMatrixMode(GL_MODELVIEW)
+
+    ship = Spaceship()
+    ship.point_arrow_at((200, 0, 0))
+    objects = [ship]
+    objects += [Planet(None, radius=random.uniform(5, 20), pos=(random.uniform(60, 160), random.uniform(-40, 40),
+                                                                   random.uniform(-60, 60))) for i in range(6)]
+    for i in range(40):
+        pos = (random.uniform(20, 150), random.uniform(-30, 30), random.uniform(-50, 50))
+        aa = (random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(0, 6))
+        objects.append(Asteroid(pos, aa, variant=None if i % 4 == 0 else (i % 3, 2)))
+    for obj in objects:
+        obj.transform.pos = obj.pos
+        obj.transform.quat = getattr(obj, 'quat', obj.transform.quat)
+    ship.orient = (1, 0, 0, 0)
+
+    def camera():
+        glLoadIdentity()
+        glTranslatef(0, 0, -20)
+        glRotatef(-90, 0, 1, 0)
+        glLightfv(GL_LIGHT0, GL_POSITION, SUN.pos)
+
+    def frame(program):
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        camera()
+        if program:
+            program.begin([SUN, ship_spotlight(ship)])
+        for obj in objects:
+            obj.render()
+        if program:
+            program.end()
+        glFinish()
+
+    def best_ms(program):
+        frame(program)      # uploads and shader compiles happen on the first frame
+        times = []
+        for i in range(frames):
+            t = time.perf_counter()
+            frame(program)
+            times.append(time.perf_counter() - t)
+        return 1000 * min(times), glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+
+    ff_ms, ff_pixels = best_ms(None)
+    ff_calls = sum(fixed_function_calls(o.obj) for o in objects) + fixed_function_calls(ship.arrow_obj)
+    ff_calls += sum(Planet.NUM_TREES * fixed_function_calls(p.tree_obj) for p in objects if isinstance(p, Planet))
+    program = LightingProgram()
+    sh_ms, sh_pixels = best_ms(program)
+
+    lit = lambda px: np.count_nonzero(np.frombuffer(px, np.uint8).reshape(-1, 3).any(axis=1))
+    print(f"{len(objects)} objects, {program.draws} draws with shaders")
+    print(f"fixed function: {ff_ms:.1f} ms/frame, {ff_calls} GL calls replayed from display lists, "
+          f"{lit(ff_pixels)} pixels drawn")
+    print(f"GLSL:           {sh_ms:.1f} ms/frame, {program.state_changes} state changes + {program.draws} draws, "
+          f"{lit(sh_pixels)} pixels drawn")
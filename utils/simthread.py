@@ -0,0 +1,276 @@
+"""
+File: simthread.py
+Author: Jay Kmetz
+"""
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from utils.quat import normalize, qv_mult
+from utils.util import mag, sub_vecs
+
+
+# GLOBALS
+SIM_RATE = 60           # ticks a second on the simulation thread
+TIMING_SAMPLES = 600    # tick intervals and frame latencies kept for the stats
+
+
+# The ship values the HUD, camera, radar and the ship's own drawing read, copied at the end of a tick.
+# arrow_vec points the ship's arrow away from target_pos, like Spaceship.point_arrow_at.
+class ShipView:
+    __slots__ = ('pos', 'orient', 'vel', 'rpy', 'health', 'fuel', 'thrusting', 'arrow_vec')
+
+    def __init__(self, ship, target_pos):
+        self.pos = tuple(ship.pos)
+        self.orient = tuple(ship.orient)
+        self.vel = tuple(ship.vel)
+        self.rpy = tuple(ship.rpy)
+        self.health = ship.health
+        self.fuel = ship.fuel
+        self.thrusting = ship.thrusting
+        self.arrow_vec = normalize(sub_vecs(self.pos, target_pos))
+
+    def getVelMag(self):
+        return mag(self.vel)
+
+    def getUpVec(self):
+        return qv_mult(self.orient, (0.0, 1.0, 0.0))
+
+
+# Everything the renderer needs from one tick. Objects are drawn with the model matrices copied here rather
+# than their live transforms, so the next tick can move them while this one is on screen.
+class Frame:
+    def __init__(self):
+        self.tick = -1
+        self.published = 0.0    # perf_counter when the tick finished
+        self.objects = []       # scene objects in draw order
+        self.matrices = np.zeros((0, 4, 4), dtype=np.float32)
+        self._mats = self.matrices  # grows, never shrinks
+        self.ship = None        # ShipView
+        self.target = None      # the planet to land on, only its fixed size and landing plane are read
+        self.target_pos = None  # and where it was this tick
+        self.asteroid_pos = np.zeros((0, 3))
+        self.asteroid_vel = np.zeros((0, 3))
+        self.path = None        # Trajectory.freeze()
+        self.impact = None      # Trajectory.impact
+        self.message = None     # (text, color) held on screen until a key goes down
+
+    # copy every object's model matrix. The object list is the scene's cached one, which is replaced
+    # rather than changed when the scene changes.
+    def set_objects(self, objects):
+        n = len(objects)
+        if len(self._mats) < n:
+            self._mats = np.zeros((2 * n, 4, 4), dtype=np.float32)
+        for i, obj in enumerate(objects):
+            self._mats[i] = obj.transform.matrix()
+        self.objects = objects
+        self.matrices = self._mats[:n]
+
+    def stamp(self, tick):
+        self.tick = tick
+        self.published = time.perf_counter()
+
+
+# Tick intervals and how old frames are when they reach the screen
+class TickTimer:
+    def __init__(self, samples=TIMING_SAMPLES):
+        self.intervals = deque(maxlen=samples)
+        self.latencies = deque(maxlen=samples)
+        self.last = None
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.last is not None:
+            self.intervals.append(now - self.last)
+        self.last = now
+
+    # a frame published at perf_counter() time published was just flipped
+    def shown(self, published):
+        self.latencies.append(time.perf_counter() - published)
+
+    def stats(self):
+        intervals = 1000 * np.array(self.intervals or [0.0])
+        latencies = 1000 * np.array(self.latencies or [0.0])
+        return {
+            'tick_ms': intervals.mean(),
+            'jitter_ms': intervals.std(),
+            'worst_ms': intervals.max(),
+            'latency_ms': latencies.mean(),
+            'latency_p95_ms': np.percentile(latencies, 95)
+        }
+
+    def report(self):
+        s = self.stats()
+        return (f"tick {s['tick_ms']:.1f} ms, jitter {s['jitter_ms']:.2f} (worst {s['worst_ms']:.1f}), "
+                f"render latency {s['latency_ms']:.1f} ms (p95 {s['latency_p95_ms']:.1f})")
+
+
+# Runs tick() at a fixed rate on its own thread and hands each result to the renderer through three frames:
+# one being written, the newest finished one, and the one on screen. Publishing and taking a frame are
+# pointer swaps under a lock held for nothing else, so neither side ever waits on the other's work.
+# tick() returns whether the world moved, capture(frame) copies it into the back frame if it did.
+class SimThread:
+    def __init__(self, tick, capture, rate=SIM_RATE):
+        self.tick_fn = tick
+        self.capture_fn = capture
+        self.period = 1 / rate
+        self.ticks = 0
+        self.timer = TickTimer()
+
+        self._back, self._ready, self._front = Frame(), Frame(), Frame()
+        self._fresh = False     # _ready holds a frame the renderer hasn't taken
+        self._swap = threading.Lock()
+
+        self._idle = threading.Condition()
+        self._paused = False
+        self._busy = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    # finish the tick in progress and stop
+    def stop(self):
+        with self._idle:
+            self._running = False
+            self._idle.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    # Hold the simulation between ticks, for changes it must not see half done (a new level).
+    # Returns once the tick in progress has finished.
+    def pause(self):
+        with self._idle:
+            self._paused = True
+            while self._busy:
+                self._idle.wait()
+
+    # carry on from now, frames finished before the pause are dropped
+    def resume(self):
+        with self._swap:
+            self._fresh = False
+        with self._idle:
+            self._paused = False
+            self._idle.notify_all()
+
+    # newest finished frame, None if there is nothing new since the last call
+    def acquire(self):
+        with self._swap:
+            if not self._fresh:
+                return None
+            self._front, self._ready = self._ready, self._front
+            self._fresh = False
+            return self._front
+
+    def _publish(self):
+        self._back.stamp(self.ticks)
+        with self._swap:
+            self._back, self._ready = self._ready, self._back
+            self._fresh = True
+
+    def _run(self):
+        deadline = time.perf_counter()
+        while True:
+            with self._idle:
+                if self._paused:
+                    while self._paused and self._running:
+                        self._idle.wait()
+                    deadline = time.perf_counter()
+                if not self._running:
+                    return
+                self._busy = True
+            self.timer.tick()
+            if self.tick_fn():
+                self.ticks += 1
+                self.capture_fn(self._back)
+                self._publish()
+            with self._idle:
+                self._busy = False
+                self._idle.notify_all()
+
+            # fixed rate, a late tick doesn't make the next ones bunch up to catch up
+            deadline += self.period
+            wait = deadline - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            elif wait < -self.period:
+                deadline = time.perf_counter()
+
+
+# Tick jitter and render latency with and without the simulation thread, for a render that stalls every
+# second like a blocking flip or a loading screen would: python -m utils.simthread
+if __name__ == "__main__":
+    import sys
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    rng = np.random.default_rng(0)
+    bodies = rng.standard_normal((2000, 3))
+    vel = rng.standard_normal((2000, 3)) * .01
+
+    class Body:
+        def __init__(self, i):
+            self.i = i
+            self.transform = self
+
+        def matrix(self):
+            m = np.identity(4, dtype=np.float32)
+            m[3, :3] = bodies[self.i]
+            return m
+
+    objects = [Body(i) for i in range(100)]
+
+    def tick():
+        bodies[:] += vel
+        np.sqrt((bodies * bodies).sum(axis=1))     # stand-in for collisions
+        return True
+
+    def capture(frame):
+        frame.set_objects(objects)
+
+    def render(frame, n):
+        for mat in frame.matrices:
+            mat.sum()                               # stand-in for issuing the draw calls
+        time.sleep(.004)                            # GL waits release the GIL like this
+        if n % 60 == 59:
+            time.sleep(.08)                         # a stalled flip
+
+    # inline: every frame ticks, captures and renders one after another
+    timer = TickTimer()
+    frame = Frame()
+    period = 1 / SIM_RATE
+    n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        deadline = time.perf_counter() + period
+        timer.tick()
+        tick()
+        capture(frame)
+        frame.stamp(n)
+        render(frame, n)
+        timer.shown(frame.published)
+        n += 1
+        wait = deadline - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+    print(f"inline:   {timer.report()}")
+
+    # threaded: the renderer draws whatever is newest
+    sim = SimThread(tick, capture).start()
+    n = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        frame = sim.acquire()
+        if frame is None:
+            time.sleep(.001)
+            continue
+        render(frame, n)
+        sim.timer.shown(frame.published)
+        n += 1
+    sim.stop()
+    print(f"threaded: {sim.timer.report()}, {n} frames drawn of {sim.ticks} ticks")
@@ -0,0 +1,256 @@
+"""
+File: snapshot.py
+Author: Jay Kmetz
+"""
+import random
+import struct
+import time
+
+import numpy as np
+
+
+# GLOBALS
+TICKS_PER_SECOND = 60
+REWIND_SECONDS = 5
+SAVE_MAGIC = b'ISJS'
+SAVE_VERSION = 2     # 2: levels come from LevelGenerator
+SAVE_HEADER = struct.Struct('<4sHIII')  # magic, version, spinning pivots, drifting objects, bodies
+RNG_WORDS = 625     # random's Mersenne Twister state, 624 words and the position in them
+
+# ship attributes in the order they are packed, with their widths
+SHIP_FIELDS = (('pos', 3), ('vel', 3), ('force', 3), ('orient', 4), ('rpy', 3), ('fuel', 1), ('health', 1), ('thrusting', 1))
+SHIP_WIDTH = sum(width for name, width in SHIP_FIELDS)
+
+
+# Record layout of a level with the given number of spinning pivots, drifting objects and bodies.
+# World transforms aren't stored, they follow from the local transforms of what moves.
+def record_dtype(spins, drifts, bodies):
+    return np.dtype([
+        ('level', '<i4'),
+        ('tick', '<i8'),                        # ticks into the level
+        ('ship', '<f8', (SHIP_WIDTH,)),
+        ('spin', '<f8', (spins, 4)),            # local orientation of every spinning pivot
+        ('drift', '<f8', (drifts, 6)),          # local position and velocity of every drifting object
+        ('alive', 'u1', (bodies,)),             # which objects are still in the scene
+        ('planet', '<f8', (7,)),                # target planet position, radius and landing plane point
+        ('rng', '<u4', (RNG_WORDS,)),           # random's state now
+        ('level_rng', '<u4', (RNG_WORDS,))      # random's state the level was generated from
+    ])
+
+
+# random.setstate argument from packed words
+def rng_state(words):
+    return (3, tuple(words.tolist()), None)
+
+
+# Recent world states of one level in a preallocated ring of binary records, for stepping back a few seconds,
+# plus quick saves of the current state. Recording a tick copies the ship, the moving scene nodes and which
+# objects are still around into the next slot, nothing else is touched or allocated on the array side.
+class Recorder:
+    def __init__(self, scene, ship, planet, level, level_rng, seconds=REWIND_SECONDS):
+        self.scene = scene
+        self.ship = ship
+        self.spins = [n for n in scene.movers if n.spin is not None]
+        self.drifts = [n for n in scene.movers if n.drift]
+        self.bodies = [n for n in scene.walk() if n.obj is not None and not n.free]
+        self.parents = [n.parent for n in self.bodies]
+        self.dtype = record_dtype(len(self.spins), len(self.drifts), len(self.bodies))
+
+        # one slot per tick, plus a scratch slot for saves
+        self.capacity = max(1, int(seconds * TICKS_PER_SECOND))
+        self.ring = np.zeros(self.capacity + 1, self.dtype)
+        self.ring['level'] = level
+        self.ring['planet'] = (*planet.pos, planet.radius, *planet.landingplanept)
+        self.ring['level_rng'] = level_rng[1]
+        self._fields = {name: self.ring[name] for name in self.dtype.names}   # views, looked up once
+        self.head = 0       # next slot to write
+        self.count = 0      # ticks held
+        self.tick = 0
+        self._rng = None        # random's state as last captured, and where
+        self._rng_slot = 0
+        self.record()
+
+    # write the world as it is now into slot i
+    def capture(self, i):
+        ring = self._fields
+        ship = self.ship
+        ring['tick'][i] = self.tick
+        ring['ship'][i] = (*ship.pos, *ship.vel, *ship.force, *ship.orient, *ship.rpy,
+                           ship.fuel, ship.health, ship.thrusting)
+        if self.spins:
+            ring['spin'][i] = [n.local.quat for n in self.spins]
+        if self.drifts:
+            ring['drift'][i] = [(*n.local.pos, *n.obj.vel) for n in self.drifts]
+        ring['alive'][i] = [n.parent is not None for n in self.bodies]
+        # random only moves while a level is generated, copy the last words over unless it did
+        state = random.getstate()[1]
+        if state == self._rng:
+            ring['rng'][i] = ring['rng'][self._rng_slot]
+        else:
+            ring['rng'][i] = state
+            self._rng = state
+        self._rng_slot = i
+
+    # put the world back the way slot i has it, objects are placed rather than swept into position
+    def restore(self, i):
+        rec = self.ring[i]
+        ship = self.ship
+        s = rec['ship'].tolist()    # python floats, numpy scalars would slow every tick after this down
+        ship.teleport(tuple(s[0:3]))
+        ship.vel = tuple(s[3:6])
+        ship.force = tuple(s[6:9])
+        ship.orient = tuple(s[9:13])
+        ship.rpy = s[13:16]
+        ship.fuel = s[16]
+        ship.health = int(s[17])
+        ship.thrusting = int(s[18])
+
+        for node, quat in zip(self.spins, rec['spin'].tolist()):
+            node.local.quat = tuple(quat)
+        for node, drift in zip(self.drifts, rec['drift'].tolist()):
+            node.local.pos = tuple(drift[:3])
+            node.obj.vel = tuple(drift[3:])
+        for node, parent, alive in zip(self.bodies, self.parents, rec['alive']):
+            if alive and node.parent is None:
+                self.scene.add(node, parent)
+            elif not alive and node.parent is not None:
+                self.scene.remove(node)
+        self.scene.reset()
+        random.setstate(rng_state(rec['rng']))
+        self._rng = None
+        self.tick = int(rec['tick'])
+
+    # keep this tick, overwriting the oldest once the ring is full
+    def record(self):
+        self.capture(self.head)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.tick += 1
+
+    # Go back up to ticks recorded ticks. The oldest one is kept to go back to. False if there is nothing left.
+    def rewind(self, ticks=1):
+        ticks = min(ticks, self.count - 1)
+        if ticks <= 0:
+            return False
+        self.head = (self.head - ticks) % self.capacity
+        self.count -= ticks
+        self.restore((self.head - 1) % self.capacity)
+        self.tick += 1      # the next record follows the restored one
+        return True
+
+    def save(self, fname):
+        self.capture(self.capacity)
+        with open(fname, 'wb') as fp:
+            fp.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, len(self.spins), len(self.drifts), len(self.bodies)))
+            fp.write(self.ring[self.capacity:].tobytes())
+
+    # Restore a record from read_save. The level has to have been rebuilt from the record's level_rng first.
+    def load(self, saved):
+        if saved.dtype != self.dtype or not np.allclose(saved['planet'], self.ring['planet'][0]):
+            raise ValueError("saved state is from a different level")
+        self.ring[self.capacity] = saved
+        self.restore(self.capacity)
+        self.head = self.count = 0
+        self.record()
+
+
+# The record in a save file, a structured scalar with level, level_rng and the rest
+def read_save(fname):
+    with open(fname, 'rb') as fp:
+        data = fp.read()
+    magic, version, spins, drifts, bodies = SAVE_HEADER.unpack_from(data)
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        raise ValueError(f"{fname} is not a version {SAVE_VERSION} save")
+    return np.frombuffer(data, record_dtype(spins, drifts, bodies), 1, SAVE_HEADER.size)[0]
+
+
+# Capture and restore costs on a scene the size of a late level: python -m utils.snapshot
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from pyobjs.ColObj import ColObj
+    from utils.SceneGraph import SceneGraph, SceneNode
+
+    class Body(ColObj):
+        def __init__(self, vel=(0, 0, 0)):
+            super().__init__((0, 0, 0))
+            self.vel = vel
+
+    class Ship(Body):
+        def __init__(self):
+            super().__init__()
+            self.force = (0, 0, 0)
+            self.orient = (0, 1, 0, 0)
+            self.rpy = [0, 0, 0]
+            self.fuel = 100
+            self.health = 3
+            self.thrusting = 0
+
+        def update(self):
+            self.pos = tuple(p + v for p, v in zip(self.pos, self.vel))
+            self.rpy = [r + .001 for r in self.rpy]
+
+    rng = random.Random(0)
+    scene = SceneGraph()
+    ship = Ship()
+    ship.vel = (.1, 0, .05)
+    scene.add(SceneNode(ship, free=True))
+    planet = Body()
+    planet.radius, planet.landingplanept = 20.0, (0.0, 15.0, 0.0)
+    target = scene.add(SceneNode(planet, pos=(300, 0, 0)))
+    for moon in range(6):   # moons and planets with belts hang off spinning pivots
+        pivot = scene.add(SceneNode(spin=((0, 1, 0), .002)), target)
+        body = scene.add(SceneNode(Body(), pos=(40 + 15 * moon, 0, 0)), pivot)
+        belt = scene.add(SceneNode(spin=((0, 1, 0), .004)), body)
+        for rock in range(10):
+            scene.add(SceneNode(Body(), pos=(12, rock, 0)), belt)
+    for rock in range(24):  # asteroids drifting on their own
+        vel = tuple(rng.uniform(-.03, .03) for i in range(3))
+        scene.add(SceneNode(Body(vel), pos=(rng.uniform(0, 300), 0, 0), drift=True))
+
+    recorder = Recorder(scene, ship, planet, 5, random.getstate())
+    print(f"{len(recorder.spins)} spinning pivots, {len(recorder.drifts)} drifting, {len(recorder.bodies)} bodies, "
+          f"{recorder.dtype.itemsize} bytes a record, {recorder.ring.nbytes / 1e6:.1f} MB ring")
+
+    ticks = 3 * recorder.capacity
+    record_us = update_us = 0
+    for t in range(ticks):
+        ship.update()
+        start = time.perf_counter()
+        scene.update()
+        update_us += time.perf_counter() - start
+        if t == ticks - recorder.capacity // 2:     # hit an asteroid halfway through the rewind window
+            scene.remove(recorder.bodies[-1])
+        start = time.perf_counter()
+        recorder.record()
+        record_us += time.perf_counter() - start
+
+    start = time.perf_counter()
+    rewound = 0
+    while recorder.rewind(1):
+        rewound += 1
+    restore_us = (time.perf_counter() - start) / rewound
+    print(f"record: {1e6 * record_us / ticks:.1f} us/tick, restore: {1e6 * restore_us:.1f} us/tick "
+          f"({rewound} ticks rewound, asteroid back: {recorder.bodies[-1].parent is not None}), "
+          f"scene.update: {1e6 * update_us / ticks:.1f} us/tick")
+
+    # a save taken now loads back to the same state after the world has moved on
+    fname = os.path.join(tempfile.gettempdir(), "snapshot_bench.isj")
+    for t in range(recorder.capacity):
+        ship.update()
+        scene.update()
+        recorder.record()
+    start = time.perf_counter()
+    recorder.save(fname)
+    save_us = time.perf_counter() - start
+    expect = (ship.pos, recorder.drifts[0].world.pos, recorder.spins[0].local.quat, random.random())
+    for t in range(100):
+        ship.update()
+        scene.update()
+    start = time.perf_counter()
+    recorder.load(read_save(fname))
+    load_us = time.perf_counter() - start
+    got = (ship.pos, recorder.drifts[0].world.pos, recorder.spins[0].local.quat, random.random())
+    os.remove(fname)
+    print(f"save: {1e6 * save_us:.0f} us, load: {1e6 * load_us:.0f} us, round trip exact: {got == expect}")
@@ -0,0 +1,160 @@
+"""
+File: spatial.py
+Author: Jay Kmetz
+"""
+import time
+
+import numpy as np
+
+
+# GLOBALS
+CELL_SIZE = 32.0        # grid cell edge in world units, about the spacing of a level's asteroids
+KEY_BITS = 21           # bits per axis in a cell key
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+BRUTE_MAX = 5000        # up to this many points knn just sorts them all, the grid only pays off past it
+
+
+# Uniform grid over a set of points for k-nearest queries. Points are kept sorted by cell key so every
+# cell is a contiguous run found with a binary search. Refitting after the points move only re-sorts
+# when some point changed cell, and a nearly sorted order sorts in close to linear time.
+class GridIndex:
+    def __init__(self, cell=CELL_SIZE):
+        self.cell = cell
+        self.order = np.empty(0, dtype=np.int64)    # sorted slot -> point index
+        self.keys = np.empty(0, dtype=np.int64)     # cell key of each sorted slot
+        self.pos = np.empty((0, 3))                 # positions in sorted order
+        self.lo = self.hi = np.zeros(3, dtype=np.int64)     # occupied cell bounds
+        self.resorts = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def _cells(self, pos):
+        return np.floor(pos / self.cell).astype(np.int64)
+
+    @staticmethod
+    def _key(cells):
+        c = cells + KEY_OFFSET
+        return c[..., 0] << 2 * KEY_BITS | c[..., 1] << KEY_BITS | c[..., 2]
+
+    # Take the points' current positions. Same count as last time keeps the old order as a starting point.
+    def refit(self, pos):
+        pos = np.asarray(pos, dtype=float).reshape(-1, 3)
+        if len(pos) != len(self.order):
+            self.order = np.arange(len(pos))
+        cells = self._cells(pos[self.order])
+        keys = self._key(cells)
+        if len(keys) and (keys[1:] < keys[:-1]).any():     # someone changed cell, sort again
+            resort = np.argsort(keys, kind='stable')
+            self.order = self.order[resort]
+            keys = keys[resort]
+            cells = cells[resort]
+            self.resorts += 1
+        self.keys = keys
+        self.pos = pos[self.order]
+        if len(cells):
+            self.lo, self.hi = cells.min(axis=0), cells.max(axis=0)
+        return self
+
+    # Sorted slots of the points in the cells from lo to hi. Keys run z fastest, so the cells of every
+    # (x, y) column of the box are one run of keys, found with one pair of binary searches.
+    def _box(self, lo, hi):
+        xs, ys = np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1)
+        cols = np.empty((len(xs), len(ys), 3), dtype=np.int64)
+        cols[..., 0], cols[..., 1] = xs[:, None], ys[None]
+        cols = cols.reshape(-1, 3)
+        cols[:, 2] = lo[2]
+        start = np.searchsorted(self.keys, self._key(cols), side='left')
+        cols[:, 2] = hi[2]
+        count = np.searchsorted(self.keys, self._key(cols), side='right') - start
+        ends = np.cumsum(count)
+        return np.repeat(start - ends + count, count) + np.arange(ends[-1])
+
+    # Indices and distances of the k points nearest to q, nearest first. A cube of cells around q, clipped
+    # to the occupied cells, grows until it holds k points.
+    # Nothing closer than the kth of those can be outside the cube that just holds that distance, so one
+    # more look at that cube finishes it. A few points are faster to just sort.
+    def knn(self, q, k):
+        q = np.asarray(q, dtype=float)
+        k = min(k, len(self.order))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if len(self.order) <= BRUTE_MAX:
+            diff = self.pos - q
+            d2 = np.einsum('ij,ij->i', diff, diff)
+            slots = np.argpartition(d2, k - 1)[:k] if k < len(d2) else np.arange(len(d2))
+            nearest = slots[np.argsort(d2[slots])]
+            return self.order[nearest], np.sqrt(d2[nearest])
+
+        qc = self._cells(q)
+        # start from the cube that would hold k points at the grid's mean density, or the first that isn't empty
+        per_cell = len(self.order) / np.prod(self.hi - self.lo + 1)
+        r = max(int(np.maximum(np.maximum(self.lo - qc, qc - self.hi), 0).max()),
+                int(np.ceil(((k / per_cell) ** (1 / 3) - 1) / 2)))
+        while True:
+            lo, hi = np.maximum(self.lo, qc - r), np.minimum(self.hi, qc + r)
+            slots = self._box(lo, hi)
+            if len(slots) >= k:
+                diff = self.pos[slots] - q
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                keep = np.argpartition(d2, k - 1)[:k]
+                slots, d2 = slots[keep], d2[keep]
+                need = int(np.ceil(np.sqrt(d2.max()) / self.cell))     # cells out the kth distance reaches
+                if need <= r or ((lo == self.lo).all() and (hi == self.hi).all()):
+                    break
+                r = need
+            else:
+                r = max(2 * r, 1)
+
+        nearest = np.argsort(d2)
+        return self.order[slots[nearest]], np.sqrt(d2[nearest])
+
+
+# Query cost against brute force, from inside the field and from further and further out beside it:
+# python -m utils.spatial
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    k = 12
+    outside = (0, 150, 500)
+
+    # us per query on the grid (the brute force cut off), by knn as it is and by a full sort, and whether
+    # they all agree
+    def query_us(index, pos, queries):
+        global BRUTE_MAX
+        brute_max, BRUTE_MAX = BRUTE_MAX, 0
+        t = time.perf_counter()
+        grid = [index.knn(q, k)[0] for q in queries]
+        grid_us = 1e6 * (time.perf_counter() - t) / len(queries)
+        BRUTE_MAX = brute_max
+        t = time.perf_counter()
+        got = [index.knn(q, k)[0] for q in queries]
+        knn_us = 1e6 * (time.perf_counter() - t) / len(queries)
+        ref = [np.argsort(np.linalg.norm(pos - q, axis=1))[:k] for q in queries]
+        return grid_us, knn_us, all((g == r).all() and (h == r).all() for g, h, r in zip(grid, got, ref))
+
+    print(f"{'N':>7}{'refit (ms)':>12}{'moved refit':>13}" + "".join(f"{f'grid {d} out':>15}" for d in outside) +
+          f"{'knn (us)':>10}{'match':>7}")
+    for n in (30, 100, 300, 500, 5000, 50000):
+        half = 50 * n ** (1 / 3)    # constant density
+        pos = rng.uniform(-half, half, size=(n, 3))
+        index = GridIndex()
+        t = time.perf_counter()
+        index.refit(pos)
+        refit_ms = 1000 * (time.perf_counter() - t)
+        pos += rng.normal(scale=.2, size=pos.shape)     # one tick of drift
+        t = time.perf_counter()
+        index.refit(pos)
+        moved_ms = 1000 * (time.perf_counter() - t)
+
+        line, used, match = [], [], True
+        for d in outside:
+            queries = rng.uniform(-.8 * half, .8 * half, size=(200, 3))
+            if d:   # d units off one face of the field
+                axis = rng.integers(0, 3, len(queries))
+                queries[np.arange(len(queries)), axis] = rng.choice((-1, 1), len(queries)) * (half + d)
+            grid_us, knn_us, ok = query_us(index, pos, queries)
+            line.append(f"{grid_us:>15.1f}")
+            used.append(knn_us)
+            match &= ok
+        print(f"{n:>7}{refit_ms:>12.2f}{moved_ms:>13.2f}" + "".join(line) + f"{max(used):>10.1f}{str(match):>7}")
+    print(f"knn (slowest of the three) sorts every point up to BRUTE_MAX = {BRUTE_MAX} points")
@@ -0,0 +1,248 @@
+"""
+File: spheretree.py
+Author: Jay Kmetz
+"""
+import numpy as np
+
+
+# GLOBALS
+LEAF_TRIS = 4   # triangles per leaf, leaf pairs test all their triangle pairs at once
+SAT_BATCH = 256 # triangle pairs tested together, a hit in one batch skips the rest
+
+# Separating axis test for pairs of triangles, a and b are (P, 3, 3). True where the triangles intersect.
+# Axes are both face normals and the nine edge cross products, parallel edges give a zero axis that
+# separates nothing. The face normals go first, on their own they part most of the pairs that only come
+# near each other, and the nine edge axes are only worked out for the rest. Vectors are kept as separate
+# x, y and z arrays, numpy is slow at crosses and reductions over axes of length 3.
+def triangles_intersect(a, b):
+    a, b = a.transpose(1, 2, 0), b.transpose(1, 2, 0)     # (corner, xyz, pair)
+    ea, eb = np.roll(a, -1, axis=0) - a, np.roll(b, -1, axis=0) - b
+    lo_a, hi_a = _span(_cross(ea[0], ea[1]), b - a[0])     # b's corners against a's plane
+    lo_b, hi_b = _span(_cross(eb[0], eb[1]), a - b[0])
+    touching = ~((lo_a > 0) | (hi_a < 0) | (lo_b > 0) | (hi_b < 0))
+    rest = np.flatnonzero(touching)
+    if len(rest):
+        a, b, ea, eb = a[..., rest], b[..., rest], ea[..., rest], eb[..., rest]
+        axes = _cross(ea.transpose(1, 0, 2)[:, :, None], eb.transpose(1, 0, 2)[:, None])   # (3, 3, P) each
+        lo_a, hi_a = _span(axes, a)
+        lo_b, hi_b = _span(axes, b)
+        touching[rest] = ~((hi_a < lo_b) | (hi_b < lo_a)).any(axis=(0, 1))
+    return touching
+
+
+# u x v for vectors given as their x, y and z arrays
+def _cross(u, v):
+    return u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]
+
+
+# lowest and highest projection of three corners (corner, xyz, ...) on the axes (x, y, z)
+def _span(axes, corners):
+    x, y, z = axes
+    p0, p1, p2 = (x * c[0] + y * c[1] + z * c[2] for c in corners)
+    return np.minimum(np.minimum(p0, p1), p2), np.maximum(np.maximum(p0, p1), p2)
+
+
+# Binary tree of bounding spheres over a mesh's triangles, up to LEAF_TRIS triangles per leaf. Nodes are split
+# along the longest side of their box at the median triangle, so the tree is balanced.
+class SphereTree:
+    def __init__(self, tris, leaf_tris=LEAF_TRIS):
+        self.tris = np.ascontiguousarray(tris, dtype=float).reshape(-1, 3, 3)
+        centroids = self.tris.mean(axis=1)
+        self.tri_center = centroids     # a sphere round every triangle, to cull leaf triangle pairs
+        self.tri_radius = np.sqrt(((self.tris - centroids[:, None]) ** 2).sum(axis=2).max(axis=1))
+        center, radius, children, leaf = [], [], [], []
+
+        def build(idx):
+            node = len(center)
+            pts = self.tris[idx].reshape(-1, 3)
+            lo, hi = pts.min(axis=0), pts.max(axis=0)
+            c = (lo + hi) / 2
+            center.append(c)
+            radius.append(np.sqrt(((pts - c) ** 2).sum(axis=1).max()))
+            children.append([-1, -1])
+            leaf.append(np.full(leaf_tris, -1))
+            if len(idx) <= leaf_tris:
+                leaf[node][:len(idx)] = idx
+                return node
+            spread = np.ptp(centroids[idx], axis=0)
+            order = idx[np.argsort(centroids[idx, np.argmax(spread)], kind='stable')]
+            half = len(order) // 2
+            children[node] = [build(order[:half]), build(order[half:])]
+            return node
+
+        if len(self.tris):
+            build(np.arange(len(self.tris)))
+        self.center = np.array(center, dtype=float).reshape(-1, 3)
+        self.radius = np.array(radius, dtype=float)
+        self.children = np.array(children, dtype=np.int32).reshape(-1, 2)
+        self.leaf = np.array(leaf, dtype=np.int32).reshape(-1, leaf_tris)  # triangles of each leaf, -1 padded
+        self.is_leaf = self.children[:, 0] < 0
+
+    def __len__(self):
+        return len(self.radius)
+
+    # Whether this mesh and other's intersect, with other placed by rot and trans in this one's frame
+    # (x -> rot @ x + trans).
+    def overlaps(self, other, rot, trans):
+        return self.first_overlap(other, rot, np.reshape(trans, (1, 3))) >= 0
+
+    # Index of the first of the translations trans (S, 3) at which this mesh and other's intersect, with
+    # other placed by rot and trans[s] in this one's frame, -1 if they never do. Pairs of nodes go down both
+    # trees together, a level of each per pass, placed at the middle translation with their reach widened
+    # by how far the others are from it, so one walk does for all of them. Pairs of leaf triangles are then
+    # tested at every translation, the earliest first, and a hit ends the search once nothing earlier is left.
+    def first_overlap(self, other, rot, trans):
+        trans = np.asarray(trans, dtype=float).reshape(-1, 3)
+        if not len(self) or not len(other) or not len(trans):
+            return -1
+        rot = np.asarray(rot, dtype=float)
+        mid = (trans.min(axis=0) + trans.max(axis=0)) / 2
+        spread = np.sqrt(((trans - mid) ** 2).sum(axis=1).max())
+        centers = other.center @ rot.T + mid
+        tri_centers = tris = None   # other's triangles turned into this frame and placed at mid, once needed
+        best = len(trans)
+        a = b = np.zeros(1, dtype=np.int32)
+        while len(a):
+            gap = self.center[a] - centers[b]
+            reach = self.radius[a] + other.radius[b] + spread
+            keep = np.einsum('ij,ij->i', gap, gap) <= reach * reach
+            a, b = a[keep], b[keep]
+
+            leaf_a, leaf_b = self.is_leaf[a], other.is_leaf[b]
+            both = leaf_a & leaf_b
+            if both.any():
+                if tris is None:
+                    tri_centers, tris = other.tri_center @ rot.T + mid, other.tris @ rot.T
+                ia = np.repeat(self.leaf[a[both]], other.leaf.shape[1], axis=1).ravel()
+                ib = np.tile(other.leaf[b[both]], self.leaf.shape[1]).ravel()
+                valid = (ia >= 0) & (ib >= 0)
+                ia, ib = ia[valid], ib[valid]
+                gap = self.tri_center[ia] - tri_centers[ib]
+                reach = self.tri_radius[ia] + other.tri_radius[ib]
+                close = np.einsum('ij,ij->i', gap, gap) <= (reach + spread) ** 2    # at any translation
+                ia, ib, reach = ia[close], ib[close], reach[close]
+                gap = (gap[close] + mid)[None] - trans[:best, None]    # (S, pairs, 3)
+                slack = np.einsum('spk,spk->sp', gap, gap) - reach * reach
+                si, near = np.nonzero(slack <= 0)   # by translation, the earliest first
+                order = np.lexsort((slack[si, near], si))  # then the deepest first
+                si, near = si[order], near[order]
+                for i in range(0, len(near), SAT_BATCH):
+                    keep = si[i:i + SAT_BATCH] < best
+                    sj, jn = si[i:i + SAT_BATCH][keep], near[i:i + SAT_BATCH][keep]
+                    if not len(sj):
+                        break
+                    hit = triangles_intersect(self.tris[ia[jn]], tris[ib[jn]] + trans[sj][:, None])
+                    if hit.any():
+                        best = int(sj[hit].min())
+                if best == 0:
+                    return 0
+                a, b, leaf_a, leaf_b = a[~both], b[~both], leaf_a[~both], leaf_b[~both]
+
+            # split every inner node of a pair into its children, a leaf stays as it is
+            ca = np.where(leaf_a[:, None], a[:, None], self.children[a])
+            cb = np.where(leaf_b[:, None], b[:, None], other.children[b])
+            keep = ~(np.outer(leaf_a, (False, False, True, True)) | np.outer(leaf_b, (False, True, False, True)))
+            a = np.repeat(ca, 2, axis=1)[keep]
+            b = np.tile(cb, 2)[keep]
+        return best if best < len(trans) else -1
+
+
+# Accuracy of the old collision spheres and cost per candidate pair of the tree test, ship against asteroids
+# placed at random inside their bounding spheres' reach: python -m utils.spheretree
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from utils.DisplayObj import DisplayObj
+    from utils.meshgen import asteroid_variant
+    from utils.quat import q_to_mat4, normalize
+
+    pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    rng = np.random.default_rng(0)
+    ship = DisplayObj()
+    ship.objFileImport("./wfobjs/spaceship")
+    stock = DisplayObj()
+    stock.objFileImport("./wfobjs/asteroid")
+    asteroids = [stock] + [asteroid_variant(seed, 2) for seed in range(4)]
+
+    t = time.perf_counter()
+    trees = [obj.sphere_tree for obj in [ship] + asteroids]
+    build_ms = 1000 * (time.perf_counter() - t) / len(trees)
+    print(f"ship: {len(ship.sphere_tree.tris)} triangles, {len(ship.sphere_tree)} nodes; "
+          f"trees built in {build_ms:.1f} ms each")
+
+    def random_rot():
+        return q_to_mat4(normalize(rng.normal(size=4)))[:3, :3].astype(float)
+
+    checked = min(pairs, 30)    # pairs also tested triangle against triangle, that is slow
+    crude_hits = tree_hits = false_pos = false_neg = mismatches = 0
+    tree_s = brute_s = crude_s = 0.0
+    for i in range(pairs):
+        ast = asteroids[i % len(asteroids)]
+        ra, rb = random_rot(), random_rot()
+        direction = normalize(rng.normal(size=3))
+        pos = np.array(direction) * rng.uniform(0, ship.maxr + ast.maxr)
+        rot, trans = ra.T @ rb, ra.T @ pos     # asteroid in the ship's frame
+
+        t = time.perf_counter()
+        crude = np.linalg.norm(pos) <= 2 * ship.maxr / 3 + 2 * ast.maxr / 3
+        crude_s += time.perf_counter() - t
+
+        t = time.perf_counter()
+        hit = ship.sphere_tree.overlaps(ast.sphere_tree, rot, trans)
+        tree_s += time.perf_counter() - t
+
+        if i < checked:
+            t = time.perf_counter()
+            ta = np.repeat(ship.sphere_tree.tris, len(ast.sphere_tree.tris), axis=0)
+            tb = np.tile(ast.sphere_tree.tris @ rot.T + trans, (len(ship.sphere_tree.tris), 1, 1))
+            mismatches += hit != triangles_intersect(ta, tb).any()
+            brute_s += time.perf_counter() - t
+
+        crude_hits += crude
+        tree_hits += hit
+        false_pos += crude and not hit
+        false_neg += hit and not crude
+
+    print(f"sphere tree against every triangle pair: {mismatches} disagreements in {checked} pairs")
+    print(f"{pairs} candidate pairs, {tree_hits} touching")
+    print(f"2/3 max radius spheres: {crude_hits} hits, {false_pos} false hits, {false_neg} missed")
+    print(f"cost per pair: spheres {1e6 * crude_s / pairs:.1f} us, tree {1e6 * tree_s / pairs:.0f} us, "
+          f"every triangle pair {1e3 * brute_s / checked:.0f} ms")
+
+    # Ship flying past asteroids closer than their bounding spheres, swept by ColObj.narrow_time_of_impact.
+    # first_overlap on a pass's sample translations is checked against overlaps on them one at a time.
+    from types import SimpleNamespace
+
+    from pyobjs.ColObj import narrow_time_of_impact, NARROW_STEP
+
+    def body(obj, prev, pos, quat):
+        return SimpleNamespace(tree=obj.sphere_tree, transform=SimpleNamespace(quat=quat), prev_pos=tuple(prev),
+                               step_delta=lambda: tuple(np.subtract(pos, prev)))
+
+    passes = max(1, pairs // 5)
+    wrong = touched = 0
+    sweep_s, worst_s = 0.0, 0.0
+    for i in range(passes):
+        ast = asteroids[1 + i % (len(asteroids) - 1)]
+        d = np.array(normalize(rng.normal(size=3)))
+        speed = rng.uniform(1, 12)     # units a step
+        side = np.cross(d, rng.normal(size=3))
+        start = side / np.linalg.norm(side) * rng.uniform(0, ship.maxr + ast.maxr) - d * speed * rng.uniform(.5, 1)
+        qa, qb = normalize(rng.normal(size=4)), normalize(rng.normal(size=4))
+
+        ra, rb = q_to_mat4(qa)[:3, :3].astype(float), q_to_mat4(qb)[:3, :3].astype(float)
+        trans = (start + np.linspace(0, 1, 16)[:, None] * d * speed) @ ra    # asteroid in the ship's frame
+        one_by_one = [ship.sphere_tree.overlaps(ast.sphere_tree, ra.T @ rb, tr) for tr in trans]
+        first = ship.sphere_tree.first_overlap(ast.sphere_tree, ra.T @ rb, trans)
+        wrong += first != (one_by_one.index(True) if any(one_by_one) else -1)
+
+        t = time.perf_counter()
+        toi = narrow_time_of_impact(body(ship, (0, 0, 0), (0, 0, 0), qa), body(ast, start, start + d * speed, qb))
+        took = time.perf_counter() - t
+        sweep_s += took
+        worst_s = max(worst_s, took)
+        touched += np.isfinite(toi)
+    print(f"first_overlap against overlaps one translation at a time: {wrong} disagreements in {passes} passes")
+    print(f"{passes} close passes at 1 to 12 units a step, samples {NARROW_STEP} apart, {touched} touching: "
+          f"{1e3 * sweep_s / passes:.1f} ms a pass, {1e3 * worst_s:.1f} ms at worst")
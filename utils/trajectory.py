@@ -0,0 +1,213 @@
+"""
+File: trajectory.py
+Author: Jay Kmetz
+"""
+import time
+
+import numpy as np
+from OpenGL.GL import *
+
+from utils.flight import *
+from utils.gravity import accel_from
+from utils.util import sweep_spheres
+
+
+# GLOBALS
+TICKS_PER_SECOND = 60
+PREDICT_SECONDS = 3
+BUILD_BUDGET_MS = 1.0   # time a fresh prediction may spend growing each frame
+REFRESH_TICKS = 30      # obstacles are extrapolated in straight lines, re-read them this often
+MATCH_TOL = 1e-9        # how close the ship has to be to the prediction for it to still hold
+
+PATH_COLOR = (0.2, 0.9, 1.0, 0.8)
+IMPACT_COLOR = (1.0, 0.15, 0.1, 0.9)
+LANDING_COLOR = (0.2, 1.0, 0.2, 0.9)
+
+
+# Where the ship goes over the next few seconds if it keeps its current inputs, and what it hits on the way.
+# While the inputs stay the same and the ship follows the prediction, every frame only drops the point the
+# ship reached and adds one tick at the far end, and only that new segment is swept against the obstacles.
+class Trajectory:
+    def __init__(self, seconds=PREDICT_SECONDS, dt=1.0, budget_ms=BUILD_BUDGET_MS):
+        self.ticks = int(seconds * TICKS_PER_SECOND)
+        self.dt = dt
+        self.budget = budget_ms / 1000
+
+        # points and velocities along the path, a window [head, head + count) slides along the buffer
+        cap = 2 * (self.ticks + 1)
+        self.pos = np.zeros((cap, 3))
+        self.vel = np.zeros((cap, 3))
+        self.toi = np.full(cap, np.inf)     # first impact fraction of the segment starting at each point
+        self.hit = np.full(cap, -1)         # obstacle it hits
+        self.colors = np.zeros((cap, 4), dtype=np.float32)
+        self.head = 0
+        self.count = 0
+
+        self.state = None       # flight state at the last point
+        self.ship_r = 0
+        self.controls = None
+        self.gravity = None     # (positions, masses) of attractors
+
+        # obstacles as they were when last read: positions, motion per tick, radii, ticks since then
+        self.obstacles = []
+        self.obs_ids = ()
+        self.obs_pos = self.obs_step = self.obs_r = None
+        self.obs_age = 0
+
+        self.impact = None      # (seconds, obstacle, point, speed) of the first impact, or None
+        self.impact_at = 0      # points from the head on that are past the impact
+        self.update_ms = 0.0
+
+    # Advance the prediction to the ship's state after this tick's update. bits are the inputs it flew.
+    # gravity is (positions, masses) of planets pulling on the ship, or None.
+    def update(self, ship, bits, obstacles, gravity=None):
+        t0 = time.perf_counter()
+        self.ship_r = ship.colr
+        rot, thrust = bits_to_controls(np.array([bits]))
+        controls = (rot.tobytes(), thrust.tobytes())
+
+        on_path = (
+            controls == self.controls and self.count > 1
+            and np.allclose(ship.pos, self.pos[self.head + 1], rtol=0, atol=MATCH_TOL)
+            and np.allclose(ship.vel, self.vel[self.head + 1], rtol=0, atol=MATCH_TOL)
+        )
+        if on_path:     # the ship made it to the next point, drop the one behind it
+            self.head += 1
+            self.count -= 1
+            self.obs_age += 1
+        else:           # new inputs or knocked off course, start over from the ship
+            self.controls = controls
+            self.gravity = gravity
+            self.state = FlightState.from_ship(ship)
+            self.head = 0
+            self.count = 0
+            self._append()
+
+        ids = tuple(map(id, obstacles))
+        if not on_path or ids != self.obs_ids or self.obs_age >= REFRESH_TICKS:
+            self._read_obstacles(obstacles, ids)
+            self._forecast(self.head, self.head + self.count - 1)
+
+        # grow the far end, one tick when following along, as much as the budget allows after a restart
+        first = self.head + self.count - 1
+        while self.count <= self.ticks and (self.count < 2 or time.perf_counter() - t0 < self.budget):
+            if self.gravity is not None:
+                self.state.vel += accel_from(self.state.pos, *self.gravity) * self.dt
+            step(self.state, rot, thrust, self.dt)
+            self._append()
+        self._forecast(first, self.head + self.count - 1)
+
+        self._find_impact()
+        self.update_ms = 1000 * (time.perf_counter() - t0)
+
+    def _append(self):
+        if self.head + self.count == len(self.pos):     # out of room, slide the window back to the start
+            live = slice(self.head, self.head + self.count)
+            for buf in (self.pos, self.vel, self.toi, self.hit):
+                buf[:self.count] = buf[live]
+            self.head = 0
+        end = self.head + self.count
+        self.pos[end] = self.state.pos[0]
+        self.vel[end] = self.state.vel[0]
+        self.toi[end] = np.inf
+        self.hit[end] = -1
+        self.count += 1
+
+    def _read_obstacles(self, obstacles, ids):
+        self.obstacles = list(obstacles)
+        self.obs_ids = ids
+        self.obs_age = 0
+        if obstacles:
+            self.obs_pos = np.array([o.pos for o in obstacles], dtype=float)
+            self.obs_step = np.array([o.step_delta() for o in obstacles], dtype=float)
+            self.obs_r = np.array([o.colr for o in obstacles], dtype=float)
+
+    # Sweep segments [first, last) of the path against every obstacle at once. Segment k of the path is
+    # k ticks from now, where every obstacle has moved k + obs_age of its last steps from where it was read.
+    def _forecast(self, first, last):
+        if last <= first:
+            return
+        seg = np.arange(first, last)
+        self.toi[seg] = np.inf
+        self.hit[seg] = -1
+        if not self.obstacles:
+            return
+
+        p0 = self.pos[seg]
+        p1 = self.pos[seg + 1]
+        ticks = seg - self.head + self.obs_age
+
+        # only obstacles whose boxes over these ticks touch the box around these segments
+        ends = self.obs_pos[None] + ticks[[0, -1], None, None] * self.obs_step[None]
+        reach = self.obs_r[:, None] + self.ship_r
+        near = np.flatnonzero(
+            (ends.min(axis=0) - reach <= np.maximum(p0.max(axis=0), p1.max(axis=0))).all(axis=1)
+            & (ends.max(axis=0) + reach >= np.minimum(p0.min(axis=0), p1.min(axis=0))).all(axis=1)
+        )
+        if not len(near):
+            return
+
+        n = len(near)
+        step_near = self.obs_step[near]
+        ps = self.obs_pos[near][None] + ticks[:, None, None] * step_near[None]     # (segments, near, 3)
+        toi = sweep_spheres(
+            np.repeat(p0, n, axis=0), np.repeat(p1 - p0, n, axis=0), self.ship_r,
+            ps.reshape(-1, 3), np.tile(step_near, (len(seg), 1)), np.tile(self.obs_r[near], len(seg))
+        ).reshape(len(seg), n)
+        self.toi[seg] = toi.min(axis=1)
+        self.hit[seg] = np.where(np.isfinite(self.toi[seg]), near[toi.argmin(axis=1)], -1)
+
+    def _find_impact(self):
+        live = self.toi[self.head:self.head + self.count - 1]
+        hits = np.flatnonzero(np.isfinite(live))
+        self.impact = None
+        if len(hits):
+            k = hits[0]
+            i = self.head + k
+            t = live[k]
+            point = self.pos[i] + t * (self.pos[i + 1] - self.pos[i])
+            speed = np.linalg.norm(self.vel[i + 1])    # what the landing check will see
+            self.impact = ((k + t) / TICKS_PER_SECOND, self.obstacles[self.hit[i]], point, speed)
+            self.impact_at = k + 1
+
+    # copy of the path as it is now, for drawing while the next update runs
+    def freeze(self):
+        return self.pos[self.head:self.head + self.count].copy(), self.impact, self.impact_at
+
+    # path as one line strip, colored up to the first impact, then the impact point
+    def draw(self, target=None, landing_speed=0, frozen=None):
+        pos, impact, impact_at = frozen or self.freeze()
+        count = len(pos)
+        if count < 2:
+            return
+        colors = self.colors[:count]
+        fade = np.linspace(1, .2, count, dtype=np.float32)
+        colors[:] = PATH_COLOR
+        colors[:, 3] *= fade
+        marker = None
+        if impact is not None:
+            seconds, obstacle, point, speed = impact
+            landing = obstacle is target and speed <= landing_speed
+            k = impact_at
+            colors[k:] = LANDING_COLOR if landing else IMPACT_COLOR
+            colors[k:, 3] *= fade[k:]
+            marker = (point, LANDING_COLOR if landing else IMPACT_COLOR)
+
+        glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT | GL_POINT_BIT | GL_LINE_BIT)
+        glDisable(GL_LIGHTING)
+        glDisable(GL_TEXTURE_2D)
+        glLineWidth(2)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glVertexPointer(3, GL_DOUBLE, 0, pos)
+        glColorPointer(4, GL_FLOAT, 0, colors)
+        glDrawArrays(GL_LINE_STRIP, 0, count)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        if marker is not None:
+            glPointSize(10)
+            glBegin(GL_POINTS)
+            glColor4f(*marker[1])
+            glVertex3dv(marker[0])
+            glEnd()
+        glPopAttrib()
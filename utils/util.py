@@ -1,8 +1,10 @@
 from OpenGL.GL import *
 import numpy as np
+from utils import kernels
 
 # SHARED GLOBALS
 KP_UP = 'KP_UP'
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
 
 
 # Draw vector vec starting at point p1 with color col
@@ -59,6 +61,33 @@ def is_colliding(p1, r1, p2, r2):
     return dist(p1, p2) < (r1 + r2)
 
 
+# Swept sphere test. Sphere r0 moves from p0 by d0 during one step while the spheres rs move from ps by ds.
+# ps, ds and rs can hold one row per sphere, so a whole asteroid field is tested at once, and so can p0 and d0.
+# Returns the fraction of the step [0, 1] at which each pair first touches, np.inf if they never do.
+def sweep_spheres(p0, d0, r0, ps, ds, rs):
+    ps = np.atleast_2d(np.asarray(ps, dtype=float))
+    if kernels.ENABLED:
+        p0, d0, ds = (np.broadcast_to(np.asarray(v, dtype=float), ps.shape) for v in (p0, d0, ds))
+        rs = np.broadcast_to(np.asarray(rs, dtype=float), len(ps))
+        return kernels.sweep_spheres(p0, d0, float(r0), ps, ds, rs)
+    rel = np.asarray(p0, dtype=float) - ps                                  # relative start position
+    mov = np.asarray(d0, dtype=float) - np.atleast_2d(np.asarray(ds, dtype=float))  # relative motion
+    rsum = r0 + np.asarray(rs, dtype=float)
+
+    # |rel + t*mov|^2 = rsum^2  ->  a*t^2 + b*t + c = 0
+    a = np.einsum('ij,ij->i', mov, mov)
+    b = 2 * np.einsum('ij,ij->i', rel, mov)
+    c = np.einsum('ij,ij->i', rel, rel) - rsum * rsum
+    disc = b * b - 4 * a * c
+
+    toi = np.full(len(ps), np.inf)
+    moving = (a > 0) & (disc >= 0)
+    t = (-b[moving] - np.sqrt(disc[moving])) / (2 * a[moving])  # first root is the entry time
+    toi[moving] = np.where((t >= 0) & (t <= 1), t, np.inf)
+    toi[c <= 0] = 0     # already overlapping at the start of the step
+    return toi
+
+
 # takes a var and turns it into a value between 1 and maxval which asymptonically approaches maxval
 # dependent on growth_rate and center
 def logistic_approaches(var, minval, maxval, growth, center):
@@ -74,4 +103,25 @@ def spherical_to_cartesian(rho, theta, phi):
 
 
 def coltup_to_bytes(tup):
-    return bytes.fromhex(''.join(f'{n:02x}' for n in tup))
\ No newline at end of file
+    return bytes.fromhex(''.join(f'{n:02x}' for n in tup))
+
+# Offscreen OpenGL context on Mesa's surfaceless EGL platform, for running GL code without a window
+# (llvmpipe on a headless box). OpenGL has to be imported with PYOPENGL_PLATFORM=egl for calls to reach it.
+def offscreen_context(width, height):
+    import ctypes
+    from OpenGL import EGL
+
+    display = EGL.eglGetPlatformDisplay(EGL_PLATFORM_SURFACELESS_MESA, EGL.EGL_DEFAULT_DISPLAY, None)
+    EGL.eglInitialize(display, None, None)
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    config, count = EGL.EGLConfig(), EGL.EGLint()
+    attrs = (EGL.EGLint * 9)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT, EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                             EGL.EGL_DEPTH_SIZE, 24, EGL.EGL_RED_SIZE, 8, EGL.EGL_NONE)
+    EGL.eglChooseConfig(display, attrs, ctypes.pointer(config), 1, ctypes.pointer(count))
+    if not count.value:
+        raise RuntimeError("no EGL config for an offscreen OpenGL context")
+    surface = EGL.eglCreatePbufferSurface(display, config, (EGL.EGLint * 5)(
+        EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE))
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    EGL.eglMakeCurrent(display, surface, surface, context)
+    return display, surface, context